@@ -0,0 +1,205 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+import config
+import http_client
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+
+# Downloaded images and audio are kept under TEMP_PATH/cache, stored by the
+# sha256 of their content. The index maps each URL to a content hash, so two
+# URLs serving the same bytes share one file. When the cache grows past
+# ASSET_CACHE_MAX_BYTES the least recently used files are evicted.
+CACHE_PATH = os.path.join(config.TEMP_PATH, "cache")
+INDEX_PATH = os.path.join(CACHE_PATH, "index.json")
+
+stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+_index = None
+_inflight = {}
+_save_lock = asyncio.Lock()
+
+
+def _load_index() -> dict:
+    global _index
+    if _index is None:
+        os.makedirs(CACHE_PATH, exist_ok=True)
+        try:
+            with open(INDEX_PATH) as f:
+                _index = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            _index = {"urls": {}, "blobs": {}}
+    return _index
+
+
+# Write the index to disk off the event loop. Saves are serialized so the
+# last one to finish holds the latest index.
+async def _save_index():
+    async with _save_lock:
+        await asyncio.to_thread(_write_index, json.dumps(_index))
+
+
+def _write_index(data: str):
+    tmp_path = INDEX_PATH + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(data)
+    os.replace(tmp_path, INDEX_PATH)
+
+
+def _blob_path(content_hash: str) -> str:
+    return os.path.join(CACHE_PATH, content_hash)
+
+
+# Total bytes currently held in the cache
+def total_bytes() -> int:
+    return sum(blob["size"] for blob in _load_index()["blobs"].values())
+
+
+# Evict least recently used blobs until the cache fits its quota. The index
+# is updated straight away, the files are removed in a thread.
+async def _evict():
+    index = _load_index()
+    blobs = index["blobs"]
+    total = total_bytes()
+    evicted_paths = []
+    for content_hash in sorted(blobs, key=lambda h: blobs[h]["last_access"]):
+        if total <= config.ASSET_CACHE_MAX_BYTES:
+            break
+        total -= blobs.pop(content_hash)["size"]
+        index["urls"] = {u: h for u, h in index["urls"].items() if h != content_hash}
+        evicted_paths.append(_blob_path(content_hash))
+        stats["evictions"] += 1
+        logging.info(f"🧹 Evicted {content_hash} from asset cache.")
+    if evicted_paths:
+        await asyncio.to_thread(_remove_files, evicted_paths)
+
+
+def _remove_files(paths: list):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+# Path of the cached copy of a URL, or None if it isn't cached
+def lookup(url: str) -> str:
+    index = _load_index()
+    content_hash = index["urls"].get(url)
+    if content_hash is None or not os.path.exists(_blob_path(content_hash)):
+        return None
+    index["blobs"][content_hash]["last_access"] = time.time()
+    return _blob_path(content_hash)
+
+
+def _hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+async def _download(url: str) -> str:
+    try:
+        # Stable name per URL, so an interrupted download can resume next time
+        url_hash = hashlib.sha1(url.encode()).hexdigest()
+        tmp_path = os.path.join(CACHE_PATH, f"download_{url_hash}.tmp")
+        await http_client.download(url, tmp_path)
+        content_hash = await asyncio.to_thread(_hash_file, tmp_path)
+
+        index = _load_index()
+        if content_hash in index["blobs"] and os.path.exists(_blob_path(content_hash)):
+            # Same bytes already cached under another URL
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, _blob_path(content_hash))
+            index["blobs"][content_hash] = {
+                "size": os.path.getsize(_blob_path(content_hash)),
+                "last_access": time.time(),
+            }
+        index["urls"][url] = content_hash
+        index["blobs"][content_hash]["last_access"] = time.time()
+        await _evict()
+        await _save_index()
+        return content_hash
+    finally:
+        # Also when nobody is waiting any more, so a failed download isn't
+        # handed to the next caller
+        if _inflight.get(url) is asyncio.current_task():
+            del _inflight[url]
+
+
+# Download a URL into the cache, sharing one download between concurrent
+# callers. Returns the path of the cached blob.
+async def _fetch_blob(url: str) -> str:
+    if url not in _inflight:
+        _inflight[url] = asyncio.ensure_future(_download(url))
+    task = _inflight[url]
+    try:
+        content_hash = await asyncio.shield(task)
+    finally:
+        if _inflight.get(url) is task and task.done():
+            del _inflight[url]
+    return _blob_path(content_hash)
+
+
+# Put a copy of a cached blob at file_name. A hard link is instant and keeps
+# the file alive even if the blob gets evicted.
+def _place(cached_path: str, file_name: str):
+    if os.path.exists(file_name):
+        os.remove(file_name)
+    try:
+        os.link(cached_path, file_name)
+    except FileNotFoundError:
+        raise
+    except OSError:
+        shutil.copyfile(cached_path, file_name)
+
+
+# Fetch a URL through the cache and place a copy of it at file_name.
+# Returns file_name.
+async def fetch(url: str, file_name: str) -> str:
+    cached_path = lookup(url)
+    if cached_path is not None:
+        stats["hits"] += 1
+        logging.info(f"🟢 Asset cache hit for {url}")
+    else:
+        stats["misses"] += 1
+        cached_path = await _fetch_blob(url)
+
+    try:
+        _place(cached_path, file_name)
+    except FileNotFoundError:
+        if os.path.exists(cached_path):
+            raise
+        # Evicted by another download since it was looked up
+        logging.info(f"⚠️ {url} was evicted from the asset cache, downloading it again.")
+        _place(await _fetch_blob(url), file_name)
+    logging.info(f"File downloaded successfully: {file_name}")
+    return file_name
+
+
+# Bytes of a URL, from the cache when possible and otherwise straight from the
+# network without writing anything to disk.
+async def fetch_bytes(url: str) -> bytes:
+    cached_path = lookup(url)
+    if cached_path is not None:
+        stats["hits"] += 1
+        logging.info(f"🟢 Asset cache hit for {url}")
+        return await asyncio.to_thread(read_file, cached_path)
+    stats["misses"] += 1
+    return await http_client.fetch_bytes(url)
+
+
+def read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
@@ -0,0 +1,225 @@
+import logging
+import struct
+import wave
+import numpy as np
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+
+# Small in-process audio toolkit for the WAV files MusicGen returns, so that
+# trimming, fades, loudness and crossfades don't each need an ffmpeg pass.
+# Files are memory-mapped, so slicing a few seconds out of a long track only
+# reads those seconds from disk. Samples are returned as they are stored
+# (e.g. int16) with shape (frames, channels); the processing functions take
+# those or float32 in [-1, 1] and return float32.
+
+_WAVE_FORMAT_PCM = 1
+_WAVE_FORMAT_IEEE_FLOAT = 3
+_WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+_DTYPES = {
+    (_WAVE_FORMAT_PCM, 8): np.uint8,
+    (_WAVE_FORMAT_PCM, 16): np.int16,
+    (_WAVE_FORMAT_PCM, 32): np.int32,
+    (_WAVE_FORMAT_IEEE_FLOAT, 32): np.float32,
+    (_WAVE_FORMAT_IEEE_FLOAT, 64): np.float64,
+}
+
+
+# Read a WAV header: sample_rate, channels, bits, format, data_offset, frames, duration.
+# Only the header is read, no ffprobe needed.
+def probe(path: str) -> dict:
+    with open(path, "rb") as f:
+        riff, _, wave_id = struct.unpack("<4sI4s", f.read(12))
+        if riff != b"RIFF" or wave_id != b"WAVE":
+            raise Exception(f"{path} is not a WAV file.")
+
+        fmt = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise Exception(f"No audio data found in {path}.")
+            chunk_id, chunk_size = struct.unpack("<4sI", header)
+            if chunk_id == b"fmt ":
+                chunk = f.read(chunk_size)
+                audio_format, channels, sample_rate, _, block_align, bits = struct.unpack(
+                    "<HHIIHH", chunk[:16]
+                )
+                if audio_format == _WAVE_FORMAT_EXTENSIBLE:
+                    # The real format is the first two bytes of the subformat GUID
+                    audio_format = struct.unpack("<H", chunk[24:26])[0]
+                fmt = {
+                    "format": audio_format,
+                    "channels": channels,
+                    "sample_rate": sample_rate,
+                    "bits": bits,
+                    "block_align": block_align,
+                }
+            elif chunk_id == b"data":
+                if fmt is None:
+                    raise Exception(f"Audio data before format in {path}.")
+                data_offset = f.tell()
+                # Streamed WAVs may leave the size at 0 or 0xFFFFFFFF
+                f.seek(0, 2)
+                data_size = f.tell() - data_offset
+                if 0 < chunk_size < data_size:
+                    data_size = chunk_size
+                frames = data_size // fmt["block_align"]
+                return dict(
+                    fmt,
+                    data_offset=data_offset,
+                    frames=frames,
+                    duration=frames / fmt["sample_rate"],
+                )
+            else:
+                # Chunks are padded to an even size
+                f.seek(chunk_size + chunk_size % 2, 1)
+
+
+# Length of a WAV file in seconds
+def duration(path: str) -> float:
+    return probe(path)["duration"]
+
+
+# Memory-map a WAV file. Returns (samples, sample_rate); samples has shape
+# (frames, channels) and the file's sample type.
+def read(path: str):
+    info = probe(path)
+    dtype = _DTYPES.get((info["format"], info["bits"]))
+    if dtype is None:
+        raise Exception(
+            f"Unsupported WAV format {info['format']} with {info['bits']} bits in {path}."
+        )
+    samples = np.memmap(
+        path,
+        dtype=dtype,
+        mode="r",
+        offset=info["data_offset"],
+        shape=(info["frames"], info["channels"]),
+    )
+    return samples, info["sample_rate"]
+
+
+# Samples as float32 in [-1, 1]
+def to_float(samples: np.ndarray) -> np.ndarray:
+    if samples.dtype == np.uint8:
+        return (samples.astype(np.float32) - 128) / 128
+    if np.issubdtype(samples.dtype, np.integer):
+        return samples.astype(np.float32) / -np.iinfo(samples.dtype).min
+    return samples.astype(np.float32)
+
+
+# Write samples (float in [-1, 1] or int16) as a 16-bit PCM WAV
+def write(path: str, samples: np.ndarray, sample_rate: int) -> str:
+    if samples.ndim == 1:
+        samples = samples[:, None]
+    if samples.dtype != np.int16:
+        samples = (np.clip(to_float(samples), -1, 1) * 32767).astype(np.int16)
+    with wave.open(path, "wb") as f:
+        f.setnchannels(samples.shape[1])
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(samples.astype("<i2").tobytes())
+    return path
+
+
+# The samples between two times in seconds, without copying
+def slice_seconds(samples: np.ndarray, sample_rate: int, start: float, end: float = None) -> np.ndarray:
+    start_frame = max(0, round(start * sample_rate))
+    end_frame = len(samples) if end is None else min(len(samples), round(end * sample_rate))
+    return samples[start_frame:end_frame]
+
+
+# Consecutive slices of the given lengths in seconds, e.g. one per scene
+def segments(samples: np.ndarray, sample_rate: int, durations: list) -> list:
+    result = []
+    start = 0
+    for length in durations:
+        result.append(slice_seconds(samples, sample_rate, start, start + length))
+        start += length
+    return result
+
+
+# Linear fade in over the first `seconds`
+def fade_in(samples: np.ndarray, sample_rate: int, seconds: float) -> np.ndarray:
+    samples = to_float(samples)
+    length = min(len(samples), round(seconds * sample_rate))
+    samples[:length] *= np.linspace(0, 1, length, endpoint=False, dtype=np.float32)[:, None]
+    return samples
+
+
+# Linear fade out over the last `seconds`
+def fade_out(samples: np.ndarray, sample_rate: int, seconds: float) -> np.ndarray:
+    samples = to_float(samples)
+    length = min(len(samples), round(seconds * sample_rate))
+    if length:
+        samples[-length:] *= np.linspace(1, 0, length, dtype=np.float32)[:, None]
+    return samples
+
+
+# Level in dBFS: RMS by default, or the peak
+def level_dbfs(samples: np.ndarray, peak: bool = False) -> float:
+    samples = to_float(samples)
+    if peak:
+        value = np.max(np.abs(samples), initial=0)
+    else:
+        value = np.sqrt(np.mean(np.square(samples, dtype=np.float64))) if len(samples) else 0
+    return 20 * np.log10(max(float(value), 1e-10))
+
+
+# Scale to an RMS loudness of target_dbfs, but never push the peak above peak_dbfs
+def normalize(
+    samples: np.ndarray, target_dbfs: float = -16.0, peak_dbfs: float = -1.0
+) -> np.ndarray:
+    samples = to_float(samples)
+    if not len(samples) or not np.any(samples):
+        return samples
+    gain_db = min(target_dbfs - level_dbfs(samples), peak_dbfs - level_dbfs(samples, peak=True))
+    samples *= np.float32(10 ** (gain_db / 20))
+    return samples
+
+
+# Join two clips, overlapping the end of a and the start of b by `seconds`
+# with an equal-power crossfade so the loudness doesn't dip in the middle.
+def crossfade(a: np.ndarray, b: np.ndarray, sample_rate: int, seconds: float) -> np.ndarray:
+    a = to_float(a)
+    b = to_float(b)
+    length = min(len(a), len(b), round(seconds * sample_rate))
+    if length == 0:
+        return np.concatenate([a, b])
+    t = np.linspace(0, np.pi / 2, length, dtype=np.float32)[:, None]
+    overlap = a[-length:] * np.cos(t) + b[:length] * np.sin(t)
+    return np.concatenate([a[:-length], overlap, b[length:]])
+
+
+# Crossfade any number of clips in order
+def join(clips: list, sample_rate: int, seconds: float) -> np.ndarray:
+    result = to_float(clips[0])
+    for clip in clips[1:]:
+        result = crossfade(result, clip, sample_rate, seconds)
+    return result
+
+
+# Silence appended to make samples `seconds` long, if they are shorter
+def pad(samples: np.ndarray, sample_rate: int, seconds: float) -> np.ndarray:
+    missing = round(seconds * sample_rate) - len(samples)
+    if missing <= 0:
+        return samples
+    samples = to_float(samples)
+    return np.concatenate([samples, np.zeros((missing, samples.shape[1]), dtype=np.float32)])
+
+
+# Write exactly `seconds` of a WAV to another file: the start of it with a
+# short fade out, so a clip ends cleanly instead of being cut off mid-note,
+# padded with silence if the WAV is shorter
+def trim(
+    source_path: str, output_path: str, seconds: float, fade_seconds: float = 0.5, loudness_dbfs: float = None
+) -> str:
+    samples, sample_rate = read(source_path)
+    clip = fade_out(slice_seconds(samples, sample_rate, 0, seconds), sample_rate, fade_seconds)
+    if loudness_dbfs is not None:
+        clip = normalize(clip, loudness_dbfs)
+    return write(output_path, pad(clip, sample_rate, seconds), sample_rate)
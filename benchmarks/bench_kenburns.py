@@ -0,0 +1,82 @@
+"""
+Zoom renderer benchmark: renders the test_files/ image with ffmpeg's zoompan
+filter and with the NumPy renderer (kenburns.py) for each profile and reports
+wall time and CPU seconds (bot process + ffmpeg). Needs ffmpeg on the PATH.
+
+Usage: python benchmarks/bench_kenburns.py [--profiles default,fast] [--duration 8]
+"""
+import argparse
+import asyncio
+import os
+import resource
+import sys
+import tempfile
+import time
+
+REPO_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, REPO_PATH)
+
+# config.py insists on these, the benchmark doesn't use them
+os.environ.setdefault("DISCORD_TOKEN", "benchmark")
+os.environ.setdefault("REPLICATE_API_TOKEN", "benchmark")
+os.environ.setdefault("ACTIVE_CHANNEL_ID", "0")
+os.environ.setdefault("TEMP_PATH", tempfile.gettempdir() + "/")
+
+import config  # noqa: E402
+import encoding_profiles  # noqa: E402
+from video_generation import generate_video  # noqa: E402
+
+TEST_IMAGE = os.path.join(REPO_PATH, "test_files", "wanderingstan_1175179192011333713_img.jpg")
+
+
+# CPU seconds of this process (NumPy frames) plus finished children (ffmpeg)
+def cpu_seconds() -> float:
+    total = 0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+    return total
+
+
+async def render(renderer: str, profile_name: str, out_dir: str, duration: float) -> dict:
+    config.ZOOM_RENDERER = renderer
+    profile = dict(encoding_profiles.PROFILES[profile_name], name=profile_name)
+    cpu_before = cpu_seconds()
+    start = time.perf_counter()
+    video_path = await generate_video(
+        TEST_IMAGE,
+        None,
+        os.path.join(out_dir, f"{renderer}_{profile_name}_"),
+        duration=duration,
+        profile=profile,
+    )
+    return {
+        "renderer": renderer,
+        "profile": profile_name,
+        "wall_s": time.perf_counter() - start,
+        "cpu_s": cpu_seconds() - cpu_before,
+        "size_kb": os.path.getsize(video_path) / 1024,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--profiles", default=",".join(encoding_profiles.PROFILES))
+    parser.add_argument("--duration", type=float, default=8)
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as out_dir:
+        for profile_name in args.profiles.split(","):
+            for renderer in ("zoompan", "numpy"):
+                results.append(await render(renderer, profile_name, out_dir, args.duration))
+
+    print(f"{'renderer':<10} {'profile':<10} {'wall s':>8} {'cpu s':>8} {'size KB':>10}")
+    for r in results:
+        print(
+            f"{r['renderer']:<10} {r['profile']:<10} {r['wall_s']:>8.2f} {r['cpu_s']:>8.2f} {r['size_kb']:>10.0f}"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,217 @@
+"""
+End-to-end load benchmark: drives the slash command handlers in main.py with
+simulated concurrent users through a fake SlashContext, against local
+stand-ins for Glif, Replicate and the CDN (see standins.py), and reports per
+command: latency percentiles, throughput, errors, peak RSS and CPU time of
+the bot process and of its ffmpeg jobs.
+
+Each command runs in its own subprocess so peak RSS and CPU are per command.
+The stand-ins run in a thread of that process, so they are included in the
+bot's numbers. /video, /film and /film2 need ffmpeg on the PATH.
+
+Usage: python benchmarks/bench_load.py [--commands music,video] [--users 10]
+       [--requests 3] [--glif-latency 2] [--replicate-latency 5]
+       [--cdn-latency 0.1] [--failure-rate 0.05] [--reuse-assets]
+       [--split-story]
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+REPO_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, REPO_PATH)
+
+from standins import StandIns  # noqa: E402
+
+# Arguments each command is called with, per request
+COMMANDS = {
+    "music": lambda n: {"prompt": f"benchmark music {n}"},
+    "image": lambda n: {"prompt": f"benchmark image {n}"},
+    "video": lambda n: {"prompt": f"benchmark video {n}"},
+    "film": lambda n: {"prompt": f"benchmark film {n}"},
+    "film2": lambda n: {"prompt": f"benchmark film2 {n}", "duration": 12},
+    "chattorio": lambda n: {"action": f"build factory {n}"},
+}
+
+_ids = itertools.count(1)
+
+
+class FakeMessage:
+    async def edit(self, content=None, **kwargs):
+        pass
+
+    async def delete(self):
+        pass
+
+
+class FakeUser:
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.global_name = f"user{user_id}"
+
+
+# Just enough of interactions.SlashContext for the command handlers
+class FakeContext:
+    def __init__(self, user: FakeUser):
+        self.id = next(_ids)
+        self.user = user
+        self.sent = []
+
+    async def defer(self):
+        pass
+
+    async def send(self, content=None, file=None, **kwargs):
+        self.sent.append(content)
+        return FakeMessage()
+
+    send_message = send
+
+    # The handlers report failures in the channel rather than raising
+    def outcome(self) -> str:
+        for content in self.sent:
+            if isinstance(content, str) and content.startswith("🚦"):
+                return "rejected"
+            if isinstance(content, str) and content.startswith("An error occurred"):
+                return "error"
+        return "ok"
+
+
+def children_cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def self_cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+# Run one command under load in this process, return its results
+async def run_command(name: str, args) -> dict:
+    # Imported here, the environment has to point at the stand-ins first
+    import main
+    import config
+    import http_client
+    import player_store
+
+    config.db_path = os.path.join(config.TEMP_PATH, "chattorio.sqlite3")
+    http_client.start()
+    handler = getattr(main, name).callback
+
+    latencies = []
+    outcomes = {"ok": 0, "error": 0, "rejected": 0}
+
+    async def user_session(user: FakeUser):
+        for i in range(args.requests):
+            ctx = FakeContext(user)
+            started_at = time.perf_counter()
+            await handler(ctx, **COMMANDS[name](f"{user.id}-{i}"))
+            outcome = ctx.outcome()
+            outcomes[outcome] += 1
+            if outcome == "ok":
+                latencies.append(time.perf_counter() - started_at)
+
+    cpu_before = self_cpu_seconds()
+    started_at = time.perf_counter()
+    try:
+        await asyncio.gather(*(user_session(FakeUser(u + 1)) for u in range(args.users)))
+    finally:
+        wall_s = time.perf_counter() - started_at
+        await http_client.close()
+        await player_store.close()
+
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) if latencies else (0, 0, 0)
+    return {
+        "command": name,
+        **outcomes,
+        "p50_s": p50,
+        "p95_s": p95,
+        "p99_s": p99,
+        "throughput": outcomes["ok"] / wall_s,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "bot_cpu_s": self_cpu_seconds() - cpu_before,
+        "ffmpeg_cpu_s": children_cpu_seconds(),
+    }
+
+
+def run_child(args):
+    standins = StandIns(
+        glif_latency_s=args.glif_latency,
+        replicate_latency_s=args.replicate_latency,
+        cdn_latency_s=args.cdn_latency,
+        failure_rate=args.failure_rate,
+        unique_assets=not args.reuse_assets,
+    )
+    standins.start()
+    with tempfile.TemporaryDirectory() as temp_path:
+        os.environ.update(
+            DISCORD_TOKEN="benchmark",
+            REPLICATE_API_TOKEN="benchmark",
+            ACTIVE_CHANNEL_ID="0",
+            TEMP_PATH=temp_path + "/",
+            GLIF_API_URL=standins.glif_url,
+            REPLICATE_API_BASE=standins.replicate_url,
+        )
+        if args.split_story:
+            os.environ["STORY_TEXT_GLIF_ID"] = "benchmark"
+        result = asyncio.run(run_command(args.command, args))
+    standins.stop()
+    result["standin_requests"] = dict(standins.stats)
+    print(json.dumps(result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--commands", default=",".join(COMMANDS))
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--requests", type=int, default=3, help="requests per user, one after another")
+    parser.add_argument("--glif-latency", type=float, default=2.0)
+    parser.add_argument("--replicate-latency", type=float, default=5.0)
+    parser.add_argument("--cdn-latency", type=float, default=0.1)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--reuse-assets", action="store_true")
+    parser.add_argument("--split-story", action="store_true", help="make /film2 scene images separately")
+    parser.add_argument("--command", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.command:
+        run_child(args)
+        return
+
+    results = []
+    for name in args.commands.split(","):
+        child = subprocess.run(
+            [sys.executable, __file__, *sys.argv[1:], "--command", name],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+        lines = child.stdout.strip().splitlines()
+        if child.returncode != 0 or not lines:
+            print(f"{name}: benchmark run failed (exit code {child.returncode})")
+            print("\n".join(child.stderr.strip().splitlines()[-10:]))
+            continue
+        results.append(json.loads(lines[-1]))
+
+    print(
+        f"{'command':<10} {'ok':>4} {'err':>4} {'rej':>4} {'p50 s':>7} {'p95 s':>7} {'p99 s':>7} "
+        f"{'req/s':>6} {'RSS MB':>7} {'bot cpu':>8} {'ffmpeg cpu':>10}"
+    )
+    for r in results:
+        print(
+            f"{r['command']:<10} {r['ok']:>4} {r['error']:>4} {r['rejected']:>4} "
+            f"{r['p50_s']:>7.2f} {r['p95_s']:>7.2f} {r['p99_s']:>7.2f} {r['throughput']:>6.2f} "
+            f"{r['peak_rss_mb']:>7.0f} {r['bot_cpu_s']:>8.2f} {r['ffmpeg_cpu_s']:>10.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
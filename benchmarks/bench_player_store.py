@@ -0,0 +1,86 @@
+"""
+Micro-benchmark for chattorio player state: moves per second through
+player_store versus opening a new SQLite connection per call, the way glif.py
+used to.
+
+Usage: python benchmarks/bench_player_store.py [--players 50] [--moves 5000]
+"""
+import argparse
+import asyncio
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+# config.py insists on these, the benchmark doesn't use them
+os.environ.setdefault("DISCORD_TOKEN", "benchmark")
+os.environ.setdefault("REPLICATE_API_TOKEN", "benchmark")
+os.environ.setdefault("ACTIVE_CHANNEL_ID", "0")
+os.environ.setdefault("TEMP_PATH", tempfile.gettempdir() + "/")
+
+import config  # noqa: E402
+import player_store  # noqa: E402
+
+
+# One move = read the player's state, then write the new state
+def naive_moves(db_path, players, moves):
+    with sqlite3.connect(db_path) as conn:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS player_state "
+            "(player_id TEXT PRIMARY KEY, glif_id TEXT, timestamp REAL, game_state TEXT)"
+        )
+    for i in range(moves):
+        player_id = f"player{i % players}"
+        with sqlite3.connect(db_path) as conn:
+            conn.execute(
+                "SELECT glif_id, timestamp, game_state FROM player_state WHERE player_id = ?",
+                (player_id,),
+            ).fetchone()
+        with sqlite3.connect(db_path) as conn:
+            conn.execute(
+                "INSERT INTO player_state VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(player_id) DO UPDATE SET game_state = excluded.game_state",
+                (player_id, "glif", time.time(), f"{i} COAL"),
+            )
+        with sqlite3.connect(db_path) as conn:
+            conn.execute(
+                "SELECT glif_id, timestamp, game_state FROM player_state WHERE player_id = ?",
+                (player_id,),
+            ).fetchone()
+
+
+async def store_moves(players, moves):
+    for i in range(moves):
+        player_id = f"player{i % players}"
+        await player_store.get_player_state(player_id)
+        await player_store.update_player_state(player_id, "glif", time.time(), f"{i} COAL")
+    await player_store.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--players", type=int, default=50)
+    parser.add_argument("--moves", type=int, default=5000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        start = time.perf_counter()
+        naive_moves(os.path.join(tmp_dir, "naive.sqlite3"), args.players, args.moves)
+        naive_s = time.perf_counter() - start
+
+        config.db_path = os.path.join(tmp_dir, "store.sqlite3")
+        start = time.perf_counter()
+        asyncio.run(store_moves(args.players, args.moves))
+        store_s = time.perf_counter() - start
+        asyncio.run(player_store.close())
+
+    print(f"connect per call: {args.moves / naive_s:10.0f} moves/s")
+    print(f"player_store:     {args.moves / store_s:10.0f} moves/s")
+    print(f"stats: {player_store.stats}")
+
+
+if __name__ == "__main__":
+    main()
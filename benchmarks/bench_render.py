@@ -0,0 +1,89 @@
+"""
+Render benchmark for the encoding profiles: renders the test_files/ image and
+music through generate_video once per profile and reports wall time, ffmpeg
+CPU seconds and output size. Needs ffmpeg on the PATH.
+
+Usage: python benchmarks/bench_render.py [--profiles default,fast] [--duration 8]
+"""
+import argparse
+import asyncio
+import os
+import resource
+import sys
+import tempfile
+import time
+
+REPO_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, REPO_PATH)
+
+# config.py insists on these, the benchmark doesn't use them
+os.environ.setdefault("DISCORD_TOKEN", "benchmark")
+os.environ.setdefault("REPLICATE_API_TOKEN", "benchmark")
+os.environ.setdefault("ACTIVE_CHANNEL_ID", "0")
+os.environ.setdefault("TEMP_PATH", tempfile.gettempdir() + "/")
+
+import encoding_profiles  # noqa: E402
+from video_generation import generate_video  # noqa: E402
+
+TEST_IMAGE = os.path.join(REPO_PATH, "test_files", "wanderingstan_1175179192011333713_img.jpg")
+TEST_MUSIC = os.path.join(REPO_PATH, "test_files", "wanderingstan_1175179192011333713_music.wav")
+
+
+def children_cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+async def render(profile_name: str, out_dir: str, duration: float) -> dict:
+    profile = dict(encoding_profiles.PROFILES[profile_name], name=profile_name)
+    cpu_before = children_cpu_seconds()
+    start = time.perf_counter()
+    video_path = await generate_video(
+        TEST_IMAGE,
+        None,
+        os.path.join(out_dir, f"{profile_name}_"),
+        duration=duration,
+        profile=profile,
+    )
+    return {
+        "profile": profile_name,
+        "wall_s": time.perf_counter() - start,
+        "cpu_s": children_cpu_seconds() - cpu_before,
+        "size_kb": os.path.getsize(video_path) / 1024,
+    }
+
+
+async def render_with_audio(profile_name: str, out_dir: str) -> dict:
+    profile = dict(encoding_profiles.PROFILES[profile_name], name=profile_name)
+    cpu_before = children_cpu_seconds()
+    start = time.perf_counter()
+    video_path = await generate_video(
+        TEST_IMAGE, TEST_MUSIC, os.path.join(out_dir, f"{profile_name}_audio_"), profile=profile
+    )
+    return {
+        "profile": profile_name + " +audio",
+        "wall_s": time.perf_counter() - start,
+        "cpu_s": children_cpu_seconds() - cpu_before,
+        "size_kb": os.path.getsize(video_path) / 1024,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--profiles", default=",".join(encoding_profiles.PROFILES))
+    parser.add_argument("--duration", type=float, default=8)
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as out_dir:
+        for profile_name in args.profiles.split(","):
+            results.append(await render(profile_name, out_dir, args.duration))
+            results.append(await render_with_audio(profile_name, out_dir))
+
+    print(f"{'profile':<20} {'wall s':>8} {'cpu s':>8} {'size KB':>10}")
+    for r in results:
+        print(f"{r['profile']:<20} {r['wall_s']:>8.2f} {r['cpu_s']:>8.2f} {r['size_kb']:>10.0f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
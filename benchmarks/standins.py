@@ -0,0 +1,189 @@
+"""
+Local stand-ins for the services the bot calls, for benchmarks: the Glif
+simple API, the Replicate predictions API and the CDN the generated images
+and music are downloaded from. They answer like the real thing after a
+configurable latency, and fail a configurable fraction of requests.
+
+Everything is served from one port in a background thread with its own event
+loop, so the stand-ins don't compete with the bot for its loop:
+
+    standins = StandIns(glif_latency_s=2, replicate_latency_s=5)
+    standins.start()
+    os.environ["GLIF_API_URL"] = standins.glif_url
+    os.environ["REPLICATE_API_BASE"] = standins.replicate_url
+"""
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from aiohttp import web
+
+REPO_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+TEST_IMAGE = os.path.join(REPO_PATH, "test_files", "wanderingstan_1175179192011333713_img.jpg")
+TEST_MUSIC = os.path.join(REPO_PATH, "test_files", "wanderingstan_1175179192011333713_music.wav")
+
+
+class StandIns:
+    def __init__(
+        self,
+        glif_latency_s: float = 2.0,
+        replicate_latency_s: float = 5.0,
+        cdn_latency_s: float = 0.1,
+        failure_rate: float = 0.0,
+        jitter: float = 0.3,
+        unique_assets: bool = True,
+    ):
+        """
+        :param glif_latency_s: Median time of a glif run. The story glif takes
+            4 times as long, as it makes 4 images.
+        :param jitter: Spread of the latencies; each one is the given median
+            times a log-normal factor with this sigma, so there is a tail.
+        :param unique_assets: Give every generated image and track its own URL
+            (like the real services), or reuse a few so the asset cache hits.
+        """
+        self.glif_latency_s = glif_latency_s
+        self.replicate_latency_s = replicate_latency_s
+        self.cdn_latency_s = cdn_latency_s
+        self.failure_rate = failure_rate
+        self.jitter = jitter
+        self.unique_assets = unique_assets
+        self.stats = {"glif": 0, "predictions": 0, "polls": 0, "cdn": 0, "failures": 0}
+        self._predictions = {}
+        self._loop = None
+        self._runner = None
+        self._thread = None
+        self.base_url = None
+
+    @property
+    def glif_url(self) -> str:
+        return f"{self.base_url}/glif"
+
+    @property
+    def replicate_url(self) -> str:
+        return f"{self.base_url}/replicate/v1"
+
+    def _latency(self, median_s: float) -> float:
+        return median_s * random.lognormvariate(0, self.jitter) if median_s else 0
+
+    def _fails(self) -> bool:
+        if random.random() < self.failure_rate:
+            self.stats["failures"] += 1
+            return True
+        return False
+
+    def _asset_url(self, kind: str, extension: str) -> str:
+        name = uuid.uuid4().hex if self.unique_assets else str(random.randrange(4))
+        return f"{self.base_url}/cdn/{kind}/{name}.{extension}"
+
+    async def _glif(self, request):
+        self.stats["glif"] += 1
+        payload = await request.json()
+        inputs = payload.get("input")
+        latency_s = self._latency(self.glif_latency_s)
+        if isinstance(inputs, dict) and "imagestyle" in inputs:
+            # The story glif makes its 4 images one after another
+            latency_s *= 4
+        await asyncio.sleep(latency_s)
+        if self._fails():
+            return web.Response(status=503, text="stand-in failure")
+
+        if isinstance(inputs, list):
+            # image glif
+            output = self._asset_url("img", "jpg")
+        elif "action" in inputs:
+            # chattorio glif
+            output = json.dumps(
+                {
+                    "narrator": f"You {inputs['action']}.",
+                    "state": {
+                        "reasoning": "Stand-in reasoning.",
+                        "updated_state": inputs["stateinput"].strip() + "\n1 COAL",
+                    },
+                }
+            )
+        elif "scenes" in inputs:
+            # story text glif
+            output = json.dumps(
+                {f"part{i}": f"Part {i} of the story." for i in range(1, int(inputs["scenes"]) + 1)}
+            )
+        else:
+            # story glif
+            story = {f"part{i}": f"Part {i} of the story." for i in range(1, 5)}
+            story.update({f"image{i}": self._asset_url("img", "jpg") for i in range(1, 5)})
+            output = json.dumps(story)
+        return web.json_response({"id": payload.get("id"), "output": output})
+
+    def _prediction(self, prediction_id: str) -> dict:
+        prediction = self._predictions[prediction_id]
+        if prediction["status"] == "processing" and time.monotonic() >= prediction["done_at"]:
+            if prediction.pop("fails"):
+                prediction.update(status="failed", error="stand-in failure")
+            else:
+                prediction.update(status="succeeded", output=self._asset_url("audio", "wav"))
+        return {k: v for k, v in prediction.items() if k != "done_at"}
+
+    async def _create_prediction(self, request):
+        self.stats["predictions"] += 1
+        await request.json()
+        prediction_id = uuid.uuid4().hex
+        self._predictions[prediction_id] = {
+            "id": prediction_id,
+            "status": "processing",
+            "done_at": time.monotonic() + self._latency(self.replicate_latency_s),
+            "fails": self._fails(),
+        }
+        return web.json_response(self._prediction(prediction_id), status=201)
+
+    async def _get_prediction(self, request):
+        self.stats["polls"] += 1
+        prediction_id = request.match_info["id"]
+        if prediction_id not in self._predictions:
+            return web.Response(status=404)
+        return web.json_response(self._prediction(prediction_id))
+
+    async def _cancel_prediction(self, request):
+        prediction = self._predictions.get(request.match_info["id"])
+        if prediction is None:
+            return web.Response(status=404)
+        if prediction["status"] == "processing":
+            prediction["status"] = "canceled"
+        return web.json_response(self._prediction(prediction["id"]))
+
+    async def _cdn(self, request):
+        self.stats["cdn"] += 1
+        await asyncio.sleep(self._latency(self.cdn_latency_s))
+        if request.match_info["kind"] == "img":
+            return web.FileResponse(TEST_IMAGE)
+        return web.FileResponse(TEST_MUSIC)
+
+    async def _serve(self, started: threading.Event):
+        app = web.Application()
+        app.router.add_post("/glif", self._glif)
+        app.router.add_post("/replicate/v1/predictions", self._create_prediction)
+        app.router.add_get("/replicate/v1/predictions/{id}", self._get_prediction)
+        app.router.add_post("/replicate/v1/predictions/{id}/cancel", self._cancel_prediction)
+        app.router.add_get("/cdn/{kind}/{name}", self._cdn)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://127.0.0.1:{port}"
+        started.set()
+
+    def start(self):
+        started = threading.Event()
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._serve(started), self._loop)
+        started.wait()
+
+    def stop(self):
+        if self._runner is not None:
+            asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
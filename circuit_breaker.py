@@ -0,0 +1,121 @@
+import asyncio
+import logging
+import time
+from collections import deque
+import config
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+
+# Circuit breakers for the upstream APIs, so that an outage doesn't pile every
+# new command onto a dependency that is failing anyway. Each breaker watches
+# the outcomes of its calls over the last BREAKER_WINDOW_S seconds; a call
+# fails if it raises or takes longer than the breaker's slow_call_s. Once at
+# least BREAKER_MIN_CALLS calls have been seen and BREAKER_FAILURE_RATE of
+# them failed, the breaker opens and calls fail fast with CircuitOpenError,
+# which callers turn into a degraded result. After BREAKER_OPEN_S one trial
+# call is let through: if it succeeds the breaker closes, else it stays open.
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# State as a number, for /metrics
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+# name -> CircuitBreaker
+breakers = {}
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, slow_call_s: float):
+        self.name = name
+        self.slow_call_s = slow_call_s
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self._trial_running = False
+        # (finish time, failed) of recent calls
+        self._outcomes = deque()
+        self.stats = {"calls": 0, "failures": 0, "rejected": 0, "opened": 0}
+        breakers[name] = self
+
+    def _set_state(self, state: str):
+        if state == self.state:
+            return
+        if state == OPEN:
+            self.opened_at = time.monotonic()
+            self.stats["opened"] += 1
+            logging.warning(f"🔴 Circuit breaker {self.name} opened, using fallbacks for {config.BREAKER_OPEN_S:.0f}s.")
+        elif state == CLOSED:
+            self._outcomes.clear()
+            logging.info(f"🟢 Circuit breaker {self.name} closed.")
+        self.state = state
+
+    def _failure_rate(self, now: float) -> float:
+        while self._outcomes and now - self._outcomes[0][0] > config.BREAKER_WINDOW_S:
+            self._outcomes.popleft()
+        if len(self._outcomes) < config.BREAKER_MIN_CALLS:
+            return 0.0
+        return sum(failed for _, failed in self._outcomes) / len(self._outcomes)
+
+    def _record(self, failed: bool, trial: bool):
+        now = time.monotonic()
+        if failed:
+            self.stats["failures"] += 1
+        if trial:
+            self._trial_running = False
+            self._set_state(OPEN if failed else CLOSED)
+            if failed:
+                # Start a new wait before the next trial
+                self.opened_at = now
+            return
+        self._outcomes.append((now, failed))
+        if self.state == CLOSED and self._failure_rate(now) >= config.BREAKER_FAILURE_RATE:
+            self._set_state(OPEN)
+
+    async def call(self, func):
+        """
+        Returns the result of func(), an async function, or raises
+        CircuitOpenError straight away while the breaker is open.
+        """
+        if not config.BREAKER_ENABLED:
+            return await func()
+
+        trial = False
+        if self.state == OPEN and time.monotonic() - self.opened_at >= config.BREAKER_OPEN_S:
+            self._set_state(HALF_OPEN)
+        if self.state == HALF_OPEN:
+            if self._trial_running:
+                self.stats["rejected"] += 1
+                raise CircuitOpenError(f"{self.name} is unavailable right now, please try again in a minute.")
+            self._trial_running = trial = True
+        elif self.state == OPEN:
+            self.stats["rejected"] += 1
+            raise CircuitOpenError(f"{self.name} is unavailable right now, please try again in a minute.")
+
+        self.stats["calls"] += 1
+        started_at = time.monotonic()
+        try:
+            result = await func()
+        except asyncio.CancelledError:
+            # Says nothing about the upstream
+            if trial:
+                self._trial_running = False
+            raise
+        except Exception:
+            self._record(True, trial)
+            raise
+        self._record(time.monotonic() - started_at > self.slow_call_s, trial)
+        return result
+
+
+# Breaker states for /metrics: name -> 0 closed, 1 half open, 2 open
+def states() -> dict:
+    return {name: STATE_VALUES[breaker.state] for name, breaker in breakers.items()}
@@ -35,3 +35,192 @@ if not os.path.exists(TEMP_PATH):
 
 # path to your SQLite database
 db_path = "chattorio.sqlite3"
+
+
+# Shared HTTP client connection pool
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_CONNECTIONS_PER_HOST = int(os.getenv("HTTP_MAX_CONNECTIONS_PER_HOST", "20"))
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "30"))
+HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", "300"))
+
+
+# ffmpeg scheduling: how many encoders may run at once across all users, and
+# how many threads each one gets. Defaults split the machine's cores evenly.
+CPU_COUNT = os.cpu_count() or 1
+FFMPEG_MAX_JOBS = int(os.getenv("FFMPEG_MAX_JOBS", str(max(1, CPU_COUNT // 2))))
+FFMPEG_THREADS_PER_JOB = int(
+    os.getenv("FFMPEG_THREADS_PER_JOB", str(max(1, CPU_COUNT // FFMPEG_MAX_JOBS)))
+)
+
+
+# Downloaded images and audio are cached under TEMP_PATH/cache up to this size
+ASSET_CACHE_MAX_BYTES = int(os.getenv("ASSET_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+
+# Reuse MusicGen results for repeated prompts and settings
+MUSIC_CACHE_ENABLED = os.getenv("MUSIC_CACHE_ENABLED", "TRUE").upper() == "TRUE"
+MUSIC_CACHE_TTL_S = float(os.getenv("MUSIC_CACHE_TTL_S", "3600"))
+MUSIC_CACHE_MAX_ENTRIES = int(os.getenv("MUSIC_CACHE_MAX_ENTRIES", "256"))
+
+# /image can make up to IMAGE_MAX_VARIANTS versions of an image at once, shown
+# as a grid. At most IMAGE_VARIANT_CONCURRENCY of their Glif runs go out at a
+# time, IMAGE_VARIANT_USER_CONCURRENCY of them for any one user.
+IMAGE_MAX_VARIANTS = int(os.getenv("IMAGE_MAX_VARIANTS", "4"))
+IMAGE_VARIANT_CONCURRENCY = int(os.getenv("IMAGE_VARIANT_CONCURRENCY", "8"))
+IMAGE_VARIANT_USER_CONCURRENCY = int(os.getenv("IMAGE_VARIANT_USER_CONCURRENCY", "4"))
+
+# Share one in-flight image_glif, story_glif or MusicGen call between
+# requests for the same prompt (and settings) that arrive while it runs
+SINGLE_FLIGHT_ENABLED = os.getenv("SINGLE_FLIGHT_ENABLED", "TRUE").upper() == "TRUE"
+
+# Music longer than MUSIC_CHUNK_S seconds is generated as parallel chunks of
+# about that length, overlapping by MUSIC_CHUNK_OVERLAP_S for the crossfade
+# (0 turns chunking off)
+MUSIC_CHUNK_S = float(os.getenv("MUSIC_CHUNK_S", "15"))
+MUSIC_CHUNK_OVERLAP_S = float(os.getenv("MUSIC_CHUNK_OVERLAP_S", "2"))
+
+# /film2 scenes. With STORY_TEXT_GLIF_ID set to a glif that only writes the
+# story (returning "part1".."partN" for inputs "prompt" and "scenes"), each
+# scene's image is made by its own image glif run, all at once, and films can
+# have up to FILM_MAX_SCENES scenes. Without it the story glif makes 4 images
+# one after another.
+STORY_TEXT_GLIF_ID = os.getenv("STORY_TEXT_GLIF_ID", "")
+FILM_SCENE_COUNT = int(os.getenv("FILM_SCENE_COUNT", "4"))
+FILM_MAX_SCENES = int(os.getenv("FILM_MAX_SCENES", "8"))
+# Render /film2 in one ffmpeg run once the music is ready, instead of one clip
+# per scene while MusicGen works
+FILM_SINGLE_PASS = os.getenv("FILM_SINGLE_PASS", "FALSE").upper() == "TRUE"
+
+
+# Streaming downloads: bytes buffered per disk write, and how many times an
+# interrupted transfer is resumed before giving up
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("DOWNLOAD_CHUNK_SIZE", str(1024 * 1024)))
+DOWNLOAD_MAX_ATTEMPTS = int(os.getenv("DOWNLOAD_MAX_ATTEMPTS", "3"))
+
+
+# Pipe downloaded images and audio straight into ffmpeg and upload results from
+# memory instead of going through TEMP_PATH (useful on small or slow disks)
+IN_MEMORY_PIPELINE = os.getenv("IN_MEMORY_PIPELINE", "FALSE").upper() == "TRUE"
+
+
+# How many jobs of each command may run at once, and how many jobs may wait in
+# total before new ones are turned away. JOB_LIMITS looks like "film2=2,video=3".
+JOB_DEFAULT_LIMIT = int(os.getenv("JOB_DEFAULT_LIMIT", "4"))
+JOB_LIMITS = {
+    "music": 4,
+    "image": 8,
+    "video": 3,
+    "film": 2,
+    "film2": 2,
+    "chattorio": 8,
+}
+for _limit in filter(None, os.getenv("JOB_LIMITS", "").split(",")):
+    _kind, _value = _limit.split("=")
+    JOB_LIMITS[_kind.strip()] = int(_value)
+JOB_MAX_QUEUE_DEPTH = int(os.getenv("JOB_MAX_QUEUE_DEPTH", "20"))
+
+
+# Chattorio player store: how many players to keep cached in memory, and how
+# writes are batched into commits
+PLAYER_CACHE_MAX_ENTRIES = int(os.getenv("PLAYER_CACHE_MAX_ENTRIES", "1000"))
+PLAYER_STORE_BATCH_SIZE = int(os.getenv("PLAYER_STORE_BATCH_SIZE", "20"))
+PLAYER_STORE_COMMIT_DELAY_S = float(os.getenv("PLAYER_STORE_COMMIT_DELAY_S", "0.5"))
+
+
+# Chattorio: forget a player's lock after this many idle seconds, and whether
+# actions sent while the player's previous move is running get merged into one
+CHATTORIO_LOCK_IDLE_S = float(os.getenv("CHATTORIO_LOCK_IDLE_S", "600"))
+CHATTORIO_MERGE_MOVES = os.getenv("CHATTORIO_MERGE_MOVES", "FALSE").upper() == "TRUE"
+
+
+# Glif simple API endpoint, e.g. to point at a local stand-in
+GLIF_API_URL = os.getenv("GLIF_API_URL", "https://simple-api.glif.app")
+
+# Glif calls of one command must finish within GLIF_DEADLINE_S of it starting.
+# A request slower than the glif's GLIF_HEDGE_PERCENTILE latency gets a
+# hedged duplicate, once there are enough samples of that glif's latency.
+# Requests time out after GLIF_TIMEOUT_FACTOR times the glif's p99, but no
+# sooner than GLIF_TIMEOUT_MIN_S. 429s, 5xx errors and timeouts are retried up
+# to GLIF_MAX_ATTEMPTS times with jittered exponential backoff.
+GLIF_DEADLINE_S = float(os.getenv("GLIF_DEADLINE_S", "180"))
+GLIF_HEDGE_ENABLED = os.getenv("GLIF_HEDGE_ENABLED", "TRUE").upper() == "TRUE"
+GLIF_HEDGE_PERCENTILE = float(os.getenv("GLIF_HEDGE_PERCENTILE", "95"))
+GLIF_TIMEOUT_FACTOR = float(os.getenv("GLIF_TIMEOUT_FACTOR", "3"))
+GLIF_TIMEOUT_MIN_S = float(os.getenv("GLIF_TIMEOUT_MIN_S", "30"))
+GLIF_MAX_ATTEMPTS = int(os.getenv("GLIF_MAX_ATTEMPTS", "3"))
+GLIF_RETRY_BASE_S = float(os.getenv("GLIF_RETRY_BASE_S", "1"))
+GLIF_RETRY_MAX_S = float(os.getenv("GLIF_RETRY_MAX_S", "10"))
+
+
+# Circuit breakers for the Glif glifs and MusicGen, see circuit_breaker.py.
+# A call fails if it errors or takes longer than BREAKER_SLOW_GLIF_S /
+# BREAKER_SLOW_MUSIC_S. While a breaker is open, images fall back to
+# DEFAULT_IMAGE_URL and music to a recent cached track or DEFAULT_MUSIC_PATH.
+BREAKER_ENABLED = os.getenv("BREAKER_ENABLED", "TRUE").upper() == "TRUE"
+BREAKER_WINDOW_S = float(os.getenv("BREAKER_WINDOW_S", "120"))
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", "5"))
+BREAKER_FAILURE_RATE = float(os.getenv("BREAKER_FAILURE_RATE", "0.5"))
+BREAKER_OPEN_S = float(os.getenv("BREAKER_OPEN_S", "60"))
+BREAKER_SLOW_GLIF_S = float(os.getenv("BREAKER_SLOW_GLIF_S", "90"))
+BREAKER_SLOW_MUSIC_S = float(os.getenv("BREAKER_SLOW_MUSIC_S", "180"))
+DEFAULT_IMAGE_URL = os.getenv(
+    "DEFAULT_IMAGE_URL",
+    "https://glif.app/_next/image?url=https%3A%2F%2Fres.cloudinary.com%2Fdzkwltgyd%2Fimage%2Fupload%2Fv1699551574%2Fglif-run-outputs%2Fs6s7h7fypr9pr35bpxul.png&w=2048&q=75&dpl=dpl_J7MPoF6chivDp2KiVJA6mJ9faKu1",
+)
+DEFAULT_MUSIC_PATH = os.getenv(
+    "DEFAULT_MUSIC_PATH", "test_files/wanderingstan_1175179192011333713_music.wav"
+)
+
+
+# Replicate predictions API. Polling starts at REPLICATE_POLL_INITIAL_S and
+# backs off up to REPLICATE_POLL_MAX_S. Set REPLICATE_WEBHOOK_URL to the public
+# URL of this bot's /replicate-webhook endpoint to be told when predictions finish.
+# The webhook only wakes the poller; bind it to REPLICATE_WEBHOOK_HOST (all
+# interfaces by default), e.g. 127.0.0.1 behind a reverse proxy.
+REPLICATE_API_BASE = os.getenv("REPLICATE_API_BASE", "https://api.replicate.com/v1")
+REPLICATE_POLL_INITIAL_S = float(os.getenv("REPLICATE_POLL_INITIAL_S", "0.5"))
+REPLICATE_POLL_MAX_S = float(os.getenv("REPLICATE_POLL_MAX_S", "5"))
+REPLICATE_POLL_BACKOFF = float(os.getenv("REPLICATE_POLL_BACKOFF", "1.5"))
+REPLICATE_WEBHOOK_URL = os.getenv("REPLICATE_WEBHOOK_URL", "")
+REPLICATE_WEBHOOK_PORT = int(os.getenv("REPLICATE_WEBHOOK_PORT", "8081"))
+REPLICATE_WEBHOOK_HOST = os.getenv("REPLICATE_WEBHOOK_HOST") or None
+
+
+# Encoding profile used when a command doesn't pick one (see encoding_profiles.py),
+# and how many queued ffmpeg jobs make renders step down to a faster profile
+ENCODING_PROFILE = os.getenv("ENCODING_PROFILE", "default")
+ENCODING_FALLBACK_QUEUE_DEPTH = int(
+    os.getenv("ENCODING_FALLBACK_QUEUE_DEPTH", str(2 * FFMPEG_MAX_JOBS))
+)
+
+# How /video and friends render the slow zoom: ffmpeg's "zoompan" filter or
+# "numpy" frames piped into ffmpeg (see kenburns.py)
+ZOOM_RENDERER = os.getenv("ZOOM_RENDERER", "zoompan")
+
+
+# Serve Prometheus metrics on this port at /metrics (0 turns it off), and
+# whether to post each command's per-stage timing breakdown in the channel
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+TRACE_IN_REPLY = os.getenv("TRACE_IN_REPLY", "FALSE").upper() == "TRUE"
+
+
+# Upload size limit: renders are capped to fit the smaller of the guild's
+# limit and UPLOAD_LIMIT_BYTES (Discord's limit for servers without boosts).
+# TARGET_SIZE_MARGIN leaves room for the container, and videos that would
+# need less than TARGET_SIZE_MIN_VIDEO_KBPS to fit get that anyway.
+TARGET_SIZE_ENCODING = os.getenv("TARGET_SIZE_ENCODING", "TRUE").upper() == "TRUE"
+UPLOAD_LIMIT_BYTES = int(os.getenv("UPLOAD_LIMIT_BYTES", str(10 * 1024 * 1024)))
+TARGET_SIZE_MARGIN = float(os.getenv("TARGET_SIZE_MARGIN", "0.95"))
+TARGET_SIZE_MIN_VIDEO_KBPS = int(os.getenv("TARGET_SIZE_MIN_VIDEO_KBPS", "150"))
+
+
+# Each command's files go in its own directory under WORKSPACE_PATH (which
+# can be a tmpfs, e.g. /dev/shm/gamebot/), deleted when the command is done
+# unless KEEP_WORKSPACES is set. Every JANITOR_INTERVAL_S the janitor deletes
+# leftovers in TEMP_PATH and WORKSPACE_PATH older than TEMP_MAX_AGE_S, then
+# the oldest until they are under TEMP_MAX_BYTES.
+WORKSPACE_PATH = os.getenv("WORKSPACE_PATH", os.path.join(TEMP_PATH, "jobs"))
+KEEP_WORKSPACES = os.getenv("KEEP_WORKSPACES", "FALSE").upper() == "TRUE"
+JANITOR_INTERVAL_S = float(os.getenv("JANITOR_INTERVAL_S", "300"))
+TEMP_MAX_AGE_S = float(os.getenv("TEMP_MAX_AGE_S", str(6 * 3600)))
+TEMP_MAX_BYTES = int(os.getenv("TEMP_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
@@ -0,0 +1,119 @@
+import logging
+import config
+import ffmpeg_pool
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+
+# Named ffmpeg encoding profiles, trading quality for render speed.
+# "default" matches what the bot always rendered: 1024x1024 at zoompan's
+# 25 fps, libx264's default preset and CRF, 192k AAC. threads=None means
+# "whatever the ffmpeg scheduler hands out per job". Under load a profile
+# steps down to its "fallback".
+PROFILES = {
+    "quality": {
+        "preset": "slow",
+        "crf": 20,
+        "size": 1024,
+        "fps": 25,
+        "threads": None,
+        "audio_bitrate": "192k",
+        "fallback": "default",
+    },
+    "default": {
+        "preset": "medium",
+        "crf": 23,
+        "size": 1024,
+        "fps": 25,
+        "threads": None,
+        "audio_bitrate": "192k",
+        "fallback": "fast",
+    },
+    "fast": {
+        "preset": "veryfast",
+        "crf": 26,
+        "size": 768,
+        "fps": 20,
+        "threads": None,
+        "audio_bitrate": "128k",
+        "fallback": "fastest",
+    },
+    "fastest": {
+        "preset": "ultrafast",
+        "crf": 30,
+        "size": 512,
+        "fps": 15,
+        "threads": None,
+        "audio_bitrate": "96k",
+        "fallback": None,
+    },
+}
+
+
+# Pick the profile for a render: the requested one (or ENCODING_PROFILE),
+# stepped down one fallback for every ENCODING_FALLBACK_QUEUE_DEPTH ffmpeg
+# jobs already waiting or running.
+def choose(name: str = None) -> dict:
+    name = name or config.ENCODING_PROFILE
+    if name not in PROFILES:
+        raise ValueError(f"Unknown encoding profile {name}, expected one of {list(PROFILES)}.")
+
+    queue_depth = ffmpeg_pool.queue_depth()
+    while (
+        queue_depth >= config.ENCODING_FALLBACK_QUEUE_DEPTH
+        and PROFILES[name]["fallback"] is not None
+    ):
+        logging.info(
+            f"⚠️ ffmpeg queue depth {queue_depth}, falling back from {name} to {PROFILES[name]['fallback']}."
+        )
+        name = PROFILES[name]["fallback"]
+        queue_depth -= config.ENCODING_FALLBACK_QUEUE_DEPTH
+
+    return dict(PROFILES[name], name=name)
+
+
+# Audio bitrate a profile really produces in kbit/s: ffmpeg's AAC encoder
+# comes out 10-15% over the nominal bitrate
+def audio_kbps(profile: dict) -> float:
+    return int(profile["audio_bitrate"].rstrip("k")) * 1.15
+
+
+# Cap a profile's video bitrate so a video of this length, with its audio,
+# comes out under max_bytes. Encoding stays CRF, so simple videos are as small
+# as ever; the cap only bites when the quality target would overshoot. x264
+# may go over the cap by up to one VBV buffer (one second of video here),
+# which the budget leaves room for.
+def fit_to_size(profile: dict, duration_s: float, max_bytes: int) -> dict:
+    budget_kbits = max_bytes * 8 / 1000 * config.TARGET_SIZE_MARGIN
+    video_kbps = int(budget_kbits / (duration_s + 1) - audio_kbps(profile))
+    if video_kbps < config.TARGET_SIZE_MIN_VIDEO_KBPS:
+        logging.warning(
+            f"⚠️ {duration_s}s won't fit in {max_bytes} bytes, capping at {config.TARGET_SIZE_MIN_VIDEO_KBPS}k."
+        )
+        video_kbps = config.TARGET_SIZE_MIN_VIDEO_KBPS
+    return dict(profile, max_video_kbps=video_kbps)
+
+
+# libx264 video encoding arguments for a profile
+def video_args(profile: dict) -> str:
+    args = (
+        f"-c:v libx264 -preset {profile['preset']} -crf {profile['crf']} "
+        f"-tune stillimage -pix_fmt yuv420p"
+    )
+    if profile.get("max_video_kbps"):
+        kbps = profile["max_video_kbps"]
+        args += f" -maxrate {kbps}k -bufsize {kbps}k"
+    return args
+
+
+# AAC audio encoding arguments for a profile
+def audio_args(profile: dict) -> str:
+    return f"-c:a aac -b:a {profile['audio_bitrate']}"
+
+
+# ffmpeg thread arguments for a profile
+def thread_args(profile: dict) -> str:
+    return ffmpeg_pool.thread_args(profile["threads"])
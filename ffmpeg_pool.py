@@ -0,0 +1,124 @@
+import asyncio
+import contextvars
+import logging
+import time
+import config
+import tracing
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+
+# Every ffmpeg process the bot starts goes through this scheduler, so that the
+# number of encoders running at once (across all users and commands) is capped
+# and each one gets a fair share of the cores instead of all of them.
+MAX_JOBS = config.FFMPEG_MAX_JOBS
+THREADS_PER_JOB = config.FFMPEG_THREADS_PER_JOB
+
+_slots = asyncio.Semaphore(MAX_JOBS)
+_waiting = 0
+_running = 0
+
+# Per-command list of job timings, see track_timings()
+_job_timings = contextvars.ContextVar("ffmpeg_job_timings", default=None)
+
+
+# ffmpeg arguments limiting encoder and filter threads for one job.
+# Goes right before the output file in a command.
+def thread_args(threads: int = None) -> str:
+    threads = threads or THREADS_PER_JOB
+    return f"-threads {threads} -filter_complex_threads {threads}"
+
+
+# Number of jobs waiting for a slot or currently running
+def queue_depth() -> int:
+    return _waiting + _running
+
+
+# Start collecting timings for every ffmpeg job run from the current task
+# (and tasks it spawns). Returns the list that the timings are appended to.
+def track_timings() -> list:
+    timings = []
+    _job_timings.set(timings)
+    return timings
+
+
+# One line per job: label, seconds waiting for a slot, seconds running
+def format_timings(timings: list) -> str:
+    return ", ".join(
+        f"{t['label']}: wait {t['wait_s']:.2f}s run {t['run_s']:.2f}s" for t in timings
+    )
+
+
+async def _feed_safely(feed, stdin):
+    try:
+        await feed(stdin)
+    except (BrokenPipeError, ConnectionResetError):
+        # ffmpeg exited early, its stderr will say why
+        pass
+
+
+# Run an ffmpeg shell command once a slot is free. Returns (stdout, stderr).
+# feed, if given, is a coroutine function that is handed ffmpeg's stdin to
+# stream input into while the command runs; it must close stdin when done.
+async def run(cmd: str, label: str = "ffmpeg", feed=None):
+    global _waiting, _running
+
+    queued_at = time.monotonic()
+    _waiting += 1
+    try:
+        await _slots.acquire()
+    finally:
+        _waiting -= 1
+
+    started_at = time.monotonic()
+    _running += 1
+    try:
+        logging.info(cmd)
+        process = await asyncio.create_subprocess_shell(
+            cmd,
+            stdin=asyncio.subprocess.PIPE if feed is not None else None,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            if feed is not None:
+                _, (stdout, stderr) = await asyncio.gather(
+                    _feed_safely(feed, process.stdin), process.communicate()
+                )
+            else:
+                stdout, stderr = await process.communicate()
+        except asyncio.CancelledError:
+            # Don't leave an orphaned encoder holding the CPU
+            process.kill()
+            await process.wait()
+            raise
+    finally:
+        _running -= 1
+        _slots.release()
+
+    finished_at = time.monotonic()
+    timing = {
+        "label": label,
+        "wait_s": started_at - queued_at,
+        "run_s": finished_at - started_at,
+    }
+    timings = _job_timings.get()
+    if timings is not None:
+        timings.append(timing)
+    tracing.record("ffmpeg_wait", timing["wait_s"], label=label)
+    tracing.record(
+        "ffmpeg", timing["run_s"], "ok" if process.returncode == 0 else "error", label=label
+    )
+    logging.info(
+        f"⏱️ {label}: waited {timing['wait_s']:.2f}s, ran {timing['run_s']:.2f}s"
+    )
+
+    if process.returncode != 0:
+        error_message = f"ffmpeg command failed for {label}:\n{stderr.decode('utf-8', errors='replace')}"
+        logging.error(error_message)
+        raise Exception(error_message)
+
+    return stdout, stderr
@@ -0,0 +1,153 @@
+import asyncio
+import logging
+import time
+import config
+import audio
+import encoding_profiles
+from glif import story_glif, story_text_glif, scene_image_glif
+from music_generation import music_generation
+from video_generation import (
+    generate_video,
+    resolve_image,
+    concatenate_videos_async,
+    assemble_film,
+)
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+
+class TaskGraph:
+    """
+    Tiny dependency-graph executor. Each step is a coroutine function that is
+    called with the results of the steps it depends on, and starts as soon as
+    those are done, so independent branches overlap. If any step fails the
+    remaining steps are cancelled and the error is raised.
+    """
+
+    def __init__(self):
+        self._steps = {}
+
+    def add(self, name: str, func, *deps: str):
+        self._steps[name] = (func, deps)
+
+    async def run(self) -> dict:
+        tasks = {}
+        started_at = time.monotonic()
+
+        async def run_step(name):
+            func, deps = self._steps[name]
+            args = [await tasks[dep] for dep in deps]
+            result = await func(*args)
+            logging.info(f"⏱️ {name} done at {time.monotonic() - started_at:.2f}s")
+            return result
+
+        for name in self._steps:
+            tasks[name] = asyncio.ensure_future(run_step(name))
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            raise
+        return {name: task.result() for name, task in tasks.items()}
+
+
+async def make_film(
+    prompt: str, duration: float, run_path: str, scene_count: int = 4, profile: dict = None
+) -> str:
+    """
+    Generates a film: story images -> one silent clip per scene -> concatenated
+    with the soundtrack. Scene clips render while MusicGen is still working,
+    and the audio is only needed for the final mux, so the whole thing takes
+    about max(story + render, music) rather than the sum.
+
+    With STORY_TEXT_GLIF_ID set, the story text comes first and then every
+    scene's image is made at the same time, each scene rendering as soon as
+    its own image is in, so images take max(scene) rather than sum(scene).
+    Otherwise the story glif makes all images, and there are always 4 scenes.
+
+    With FILM_SINGLE_PASS the scene images are only downloaded while MusicGen
+    works, and the film is rendered afterwards by assemble_film in one ffmpeg
+    run, with no per-scene clips: less work in total, but the render no
+    longer overlaps the music.
+
+    :return: Path to the film.
+    """
+    profile = profile or encoding_profiles.choose()
+    split_story = bool(config.STORY_TEXT_GLIF_ID)
+    if not split_story and scene_count != 4:
+        logging.warning(f"⚠️ The story glif makes 4 scenes, not {scene_count}.")
+        scene_count = 4
+    scene_duration_s = duration / scene_count
+    graph = TaskGraph()
+
+    if split_story:
+        graph.add("story", lambda: story_text_glif(prompt, scene_count))
+    else:
+        graph.add("story", lambda: story_glif(prompt))
+    graph.add(
+        "music",
+        lambda: music_generation(
+            config.REPLICATE_API_TOKEN, prompt, filename_prefix=run_path, duration=duration
+        ),
+    )
+
+    def scene_image(i):
+        async def make_image(parts):
+            return await scene_image_glif(prompt, parts[i])
+
+        return make_image
+
+    def render_scene(i):
+        async def render(image):
+            # The scene's own image, or all of the story glif's images
+            image_url = image if split_story else image[i]
+            if config.FILM_SINGLE_PASS:
+                return await resolve_image(image_url, f"{run_path}{i + 1}_img.jpg")
+            return await generate_video(
+                image_url,
+                None,
+                f"{run_path}{i + 1}_",
+                duration=scene_duration_s,
+                profile=profile,
+            )
+
+        return render
+
+    scene_names = [f"scene{i + 1}" for i in range(scene_count)]
+    for i, name in enumerate(scene_names):
+        if split_story:
+            graph.add(f"image{i + 1}", scene_image(i), "story")
+            graph.add(name, render_scene(i), f"image{i + 1}")
+        else:
+            graph.add(name, render_scene(i), "story")
+
+    async def mux(music_path, *scene_paths):
+        # MusicGen's track is rarely exactly the film's length, fit it here
+        if music_path.endswith(".wav"):
+            music_path = await asyncio.to_thread(
+                audio.trim, music_path, run_path + "soundtrack.wav", duration
+            )
+        if config.FILM_SINGLE_PASS:
+            scenes = [
+                {"image": image_path, "duration": scene_duration_s}
+                for image_path in scene_paths
+            ]
+            return await assemble_film(
+                scenes, music_path, run_path + "concat.mp4", profile=profile
+            )
+        return await concatenate_videos_async(
+            list(scene_paths),
+            run_path + "concat.mp4",
+            audio_file=music_path,
+            profile=profile,
+            duration=duration,
+        )
+
+    graph.add("film", mux, "music", *scene_names)
+
+    results = await graph.run()
+    return results["film"]
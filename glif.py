@@ -1,56 +1,85 @@
-import aiohttp
 import logging
 import json
 import config
 import time
-import sqlite3
+import asyncio
+import glif_client
+import player_store
+import tracing
+from keyed_locks import KeyedLocks
+from single_flight import SingleFlight, normalize
+from circuit_breaker import CircuitBreaker, CircuitOpenError
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 
 
-
-
-# Initialize and create table if it doesn't exist
-def init_db():
-    with sqlite3.connect(config.db_path) as conn:
-        conn.execute('''
-            CREATE TABLE IF NOT EXISTS player_state (
-                player_id TEXT PRIMARY KEY,
-                glif_id TEXT,
-                timestamp REAL,
-                game_state TEXT
-            )
-        ''')
-
-
-# Function to get player state
-def get_player_state(player_id):
-    with sqlite3.connect(config.db_path) as conn:
-        cursor = conn.execute('SELECT glif_id, timestamp, game_state FROM player_state WHERE player_id = ?', (player_id,))
-        row = cursor.fetchone()
-        if row:
-            return {"glif_id": row[0], "timestamp": row[1], "game_state": row[2]}
-        return None
-
-# Function to update player state
-def update_player_state(player_id, glif_id, timestamp, game_state):
-    with sqlite3.connect(config.db_path) as conn:
-        conn.execute('''
-            INSERT INTO player_state (player_id, glif_id, timestamp, game_state)
-            VALUES (?, ?, ?, ?)
-            ON CONFLICT(player_id) 
-            DO UPDATE SET
-                glif_id = excluded.glif_id,
-                timestamp = excluded.timestamp,
-                game_state = excluded.game_state
-        ''', (player_id, glif_id, timestamp, game_state))
-
-
-# ------------------------------------------------------------
-
-# Function to call Glif API, return URL to image
-async def image_glif(input_text: str) -> str:
+# Identical prompts sent while the same Glif call is still running share its
+# result instead of paying for another run
+glif_flights = SingleFlight("Glif")
+
+# While one of the glifs keeps failing or is very slow, its calls fail fast
+# (see circuit_breaker.py) and the image and story glifs fall back to the
+# default image
+image_breaker = CircuitBreaker("glif_image", config.BREAKER_SLOW_GLIF_S)
+story_breaker = CircuitBreaker("glif_story", config.BREAKER_SLOW_GLIF_S)
+chattorio_breaker = CircuitBreaker("glif_chattorio", config.BREAKER_SLOW_GLIF_S)
+story_text_breaker = CircuitBreaker("glif_story_text", config.BREAKER_SLOW_GLIF_S)
+
+
+# Run a glif call behind its breaker, shared with identical calls in flight
+async def _guarded(breaker: CircuitBreaker, key, func):
+    if not config.SINGLE_FLIGHT_ENABLED:
+        return await breaker.call(func)
+    return await glif_flights.run(key, lambda: breaker.call(func))
+
+
+# Function to call Glif API, return URL to image. Calls with different
+# variant numbers are separate runs of the glif, so each gets its own image.
+async def image_glif(input_text: str, variant: int = 0) -> str:
+    try:
+        return await _guarded(
+            image_breaker,
+            ("image", normalize(input_text), variant),
+            lambda: _image_glif(input_text),
+        )
+    except CircuitOpenError:
+        logging.warning("⚠️ Image glif is unavailable, using the default image.")
+        return config.DEFAULT_IMAGE_URL
+
+
+# Glif runs for image variants, at most IMAGE_VARIANT_CONCURRENCY at once and
+# IMAGE_VARIANT_USER_CONCURRENCY per user
+_variant_slots = asyncio.Semaphore(config.IMAGE_VARIANT_CONCURRENCY)
+_user_variant_slots = KeyedLocks(limit=config.IMAGE_VARIANT_USER_CONCURRENCY)
+
+
+async def image_glif_variants(input_text: str, count: int, user_id: str):
+    """
+    Runs the image glif count times for the same prompt, concurrently.
+    Yields (index, URL) as each run finishes, with None for the URL of a run
+    that failed.
+    """
+
+    async def variant(i):
+        async with _user_variant_slots.lock(user_id), _variant_slots:
+            try:
+                return i, await image_glif(input_text, variant=i)
+            except Exception:
+                logging.exception(f"Image variant {i + 1} of {count} failed.")
+                return i, None
+
+    tasks = [asyncio.ensure_future(variant(i)) for i in range(count)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+@tracing.traced("glif", glif="image")
+async def _image_glif(input_text: str) -> str:
     logging.info("🕒 Calling the Glif API.")
     glif_id = "clooa2ge8002sl60ixieiocdp"  # Fabian's game glif
     # glif_id = "clp0liuxc0012la0f09f955rk"
@@ -59,98 +88,202 @@ async def image_glif(input_text: str) -> str:
         # return "https://res.cloudinary.com/dzkwltgyd/image/upload/v1699551574/glif-run-outputs/s6s7h7fypr9pr35bpxul.png"
         return f"./test_files/wanderingstan_1175179192011333713_img.jpg"
 
-    async with aiohttp.ClientSession() as session:
-        payload = {"id": glif_id, "input": [input_text]}
-        headers = {"Content-Type": "application/json"}
+    payload = {"id": glif_id, "input": [input_text]}
 
-        async with session.post(
-            "https://simple-api.glif.app", json=payload, headers=headers
-        ) as response:
-            if response.status == 200:
-                response_data = await response.json()
+    response_data = await glif_client.call(payload)
 
-                logging.info("response_data:")
-                logging.info(response_data)
+    logging.info("response_data:")
+    logging.info(response_data)
 
-                image_url = response_data.get("output", "")
-                logging.info(f"🟢 Glif API responded with URL: {image_url}")
-                return image_url
-            else:
-                error_message = f"Error calling Glif API: {response.status}"
-                logging.error(error_message)
-                raise Exception(error_message)
+    image_url = response_data.get("output", "")
+    logging.info(f"🟢 Glif API responded with URL: {image_url}")
+    return image_url
 
 
 # Function to call Glif API. Returns URLs to 4 images
 async def story_glif(input_text: str) -> str:
+    try:
+        return await _guarded(
+            story_breaker, ("story", normalize(input_text)), lambda: _story_glif(input_text)
+        )
+    except CircuitOpenError:
+        logging.warning("⚠️ Story glif is unavailable, using the default image for every scene.")
+        return (config.DEFAULT_IMAGE_URL,) * 4
+
+
+@tracing.traced("glif", glif="story")
+async def _story_glif(input_text: str) -> str:
     logging.info(f"🕒 Calling story_glif with prompt '{input_text}'.")
     glif_id = "clp0liuxc0012la0f09f955rk"  # Stan's Glif
-    async with aiohttp.ClientSession() as session:
-        payload = {
-            "id": glif_id,
-            "input": {
-                "prompt": input_text,
+    payload = {
+        "id": glif_id,
+        "input": {
+            "prompt": input_text,
+            "imagestyle": "comic book style using 8-bit pixel graphics",
+        },
+    }
+
+    if config.DO_FAKE_RESULTS:
+        # response_data = {'id': 'clp0liuxc0012la0f09f955rk', 'inputs': {'prompt': 'John and mary go mountain biking in the alps', 'imagestyle': 'comic book style using 8-bit pixel graphics'}, 'output': '{\n  "part1" : "John and Mary were adventurous souls who longed for the adrenaline rush of mountain biking in the majestic Alps, where snowy peaks and lush valleys intertwined to create a breathtaking backdrop for their daring escapades. Little did they know that an unexpected obstacle awaited them on their exhilarating journey.",\n  "part2" : "As they pedaled through the treacherous terrain, their bikes gracefully gliding over rocky paths and dusty trails, a sudden storm unleashed its fury upon them, turning their once peaceful ride into a battle against nature\'s wrath. With each passing minute, the wind howled louder, rain poured harder, and visibility dwindled, testing their resilience and challenging their determination to conquer the mountains.",\n  "part3" : "In the midst of the tempest, their path became obscured, leading them towards the edge of a perilous cliff. Panic and fear gripped their hearts as they realized the gravity of the situation, their bikes teetering on the brink of disaster. With no time to spare, their survival instincts kicked in, prompting them to make a split-second decision that would define their fate.",\n  "part4" : "Summoning their courage, John and Mary clung onto each other, embracing the fierce winds, and maneuvered their bikes away from the precipice, narrowly avoiding a catastrophic end. Exhausted but triumphant, they emerged from the storm, strengthened by their shared experience and a deepened bond. With the storm now behind them, they continued their exhilarating journey, etching memories of resilience and adventure into the breathtaking landscape of the Alps.",\n  "image1" : "https://res.cloudinary.com/dzkwltgyd/image/upload/v1700153640/glif-run-outputs/xjsjz6mcgkdfq6dqsrg7.jpg",\n  "image2" : "https://res.cloudinary.com/dzkwltgyd/image/upload/v1700153652/glif-run-outputs/dslwqfsqxfz6mtsbodw0.jpg",\n  "image3" : "https://res.cloudinary.com/dzkwltgyd/image/upload/v1700153665/glif-run-outputs/wl6vbfoyjy6axtvjcttx.jpg",\n  "image4" : "https://res.cloudinary.com/dzkwltgyd/image/upload/v1700153679/glif-run-outputs/ay131vvwnomkum4txidc.jpg"\n}', 'outputFull': {'type': 'TEXT', 'value': '{\n  "part1" : "John and Mary were adventurous souls who longed for the adrenaline rush of mountain biking in the majestic Alps, where snowy peaks and lush valleys intertwined to create a breathtaking backdrop for their daring escapades. Little did they know that an unexpected obstacle awaited them on their exhilarating journey.",\n  "part2" : "As they pedaled through the treacherous terrain, their bikes gracefully gliding over rocky paths and dusty trails, a sudden storm unleashed its fury upon them, turning their once peaceful ride into a battle against nature\'s wrath. With each passing minute, the wind howled louder, rain poured harder, and visibility dwindled, testing their resilience and challenging their determination to conquer the mountains.",\n  "part3" : "In the midst of the tempest, their path became obscured, leading them towards the edge of a perilous cliff. Panic and fear gripped their hearts as they realized the gravity of the situation, their bikes teetering on the brink of disaster. With no time to spare, their survival instincts kicked in, prompting them to make a split-second decision that would define their fate.",\n  "part4" : "Summoning their courage, John and Mary clung onto each other, embracing the fierce winds, and maneuvered their bikes away from the precipice, narrowly avoiding a catastrophic end. Exhausted but triumphant, they emerged from the storm, strengthened by their shared experience and a deepened bond. With the storm now behind them, they continued their exhilarating journey, etching memories of resilience and adventure into the breathtaking landscape of the Alps.",\n  "image1" : "https://res.cloudinary.com/dzkwltgyd/image/upload/v1700153640/glif-run-outputs/xjsjz6mcgkdfq6dqsrg7.jpg",\n  "image2" : "https://res.cloudinary.com/dzkwltgyd/image/upload/v1700153652/glif-run-outputs/dslwqfsqxfz6mtsbodw0.jpg",\n  "image3" : "https://res.cloudinary.com/dzkwltgyd/image/upload/v1700153665/glif-run-outputs/wl6vbfoyjy6axtvjcttx.jpg",\n  "image4" : "https://res.cloudinary.com/dzkwltgyd/image/upload/v1700153679/glif-run-outputs/ay131vvwnomkum4txidc.jpg"\n}'}}
+        response_data = {
+            "id": "clp0liuxc0012la0f09f955rk",
+            "inputs": {
+                "prompt": "Intelligent mouse conquers the world.",
                 "imagestyle": "comic book style using 8-bit pixel graphics",
             },
+            "output": '{\n  "part1" : "In a small, cozy attic lived a highly intelligent mouse named Max, who dreamed of one day conquering the world with his intelligence and wit.",\n  "part2" : "Max embarked on a journey through dark alleys and hidden corners, gathering a group of loyal rodent friends who shared his ambition, as they planned their strategic takeover.",\n  "part3" : "Amidst a grand gathering of world leaders, Max revealed his ingenious invention—a device that could translate mouse squeaks into human language, leaving everyone astounded and eager to understand the secret world of mice.",\n  "part4" : "With the world now aware of the hidden brilliance of mice, Max and his rodent alliance negotiated a compromise that ensured their protection and respect, forever changing the paradigms of power and intelligence.",\n  "image1" : "https://res.cloudinary.com/dzkwltgyd/image/upload/v1700259865/glif-run-outputs/v5pr3f40mfrimunn8xcm.jpg",\n  "image2" : "https://res.cloudinary.com/dzkwltgyd/image/upload/v1700259895/glif-run-outputs/tggirt9wrqerwok7q1mf.jpg",\n  "image3" : "https://res.cloudinary.com/dzkwltgyd/image/upload/v1700259907/glif-run-outputs/w3qiepqh88rshibwdkhj.jpg",\n  "image4" : "https://res.cloudinary.com/dzkwltgyd/image/upload/v1700259922/glif-run-outputs/eb0uqh2beve2xlkujae2.jpg"\n}',
+            "outputFull": {
+                "type": "TEXT",
+                "value": '{\n  "part1" : "In a small, cozy attic lived a highly intelligent mouse named Max, who dreamed of one day conquering the world with his intelligence and wit.",\n  "part2" : "Max embarked on a journey through dark alleys and hidden corners, gathering a group of loyal rodent friends who shared his ambition, as they planned their strategic takeover.",\n  "part3" : "Amidst a grand gathering of world leaders, Max revealed his ingenious invention—a device that could translate mouse squeaks into human language, leaving everyone astounded and eager to understand the secret world of mice.",\n  "part4" : "With the world now aware of the hidden brilliance of mice, Max and his rodent alliance negotiated a compromise that ensured their protection and respect, forever changing the paradigms of power and intelligence.",\n  "image1" : "https://res.cloudinary.com/dzkwltgyd/image/upload/v1700259865/glif-run-outputs/v5pr3f40mfrimunn8xcm.jpg",\n  "image2" : "https://res.cloudinary.com/dzkwltgyd/image/upload/v1700259895/glif-run-outputs/tggirt9wrqerwok7q1mf.jpg",\n  "image3" : "https://res.cloudinary.com/dzkwltgyd/image/upload/v1700259907/glif-run-outputs/w3qiepqh88rshibwdkhj.jpg",\n  "image4" : "https://res.cloudinary.com/dzkwltgyd/image/upload/v1700259922/glif-run-outputs/eb0uqh2beve2xlkujae2.jpg"\n}',
+            },
         }
-        headers = {"Content-Type": "application/json"}
-
-        if config.DO_FAKE_RESULTS:
-            # response_data = {'id': 'clp0liuxc0012la0f09f955rk', 'inputs': {'prompt': 'John and mary go mountain biking in the alps', 'imagestyle': 'comic book style using 8-bit pixel graphics'}, 'output': '{\n  "part1" : "John and Mary were adventurous souls who longed for the adrenaline rush of mountain biking in the majestic Alps, where snowy peaks and lush valleys intertwined to create a breathtaking backdrop for their daring escapades. Little did they know that an unexpected obstacle awaited them on their exhilarating journey.",\n  "part2" : "As they pedaled through the treacherous terrain, their bikes gracefully gliding over rocky paths and dusty trails, a sudden storm unleashed its fury upon them, turning their once peaceful ride into a battle against nature\'s wrath. With each passing minute, the wind howled louder, rain poured harder, and visibility dwindled, testing their resilience and challenging their determination to conquer the mountains.",\n  "part3" : "In the midst of the tempest, their path became obscured, leading them towards the edge of a perilous cliff. Panic and fear gripped their hearts as they realized the gravity of the situation, their bikes teetering on the brink of disaster. With no time to spare, their survival instincts kicked in, prompting them to make a split-second decision that would define their fate.",\n  "part4" : "Summoning their courage, John and Mary clung onto each other, embracing the fierce winds, and maneuvered their bikes away from the precipice, narrowly avoiding a catastrophic end. Exhausted but triumphant, they emerged from the storm, strengthened by their shared experience and a deepened bond. With the storm now behind them, they continued their exhilarating journey, etching memories of resilience and adventure into the breathtaking landscape of the Alps.",\n  "image1" : "https://res.cloudinary.com/dzkwltgyd/image/upload/v1700153640/glif-run-outputs/xjsjz6mcgkdfq6dqsrg7.jpg",\n  "image2" : "https://res.cloudinary.com/dzkwltgyd/image/upload/v1700153652/glif-run-outputs/dslwqfsqxfz6mtsbodw0.jpg",\n  "image3" : "https://res.cloudinary.com/dzkwltgyd/image/upload/v1700153665/glif-run-outputs/wl6vbfoyjy6axtvjcttx.jpg",\n  "image4" : "https://res.cloudinary.com/dzkwltgyd/image/upload/v1700153679/glif-run-outputs/ay131vvwnomkum4txidc.jpg"\n}', 'outputFull': {'type': 'TEXT', 'value': '{\n  "part1" : "John and Mary were adventurous souls who longed for the adrenaline rush of mountain biking in the majestic Alps, where snowy peaks and lush valleys intertwined to create a breathtaking backdrop for their daring escapades. Little did they know that an unexpected obstacle awaited them on their exhilarating journey.",\n  "part2" : "As they pedaled through the treacherous terrain, their bikes gracefully gliding over rocky paths and dusty trails, a sudden storm unleashed its fury upon them, turning their once peaceful ride into a battle against nature\'s wrath. With each passing minute, the wind howled louder, rain poured harder, and visibility dwindled, testing their resilience and challenging their determination to conquer the mountains.",\n  "part3" : "In the midst of the tempest, their path became obscured, leading them towards the edge of a perilous cliff. Panic and fear gripped their hearts as they realized the gravity of the situation, their bikes teetering on the brink of disaster. With no time to spare, their survival instincts kicked in, prompting them to make a split-second decision that would define their fate.",\n  "part4" : "Summoning their courage, John and Mary clung onto each other, embracing the fierce winds, and maneuvered their bikes away from the precipice, narrowly avoiding a catastrophic end. Exhausted but triumphant, they emerged from the storm, strengthened by their shared experience and a deepened bond. With the storm now behind them, they continued their exhilarating journey, etching memories of resilience and adventure into the breathtaking landscape of the Alps.",\n  "image1" : "https://res.cloudinary.com/dzkwltgyd/image/upload/v1700153640/glif-run-outputs/xjsjz6mcgkdfq6dqsrg7.jpg",\n  "image2" : "https://res.cloudinary.com/dzkwltgyd/image/upload/v1700153652/glif-run-outputs/dslwqfsqxfz6mtsbodw0.jpg",\n  "image3" : "https://res.cloudinary.com/dzkwltgyd/image/upload/v1700153665/glif-run-outputs/wl6vbfoyjy6axtvjcttx.jpg",\n  "image4" : "https://res.cloudinary.com/dzkwltgyd/image/upload/v1700153679/glif-run-outputs/ay131vvwnomkum4txidc.jpg"\n}'}}
-            response_data = {
-                "id": "clp0liuxc0012la0f09f955rk",
-                "inputs": {
-                    "prompt": "Intelligent mouse conquers the world.",
-                    "imagestyle": "comic book style using 8-bit pixel graphics",
-                },
-                "output": '{\n  "part1" : "In a small, cozy attic lived a highly intelligent mouse named Max, who dreamed of one day conquering the world with his intelligence and wit.",\n  "part2" : "Max embarked on a journey through dark alleys and hidden corners, gathering a group of loyal rodent friends who shared his ambition, as they planned their strategic takeover.",\n  "part3" : "Amidst a grand gathering of world leaders, Max revealed his ingenious invention—a device that could translate mouse squeaks into human language, leaving everyone astounded and eager to understand the secret world of mice.",\n  "part4" : "With the world now aware of the hidden brilliance of mice, Max and his rodent alliance negotiated a compromise that ensured their protection and respect, forever changing the paradigms of power and intelligence.",\n  "image1" : "https://res.cloudinary.com/dzkwltgyd/image/upload/v1700259865/glif-run-outputs/v5pr3f40mfrimunn8xcm.jpg",\n  "image2" : "https://res.cloudinary.com/dzkwltgyd/image/upload/v1700259895/glif-run-outputs/tggirt9wrqerwok7q1mf.jpg",\n  "image3" : "https://res.cloudinary.com/dzkwltgyd/image/upload/v1700259907/glif-run-outputs/w3qiepqh88rshibwdkhj.jpg",\n  "image4" : "https://res.cloudinary.com/dzkwltgyd/image/upload/v1700259922/glif-run-outputs/eb0uqh2beve2xlkujae2.jpg"\n}',
-                "outputFull": {
-                    "type": "TEXT",
-                    "value": '{\n  "part1" : "In a small, cozy attic lived a highly intelligent mouse named Max, who dreamed of one day conquering the world with his intelligence and wit.",\n  "part2" : "Max embarked on a journey through dark alleys and hidden corners, gathering a group of loyal rodent friends who shared his ambition, as they planned their strategic takeover.",\n  "part3" : "Amidst a grand gathering of world leaders, Max revealed his ingenious invention—a device that could translate mouse squeaks into human language, leaving everyone astounded and eager to understand the secret world of mice.",\n  "part4" : "With the world now aware of the hidden brilliance of mice, Max and his rodent alliance negotiated a compromise that ensured their protection and respect, forever changing the paradigms of power and intelligence.",\n  "image1" : "https://res.cloudinary.com/dzkwltgyd/image/upload/v1700259865/glif-run-outputs/v5pr3f40mfrimunn8xcm.jpg",\n  "image2" : "https://res.cloudinary.com/dzkwltgyd/image/upload/v1700259895/glif-run-outputs/tggirt9wrqerwok7q1mf.jpg",\n  "image3" : "https://res.cloudinary.com/dzkwltgyd/image/upload/v1700259907/glif-run-outputs/w3qiepqh88rshibwdkhj.jpg",\n  "image4" : "https://res.cloudinary.com/dzkwltgyd/image/upload/v1700259922/glif-run-outputs/eb0uqh2beve2xlkujae2.jpg"\n}',
-                },
-            }
-            output = json.loads(response_data.get("output"))
-            image_url_1 = output.get("image1", "")
-            image_url_2 = output.get("image2", "")
-            image_url_3 = output.get("image3", "")
-            image_url_4 = output.get("image4", "")
-
-            logging.info(
-                f"😎 Using faked test response from Glif API responded with URLs: \n{image_url_1}\n{image_url_2}\n{image_url_3}\n{image_url_4}"
-            )
-            return image_url_1, image_url_2, image_url_3, image_url_4
-
-        async with session.post(
-            "https://simple-api.glif.app", json=payload, headers=headers
-        ) as response:
-            if response.status == 200:
-                response_data = await response.json()
-                logging.info("response_data:")
-                logging.info(response_data)
-
-                output = json.loads(response_data.get("output"))
-
-                if output is None:
-                    raise Exception("No output was returned from the model.")
-
-                image_url_1 = output.get("image1", "")
-                image_url_2 = output.get("image2", "")
-                image_url_3 = output.get("image3", "")
-                image_url_4 = output.get("image4", "")
-
-                logging.info(
-                    f"🟢 Glif API responded with URLs: \n{image_url_1}\n{image_url_2}\n{image_url_3}\n{image_url_4}"
-                )
-                return image_url_1, image_url_2, image_url_3, image_url_4
-            else:
-                error_message = f"Error calling Glif API: {response.status}"
-                raise Exception(error_message)
+        output = json.loads(response_data.get("output"))
+        image_url_1 = output.get("image1", "")
+        image_url_2 = output.get("image2", "")
+        image_url_3 = output.get("image3", "")
+        image_url_4 = output.get("image4", "")
+
+        logging.info(
+            f"😎 Using faked test response from Glif API responded with URLs: \n{image_url_1}\n{image_url_2}\n{image_url_3}\n{image_url_4}"
+        )
+        return image_url_1, image_url_2, image_url_3, image_url_4
+
+    response_data = await glif_client.call(payload)
+    logging.info("response_data:")
+    logging.info(response_data)
+
+    output = json.loads(response_data.get("output"))
+
+    if output is None:
+        raise Exception("No output was returned from the model.")
+
+    image_url_1 = output.get("image1", "")
+    image_url_2 = output.get("image2", "")
+    image_url_3 = output.get("image3", "")
+    image_url_4 = output.get("image4", "")
+
+    logging.info(
+        f"🟢 Glif API responded with URLs: \n{image_url_1}\n{image_url_2}\n{image_url_3}\n{image_url_4}"
+    )
+    return image_url_1, image_url_2, image_url_3, image_url_4
+
+
+# Function to call the story text glif (STORY_TEXT_GLIF_ID). Returns the text
+# of each scene, without images, so they can be made at once with
+# scene_image_glif() rather than one after another inside the story glif.
+async def story_text_glif(input_text: str, scene_count: int) -> list:
+    try:
+        return await _guarded(
+            story_text_breaker,
+            ("story_text", normalize(input_text), scene_count),
+            lambda: _story_text_glif(input_text, scene_count),
+        )
+    except CircuitOpenError:
+        logging.warning("⚠️ Story text glif is unavailable, using the prompt for every scene.")
+        return [input_text] * scene_count
+
+
+@tracing.traced("glif", glif="story_text")
+async def _story_text_glif(input_text: str, scene_count: int) -> list:
+    logging.info(f"🕒 Calling story_text_glif with prompt '{input_text}' for {scene_count} scenes.")
+
+    if config.DO_FAKE_RESULTS:
+        return [f"Part {i + 1} of the story of {input_text}." for i in range(scene_count)]
+
+    payload = {
+        "id": config.STORY_TEXT_GLIF_ID,
+        "input": {"prompt": input_text, "scenes": str(scene_count)},
+    }
+    response_data = await glif_client.call(payload)
+    logging.info("response_data:")
+    logging.info(response_data)
+
+    output = response_data.get("output")
+    if not output:
+        raise Exception("No output was returned from the model.")
+    data = json.loads(output.replace("```json\n", "").replace("\n```", ""))
+
+    # Scenes the glif left out just show the prompt
+    parts = [data.get(f"part{i + 1}") or input_text for i in range(scene_count)]
+    logging.info(f"🟢 Glif API responded with {scene_count} parts.")
+    return parts
+
+
+# Image for one scene of a story: the image glif run on the scene's text, with
+# the prompt in front so the scenes stay on topic
+async def scene_image_glif(input_text: str, part: str) -> str:
+    if part == input_text:
+        return await image_glif(input_text)
+    return await image_glif(f"{input_text}. {part}")
+
+
+# Moves for the same player are applied one at a time, in order, so that two
+# quick moves can't both start from the same state and overwrite each other.
+# Different players' moves run in parallel.
+_player_locks = KeyedLocks(idle_ttl_s=config.CHATTORIO_LOCK_IDLE_S)
+
+# player_id -> list of (action, future) waiting to be merged into one move
+_pending_moves = {}
 
 
 # Function to call Glif API. Returns URLs to 4 images
 async def chattorio_glif(
     action_input_text: str, player_id: str, glif_id: str = None, inventory: str = None
 ) -> str:
+    # Moves that change the glif or inventory are never merged with others
+    if not config.CHATTORIO_MERGE_MOVES or glif_id is not None or inventory is not None:
+        async with _player_locks.lock(player_id):
+            return await _chattorio_move(action_input_text, player_id, glif_id, inventory)
+
+    # Actions that pile up while the player's previous move is still running
+    # are sent to the Glif together, and everyone gets the same result
+    future = asyncio.get_running_loop().create_future()
+    _pending_moves.setdefault(player_id, []).append((action_input_text, future))
+
+    try:
+        async with _player_locks.lock(player_id):
+            if not future.done():
+                # Actions whose sender has given up are dropped
+                moves = [
+                    (action, other)
+                    for action, other in _pending_moves.pop(player_id)
+                    if not other.cancelled()
+                ]
+                if len(moves) > 1:
+                    logging.info(f"⚠️ Merging {len(moves)} moves for {player_id}.")
+                try:
+                    result = await _chattorio_move(
+                        "; then ".join(action for action, _ in moves), player_id
+                    )
+                except asyncio.CancelledError:
+                    for _, other in moves:
+                        if other is not future:
+                            other.cancel()
+                    raise
+                except Exception as e:
+                    for _, other in moves:
+                        if other is not future and not other.done():
+                            other.set_exception(e)
+                    raise
+                for _, other in moves:
+                    if other is not future and not other.done():
+                        other.set_result(result)
+                return result
+
+        return await future
+    except asyncio.CancelledError:
+        # Take the action out of a batch that hasn't been sent yet, and don't
+        # leave behind an error that nobody will read
+        if future.done() and not future.cancelled():
+            future.exception()
+        future.cancel()
+        raise
+
+
+@tracing.traced("glif", glif="chattorio")
+async def _chattorio_move(
+    action_input_text: str, player_id: str, glif_id: str = None, inventory: str = None
+):
     logging.info(f"🕒 Calling chattorio_glif with prompt '{action_input_text}'.")
 
     # TODO: move this to config.py
@@ -167,7 +300,7 @@ async def chattorio_glif(
     now = time.time()
 
     # Get existing state
-    start_state = get_player_state(player_id)
+    start_state = await player_store.get_player_state(player_id)
 
     if start_state is None:
         # First time player
@@ -196,66 +329,55 @@ async def chattorio_glif(
         logging.info(f"⚠️ glif_id invalid ({api_glif_id}), using default")
         api_glif_id = default_glif_id
 
-    async with aiohttp.ClientSession() as session:
-        payload = {
-            "id": api_glif_id,
-            "input": {
-                "stateinput": start_state["game_state"],
-                "action": action_input_text,
-                "seconds_elapsed": str(now - start_state["timestamp"]),
-            },
-        }
-        headers = {"Content-Type": "application/json"}
-
-        if config.DO_FAKE_RESULTS:
-            # response_data = {'id': 'clp0liuxc0012la0f09f955rk', 'inputs': {'prompt': 'Intelligent mouse conquers the world.', 'imagestyle': 'comic book style using 8-bit pixel graphics'}, 'output': '{\n  "part1" : "In a small, cozy attic lived a highly intelligent mouse named Max, who dreamed of one day conquering the world with his intelligence and wit.",\n  "part2" : "Max embarked on a journey through dark alleys and hidden corners, gathering a group of loyal rodent friends who shared his ambition, as they planned their strategic takeover.",\n  "part3" : "Amidst a grand gathering of world leaders, Max revealed his ingenious invention—a device that could translate mouse squeaks into human language, leaving everyone astounded and eager to understand the secret world of mice.",\n  "part4" : "With the world now aware of the hidden brilliance of mice, Max and his rodent alliance negotiated a compromise that ensured their protection and respect, forever changing the paradigms of power and intelligence.",\n  "image1" : "https://res.cloudinary.com/dzkwltgyd/image/upload/v1700259865/glif-run-outputs/v5pr3f40mfrimunn8xcm.jpg",\n  "image2" : "https://res.cloudinary.com/dzkwltgyd/image/upload/v1700259895/glif-run-outputs/tggirt9wrqerwok7q1mf.jpg",\n  "image3" : "https://res.cloudinary.com/dzkwltgyd/image/upload/v1700259907/glif-run-outputs/w3qiepqh88rshibwdkhj.jpg",\n  "image4" : "https://res.cloudinary.com/dzkwltgyd/image/upload/v1700259922/glif-run-outputs/eb0uqh2beve2xlkujae2.jpg"\n}', 'outputFull': {'type': 'TEXT', 'value': '{\n  "part1" : "In a small, cozy attic lived a highly intelligent mouse named Max, who dreamed of one day conquering the world with his intelligence and wit.",\n  "part2" : "Max embarked on a journey through dark alleys and hidden corners, gathering a group of loyal rodent friends who shared his ambition, as they planned their strategic takeover.",\n  "part3" : "Amidst a grand gathering of world leaders, Max revealed his ingenious invention—a device that could translate mouse squeaks into human language, leaving everyone astounded and eager to understand the secret world of mice.",\n  "part4" : "With the world now aware of the hidden brilliance of mice, Max and his rodent alliance negotiated a compromise that ensured their protection and respect, forever changing the paradigms of power and intelligence.",\n  "image1" : "https://res.cloudinary.com/dzkwltgyd/image/upload/v1700259865/glif-run-outputs/v5pr3f40mfrimunn8xcm.jpg",\n  "image2" : "https://res.cloudinary.com/dzkwltgyd/image/upload/v1700259895/glif-run-outputs/tggirt9wrqerwok7q1mf.jpg",\n  "image3" : "https://res.cloudinary.com/dzkwltgyd/image/upload/v1700259907/glif-run-outputs/w3qiepqh88rshibwdkhj.jpg",\n  "image4" : "https://res.cloudinary.com/dzkwltgyd/image/upload/v1700259922/glif-run-outputs/eb0uqh2beve2xlkujae2.jpg"\n}'}}
-            # logging.info(f"😎 Using faked test response from Glif API responded with URLs: \n{image_url_1}\n{image_url_2}\n{image_url_3}\n{image_url_4}")
-            # return image_url_1, image_url_2, image_url_3, image_url_4
-            return "NYI"
+    payload = {
+        "id": api_glif_id,
+        "input": {
+            "stateinput": start_state["game_state"],
+            "action": action_input_text,
+            "seconds_elapsed": str(now - start_state["timestamp"]),
+        },
+    }
 
-        logging.info("Payload:")
-        logging.info(payload)
-
-        async with session.post(
-            "https://simple-api.glif.app", json=payload, headers=headers
-        ) as response:
-            if response.status == 200:
-                response_data = await response.json()
-                logging.info("response_data:")
-                logging.info(response_data)
-
-                output = response_data.get("output")
+    if config.DO_FAKE_RESULTS:
+        # response_data = {'id': 'clp0liuxc0012la0f09f955rk', 'inputs': {'prompt': 'Intelligent mouse conquers the world.', 'imagestyle': 'comic book style using 8-bit pixel graphics'}, 'output': '{\n  "part1" : "In a small, cozy attic lived a highly intelligent mouse named Max, who dreamed of one day conquering the world with his intelligence and wit.",\n  "part2" : "Max embarked on a journey through dark alleys and hidden corners, gathering a group of loyal rodent friends who shared his ambition, as they planned their strategic takeover.",\n  "part3" : "Amidst a grand gathering of world leaders, Max revealed his ingenious invention—a device that could translate mouse squeaks into human language, leaving everyone astounded and eager to understand the secret world of mice.",\n  "part4" : "With the world now aware of the hidden brilliance of mice, Max and his rodent alliance negotiated a compromise that ensured their protection and respect, forever changing the paradigms of power and intelligence.",\n  "image1" : "https://res.cloudinary.com/dzkwltgyd/image/upload/v1700259865/glif-run-outputs/v5pr3f40mfrimunn8xcm.jpg",\n  "image2" : "https://res.cloudinary.com/dzkwltgyd/image/upload/v1700259895/glif-run-outputs/tggirt9wrqerwok7q1mf.jpg",\n  "image3" : "https://res.cloudinary.com/dzkwltgyd/image/upload/v1700259907/glif-run-outputs/w3qiepqh88rshibwdkhj.jpg",\n  "image4" : "https://res.cloudinary.com/dzkwltgyd/image/upload/v1700259922/glif-run-outputs/eb0uqh2beve2xlkujae2.jpg"\n}', 'outputFull': {'type': 'TEXT', 'value': '{\n  "part1" : "In a small, cozy attic lived a highly intelligent mouse named Max, who dreamed of one day conquering the world with his intelligence and wit.",\n  "part2" : "Max embarked on a journey through dark alleys and hidden corners, gathering a group of loyal rodent friends who shared his ambition, as they planned their strategic takeover.",\n  "part3" : "Amidst a grand gathering of world leaders, Max revealed his ingenious invention—a device that could translate mouse squeaks into human language, leaving everyone astounded and eager to understand the secret world of mice.",\n  "part4" : "With the world now aware of the hidden brilliance of mice, Max and his rodent alliance negotiated a compromise that ensured their protection and respect, forever changing the paradigms of power and intelligence.",\n  "image1" : "https://res.cloudinary.com/dzkwltgyd/image/upload/v1700259865/glif-run-outputs/v5pr3f40mfrimunn8xcm.jpg",\n  "image2" : "https://res.cloudinary.com/dzkwltgyd/image/upload/v1700259895/glif-run-outputs/tggirt9wrqerwok7q1mf.jpg",\n  "image3" : "https://res.cloudinary.com/dzkwltgyd/image/upload/v1700259907/glif-run-outputs/w3qiepqh88rshibwdkhj.jpg",\n  "image4" : "https://res.cloudinary.com/dzkwltgyd/image/upload/v1700259922/glif-run-outputs/eb0uqh2beve2xlkujae2.jpg"\n}'}}
+        # logging.info(f"😎 Using faked test response from Glif API responded with URLs: \n{image_url_1}\n{image_url_2}\n{image_url_3}\n{image_url_4}")
+        # return image_url_1, image_url_2, image_url_3, image_url_4
+        return "NYI"
 
-                # logging.info(f"🟢 Glif API responded with (raw)")
-                # logging.info(output)
+    logging.info("Payload:")
+    logging.info(payload)
 
-                # Why is LLM adding these prefixes?
-                cleaned_output_str = output.replace("```json\n", "").replace(
-                    "\n```", ""
-                )
-                data = json.loads(cleaned_output_str)
+    # No fallback for a move, it fails fast while the breaker is open
+    response_data = await chattorio_breaker.call(lambda: glif_client.call(payload))
+    logging.info("response_data:")
+    logging.info(response_data)
 
-                if data is None:
-                    raise Exception("No output was returned from the model.")
+    output = response_data.get("output")
 
-                narrator = data["narrator"]
-                reasoning = data["state"]["reasoning"]
-                updated_state = data["state"]["updated_state"]
-                image = data["image"] if "image" in data else None
+    # logging.info(f"🟢 Glif API responded with (raw)")
+    # logging.info(output)
 
-                logging.info(
-                    "🟢 " + "Glif API responded with this json:\n" + json.dumps(data, indent=4)
-                )
+    # Why is LLM adding these prefixes?
+    cleaned_output_str = output.replace("```json\n", "").replace(
+        "\n```", ""
+    )
+    data = json.loads(cleaned_output_str)
 
-                # Save the state
-                update_player_state(player_id, api_glif_id, time.time(), updated_state)
+    if data is None:
+        raise Exception("No output was returned from the model.")
 
-                return start_state, narrator, reasoning, image, get_player_state(player_id)
+    narrator = data["narrator"]
+    reasoning = data["state"]["reasoning"]
+    updated_state = data["state"]["updated_state"]
+    image = data["image"] if "image" in data else None
 
-            else:
-                error_message = f"Error calling Glif API: {response.status}"
-                raise Exception(error_message)
+    logging.info(
+        "🟢 " + "Glif API responded with this json:\n" + json.dumps(data, indent=4)
+    )
 
+    # Save the state
+    saved_state = await player_store.update_player_state(
+        player_id, api_glif_id, time.time(), updated_state
+    )
 
-# Ensure database and table are created
-init_db()
+    return start_state, narrator, reasoning, image, saved_state
@@ -0,0 +1,155 @@
+import asyncio
+import contextvars
+import logging
+import math
+import random
+import time
+from collections import deque
+import aiohttp
+import config
+import http_client
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+
+# Client for the Glif simple API that keeps slow runs from holding a command
+# open. Latencies of successful runs are tracked per glif id. Once a run has
+# taken longer than that glif's GLIF_HEDGE_PERCENTILE latency, an identical
+# second request is sent and whichever succeeds first is used, the other is
+# cancelled. Glifs are never hedged before there are enough samples to know
+# what is slow for them, as some take minutes. Each request times out after a
+# multiple of the glif's p99, and 429s, 5xx errors, timeouts and dropped
+# connections are retried with jittered backoff. All Glif calls of a command
+# share one deadline, GLIF_DEADLINE_S after the command starts (see
+# set_deadline()).
+
+# Latencies kept per glif id, and how many are needed before they are used
+LATENCY_WINDOW = 200
+MIN_SAMPLES = 20
+
+_latencies = {}
+_deadline = contextvars.ContextVar("glif_deadline", default=None)
+
+stats = {"requests": 0, "hedges": 0, "hedge_wins": 0, "retries": 0}
+
+
+class _TransientError(Exception):
+    pass
+
+
+# Give the Glif calls of the current task (and the tasks it spawns) seconds
+# to finish from now
+def set_deadline(seconds: float):
+    _deadline.set(time.monotonic() + seconds)
+
+
+# The q-th percentile of the glif's recent latencies, or None while there
+# aren't enough of them
+def latency_percentile(glif_id: str, q: float) -> float:
+    samples = _latencies.get(glif_id)
+    if samples is None or len(samples) < MIN_SAMPLES:
+        return None
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+def _record_latency(glif_id: str, seconds: float):
+    _latencies.setdefault(glif_id, deque(maxlen=LATENCY_WINDOW)).append(seconds)
+
+
+# How long to wait for the first request before hedging, or None to not
+# hedge yet
+def _hedge_delay(glif_id: str) -> float:
+    return latency_percentile(glif_id, config.GLIF_HEDGE_PERCENTILE)
+
+
+# How long a single request may take
+def _request_timeout(glif_id: str) -> float:
+    latency = latency_percentile(glif_id, 99)
+    if latency is None:
+        return None
+    return max(config.GLIF_TIMEOUT_MIN_S, latency * config.GLIF_TIMEOUT_FACTOR)
+
+
+async def _post(payload: dict) -> dict:
+    glif_id = payload["id"]
+    session = http_client.get_session()
+    timeout = aiohttp.ClientTimeout(total=_request_timeout(glif_id))
+    headers = {"Content-Type": "application/json"}
+    started_at = time.monotonic()
+    stats["requests"] += 1
+    try:
+        async with session.post(
+            config.GLIF_API_URL, json=payload, headers=headers, timeout=timeout
+        ) as response:
+            if response.status == 200:
+                response_data = await response.json()
+                _record_latency(glif_id, time.monotonic() - started_at)
+                return response_data
+            error_message = f"Error calling Glif API: {response.status}"
+            if response.status == 429 or response.status >= 500:
+                raise _TransientError(error_message)
+            raise Exception(error_message)
+    except (asyncio.TimeoutError, aiohttp.ClientConnectionError, aiohttp.ClientPayloadError) as e:
+        raise _TransientError(f"Error calling Glif API: {type(e).__name__} {e}") from e
+
+
+# Send the request, and a duplicate if it is slower than usual. Returns the
+# first successful response; fails only when both requests do.
+async def _hedged(payload: dict) -> dict:
+    tasks = [asyncio.ensure_future(_post(payload))]
+    try:
+        hedge_delay = _hedge_delay(payload["id"])
+        if config.GLIF_HEDGE_ENABLED and hedge_delay is not None:
+            done, _ = await asyncio.wait(tasks, timeout=hedge_delay)
+            if not done:
+                logging.info(f"⚠️ Glif {payload['id']} is slow, sending a hedged request.")
+                stats["hedges"] += 1
+                tasks.append(asyncio.ensure_future(_post(payload)))
+
+        pending = set(tasks)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is not tasks[0]:
+                        stats["hedge_wins"] += 1
+                    return task.result()
+                error = error or task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def call(payload: dict) -> dict:
+    """
+    Runs a glif and returns the API's response, e.g. {"id": ..., "output": ...}.
+
+    :param payload: Request body, {"id": glif_id, "input": ...}.
+    """
+    deadline = _deadline.get() or time.monotonic() + config.GLIF_DEADLINE_S
+    for attempt in range(1, config.GLIF_MAX_ATTEMPTS + 1):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            return await asyncio.wait_for(_hedged(payload), remaining)
+        except asyncio.TimeoutError:
+            break
+        except _TransientError as e:
+            if attempt == config.GLIF_MAX_ATTEMPTS:
+                raise Exception(str(e)) from e
+            backoff = min(config.GLIF_RETRY_MAX_S, config.GLIF_RETRY_BASE_S * 2 ** (attempt - 1))
+            delay = min(random.uniform(0, backoff), max(0, deadline - time.monotonic()))
+            logging.warning(f"⚠️ {e}, retrying in {delay:.1f}s (attempt {attempt}).")
+            stats["retries"] += 1
+            await asyncio.sleep(delay)
+
+    error_message = f"Glif {payload['id']} did not finish in time."
+    logging.error(error_message)
+    raise Exception(error_message)
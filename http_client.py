@@ -0,0 +1,159 @@
+import aiohttp
+import asyncio
+import logging
+import os
+import re
+import config
+import tracing
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+
+# One long-lived session shared by glif, music and video generation, so that
+# repeated calls to simple-api.glif.app, Replicate and Cloudinary reuse warm
+# keep-alive connections instead of doing a fresh TCP+TLS handshake each time.
+_session: aiohttp.ClientSession = None
+
+
+def _create_session() -> aiohttp.ClientSession:
+    connector = aiohttp.TCPConnector(
+        limit=config.HTTP_MAX_CONNECTIONS,
+        limit_per_host=config.HTTP_MAX_CONNECTIONS_PER_HOST,
+        keepalive_timeout=config.HTTP_KEEPALIVE_TIMEOUT,
+        ttl_dns_cache=config.HTTP_DNS_CACHE_TTL,
+        use_dns_cache=True,
+    )
+    return aiohttp.ClientSession(connector=connector)
+
+
+# Start the shared session. Must be called from inside the running event loop.
+def start() -> aiohttp.ClientSession:
+    global _session
+    if _session is None or _session.closed:
+        _session = _create_session()
+        logging.info(
+            f"🟢 HTTP client started (limit={config.HTTP_MAX_CONNECTIONS}, "
+            f"per_host={config.HTTP_MAX_CONNECTIONS_PER_HOST})"
+        )
+    return _session
+
+
+# Return the shared session, starting it lazily if the bot hasn't yet.
+def get_session() -> aiohttp.ClientSession:
+    if _session is None or _session.closed:
+        return start()
+    return _session
+
+
+# Close the shared session and its pooled connections.
+async def close():
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+        logging.info("HTTP client closed.")
+    _session = None
+
+
+# Where the body of a 206 starts, from its Content-Range ("bytes 100-199/200"),
+# or None if the header is missing or malformed
+def _range_start(content_range: str) -> int:
+    match = re.match(r"bytes (\d+)-\d+/(\d+|\*)$", content_range or "")
+    return int(match.group(1)) if match else None
+
+
+# Stream a URL to file_name without holding it in memory.
+# Data is buffered into chunk_size blocks that are written from a worker
+# thread, into file_name + ".part" which is renamed into place only once the
+# size matches Content-Length. If the connection drops, the transfer resumes
+# from where it stopped with a Range request (also across calls).
+@tracing.traced("download")
+async def download(url: str, file_name: str, chunk_size: int = None) -> str:
+    chunk_size = chunk_size or config.DOWNLOAD_CHUNK_SIZE
+    part_path = file_name + ".part"
+    session = get_session()
+
+    for attempt in range(1, config.DOWNLOAD_MAX_ATTEMPTS + 1):
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        # Ask for the raw bytes so Content-Length matches what we write
+        headers = {"Accept-Encoding": "identity"}
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+
+        try:
+            async with session.get(url, headers=headers) as response:
+                if response.status == 206:
+                    range_start = _range_start(response.headers.get("Content-Range"))
+                    if range_start != offset:
+                        # Not the bytes we asked for, appending them would
+                        # corrupt the file. Start over from 0.
+                        logging.warning(
+                            f"⚠️ Download of {url} resumed at {range_start} instead of {offset}, restarting."
+                        )
+                        if os.path.exists(part_path):
+                            os.remove(part_path)
+                        continue
+                    mode = "ab"
+                elif response.status == 200:
+                    # Server ignored the range, overwrite from 0
+                    offset = 0
+                    mode = "wb"
+                elif response.status == 416:
+                    # Stale partial file, start over
+                    os.remove(part_path)
+                    continue
+                else:
+                    error_msg = f"Failed to download file from {url}: {response.status}"
+                    logging.error(error_msg)
+                    raise Exception(error_msg)
+
+                expected_size = None
+                if response.content_length is not None:
+                    expected_size = offset + response.content_length
+
+                f = await asyncio.to_thread(open, part_path, mode)
+                try:
+                    buffer = bytearray()
+                    async for data in response.content.iter_chunked(chunk_size):
+                        buffer += data
+                        if len(buffer) >= chunk_size:
+                            await asyncio.to_thread(f.write, bytes(buffer))
+                            buffer.clear()
+                    if buffer:
+                        await asyncio.to_thread(f.write, bytes(buffer))
+                finally:
+                    await asyncio.to_thread(f.close)
+        except (aiohttp.ClientPayloadError, aiohttp.ClientConnectionError) as e:
+            logging.warning(f"⚠️ Download of {url} interrupted ({e}), attempt {attempt}.")
+            continue
+
+        size = os.path.getsize(part_path)
+        if expected_size is not None and size != expected_size:
+            logging.warning(
+                f"⚠️ Download of {url} got {size} of {expected_size} bytes, attempt {attempt}."
+            )
+            continue
+
+        os.replace(part_path, file_name)
+        return file_name
+
+    error_msg = f"Failed to download file from {url} after {config.DOWNLOAD_MAX_ATTEMPTS} attempts"
+    logging.error(error_msg)
+    raise Exception(error_msg)
+
+
+# Fetch a URL straight into memory, for the in-memory media pipeline
+@tracing.traced("download")
+async def fetch_bytes(url: str) -> bytes:
+    session = get_session()
+    async with session.get(url) as response:
+        if response.status != 200:
+            error_msg = f"Failed to download file from {url}: {response.status}"
+            logging.error(error_msg)
+            raise Exception(error_msg)
+        data = bytearray()
+        async for chunk in response.content.iter_chunked(config.DOWNLOAD_CHUNK_SIZE):
+            data += chunk
+        return bytes(data)
@@ -0,0 +1,159 @@
+import asyncio
+import logging
+from collections import OrderedDict, deque
+import config
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+
+# Every slash command runs its pipeline as a job of a given kind ("film2",
+# "video", ...). Each kind has its own limit on how many jobs run at once;
+# waiting jobs are started round-robin across users, so one person spamming
+# /film2 can't starve everyone else. Once too many jobs are waiting, new ones
+# are rejected with QueueFullError instead of piling up.
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class _Entry:
+    def __init__(self, user_id, on_position):
+        self.user_id = user_id
+        self.on_position = on_position
+        self.started = asyncio.get_running_loop().create_future()
+        self.position = None
+        self.reported = None
+        self.lock = asyncio.Lock()
+
+
+class _KindQueue:
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.running = 0
+        # user id -> deque of waiting entries; order is the round-robin order
+        self.waiting = OrderedDict()
+
+    def pending(self) -> int:
+        return sum(len(entries) for entries in self.waiting.values())
+
+    # Waiting entries in the order they will be started
+    def dispatch_order(self) -> list:
+        order = []
+        queues = list(self.waiting.values())
+        for round_index in range(max((len(q) for q in queues), default=0)):
+            order.extend(q[round_index] for q in queues if len(q) > round_index)
+        return order
+
+    def pop_next(self) -> _Entry:
+        user_id, entries = next(iter(self.waiting.items()))
+        entry = entries.popleft()
+        if entries:
+            self.waiting.move_to_end(user_id)
+        else:
+            del self.waiting[user_id]
+        return entry
+
+    def remove(self, entry: _Entry):
+        entries = self.waiting.get(entry.user_id)
+        if entries is not None and entry in entries:
+            entries.remove(entry)
+            if not entries:
+                del self.waiting[entry.user_id]
+
+
+class JobScheduler:
+    def __init__(self, limits: dict, default_limit: int, max_queue_depth: int):
+        self.limits = limits
+        self.default_limit = default_limit
+        self.max_queue_depth = max_queue_depth
+        self._queues = {}
+
+    def _queue(self, kind: str) -> _KindQueue:
+        if kind not in self._queues:
+            self._queues[kind] = _KindQueue(self.limits.get(kind, self.default_limit))
+        return self._queues[kind]
+
+    # Number of jobs waiting to start, across all kinds
+    def pending(self) -> int:
+        return sum(queue.pending() for queue in self._queues.values())
+
+    # Number of jobs running and waiting, per kind
+    def status(self) -> dict:
+        return {
+            kind: {"running": queue.running, "waiting": queue.pending()}
+            for kind, queue in self._queues.items()
+        }
+
+    async def _report_position(self, entry: _Entry):
+        async with entry.lock:
+            if entry.started.done() or entry.position == entry.reported:
+                return
+            entry.reported = entry.position
+            try:
+                await entry.on_position(entry.position)
+            except Exception:
+                logging.exception("Could not report queue position.")
+
+    def _update_positions(self, queue: _KindQueue):
+        for position, entry in enumerate(queue.dispatch_order(), start=1):
+            entry.position = position
+            if entry.on_position is not None and position != entry.reported:
+                asyncio.ensure_future(self._report_position(entry))
+
+    def _dispatch(self, queue: _KindQueue):
+        while queue.running < queue.limit and queue.waiting:
+            entry = queue.pop_next()
+            queue.running += 1
+            entry.started.set_result(None)
+        self._update_positions(queue)
+
+    async def submit(self, kind: str, user_id: str, job, on_position=None):
+        """
+        Runs job() once a slot for this kind of job is free, returns its result.
+
+        :param kind: Kind of job, usually the command name.
+        :param user_id: Who asked for it, for round-robin fairness.
+        :param job: Coroutine function to run.
+        :param on_position: Optional coroutine function called with the job's
+            1-based position in the queue whenever it changes while waiting.
+        """
+        queue = self._queue(kind)
+
+        if queue.running < queue.limit and not queue.waiting:
+            queue.running += 1
+        else:
+            if self.pending() >= self.max_queue_depth:
+                raise QueueFullError(f"Too many jobs waiting ({self.pending()}).")
+
+            entry = _Entry(user_id, on_position)
+            queue.waiting.setdefault(user_id, deque()).append(entry)
+            logging.info(f"🚦 Queued {kind} job for {user_id}.")
+            self._update_positions(queue)
+            try:
+                await entry.started
+            except asyncio.CancelledError:
+                if entry.started.done() and not entry.started.cancelled():
+                    # Got a slot just as we were cancelled, hand it on
+                    queue.running -= 1
+                else:
+                    queue.remove(entry)
+                self._dispatch(queue)
+                raise
+
+        try:
+            return await job()
+        finally:
+            queue.running -= 1
+            self._dispatch(queue)
+
+
+# The bot's shared scheduler
+scheduler = JobScheduler(
+    limits=config.JOB_LIMITS,
+    default_limit=config.JOB_DEFAULT_LIMIT,
+    max_queue_depth=config.JOB_MAX_QUEUE_DEPTH,
+)
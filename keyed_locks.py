@@ -0,0 +1,50 @@
+import asyncio
+import contextlib
+import time
+
+
+class KeyedLocks:
+    """
+    One asyncio.Lock per key, created on demand. Work for the same key runs
+    strictly one at a time, in arrival order, while different keys run in
+    parallel. With a limit above 1 each key gets a semaphore instead, letting
+    that many run at once. Locks nobody has used for idle_ttl_s seconds are
+    dropped so the table doesn't grow with every key ever seen.
+    """
+
+    def __init__(self, idle_ttl_s: float = 600, limit: int = 1):
+        self.idle_ttl_s = idle_ttl_s
+        self.limit = limit
+        # key -> [lock, number of holders and waiters, last release time]
+        self._entries = {}
+        self._last_sweep = time.monotonic()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _sweep(self):
+        now = time.monotonic()
+        if now - self._last_sweep < self.idle_ttl_s:
+            return
+        self._last_sweep = now
+        for key in [
+            key
+            for key, (lock, users, last_used) in self._entries.items()
+            if users == 0 and now - last_used > self.idle_ttl_s
+        ]:
+            del self._entries[key]
+
+    @contextlib.asynccontextmanager
+    async def lock(self, key):
+        self._sweep()
+        entry = self._entries.get(key)
+        if entry is None:
+            lock = asyncio.Lock() if self.limit == 1 else asyncio.Semaphore(self.limit)
+            entry = self._entries[key] = [lock, 0, time.monotonic()]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            entry[2] = time.monotonic()
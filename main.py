@@ -1,21 +1,40 @@
 from interactions import Client, Intents, listen, File
 from interactions import slash_command, SlashContext
-from interactions import OptionType, slash_option
-import replicate
-import aiohttp
+from interactions import OptionType, slash_option, SlashCommandChoice
 import os
 import logging
 import asyncio
+import contextlib
+import functools
+import io
 import json
+import time
 from music_generation import music_generation
 from video_generation import (
     generate_video,
+    generate_video_bytes,
+    load_image_bytes,
     concatenate_videos_async,
-    concatenate_videos_with_audio_async,
+    shrink_to_fit,
+    resolve_image,
+    make_grid,
 )
-from glif import image_glif, story_glif, chattorio_glif
+from glif import image_glif, image_glif_variants, story_glif, chattorio_glif, glif_flights
+from film_pipeline import make_film
 from dotenv import load_dotenv
 import config
+import http_client
+import player_store
+import replicate_api
+import ffmpeg_pool
+import encoding_profiles
+import asset_cache
+import tracing
+import glif_client
+import circuit_breaker
+import workspace
+from music_generation import result_cache_stats, prediction_flights
+from job_scheduler import scheduler, QueueFullError
 
 
 # Load environment variables from the .env file
@@ -35,13 +54,150 @@ settings = {
 # Discord Bot
 bot = Client(intents=Intents.DEFAULT)
 
-# Replicate Client
-replicate_client = replicate.Client(api_token=config.REPLICATE_API_TOKEN)
+# Choices for the optional encoding profile option
+PROFILE_CHOICES = [
+    SlashCommandChoice(name=name, value=name) for name in encoding_profiles.PROFILES
+]
 
 
-# Return a unique filename prefix for the current user and command
+# Live values for /metrics, see tracing.py
+tracing.gauge("bot_ffmpeg_queue_depth", "ffmpeg jobs waiting or running.", ffmpeg_pool.queue_depth)
+tracing.gauge("bot_jobs_waiting", "Commands waiting for a slot.", scheduler.pending)
+tracing.gauge(
+    "bot_jobs_running",
+    "Commands running.",
+    lambda: sum(queue["running"] for queue in scheduler.status().values()),
+)
+tracing.counter(
+    "bot_asset_cache_hits_total", "Downloads served from the asset cache.", lambda: asset_cache.stats["hits"]
+)
+tracing.counter(
+    "bot_asset_cache_misses_total", "Downloads not in the asset cache.", lambda: asset_cache.stats["misses"]
+)
+tracing.counter("bot_music_cache_hits_total", "MusicGen results reused.", lambda: result_cache_stats["hits"])
+tracing.counter("bot_glif_requests_total", "Requests sent to the Glif API.", lambda: glif_client.stats["requests"])
+tracing.counter("bot_glif_hedges_total", "Hedged Glif requests sent.", lambda: glif_client.stats["hedges"])
+tracing.counter(
+    "bot_glif_hedge_wins_total", "Hedged Glif requests that answered first.", lambda: glif_client.stats["hedge_wins"]
+)
+tracing.counter("bot_glif_retries_total", "Glif requests retried after an error.", lambda: glif_client.stats["retries"])
+tracing.gauge(
+    "bot_breaker_state",
+    "Circuit breaker per upstream: 0 closed, 1 half open (trying a call), 2 open (using fallbacks).",
+    circuit_breaker.states,
+    label="breaker",
+)
+tracing.counter(
+    "bot_breaker_rejected_total",
+    "Calls answered with a fallback because the breaker was open.",
+    lambda: {name: breaker.stats["rejected"] for name, breaker in circuit_breaker.breakers.items()},
+    label="breaker",
+)
+tracing.counter(
+    "bot_glif_calls_saved_total", "Glif calls saved by joining one in flight.", lambda: glif_flights.stats["saved"]
+)
+tracing.counter(
+    "bot_music_calls_saved_total",
+    "MusicGen predictions saved by joining one in flight.",
+    lambda: prediction_flights.stats["saved"],
+)
+tracing.gauge("bot_temp_bytes", "Bytes in TEMP_PATH and WORKSPACE_PATH.", lambda: workspace.stats["bytes"])
+tracing.gauge("bot_temp_files", "Files in TEMP_PATH and WORKSPACE_PATH.", lambda: workspace.stats["files"])
+tracing.gauge(
+    "bot_temp_free_bytes", "Free space where workspaces live.", lambda: workspace.stats["free_bytes"]
+)
+tracing.counter(
+    "bot_janitor_deleted_bytes_total", "Bytes of leftovers the janitor deleted.", lambda: workspace.stats["deleted_bytes"]
+)
+tracing.gauge("bot_workspaces_active", "Workspaces of running commands.", workspace.active_count)
+
+
+# Return a unique filename prefix for the current user and command, in the
+# command's workspace
 def temp_file_prefix(ctx: SlashContext):
-    return config.TEMP_PATH + ctx.user.global_name + "_" + str(ctx.id) + "_"
+    return workspace.current_path() + ctx.user.global_name + "_" + str(ctx.id) + "_"
+
+
+# Largest file the bot may upload where this command was run
+def upload_limit(ctx) -> int:
+    guild = getattr(ctx, "guild", None)
+    if guild is None:
+        return config.UPLOAD_LIMIT_BYTES
+    return min(guild.filesize_limit, config.UPLOAD_LIMIT_BYTES)
+
+
+# Encoding profile for a render of this many seconds, capped to fit the
+# upload limit (see TARGET_SIZE_ENCODING)
+def render_profile_for(ctx, profile: str, duration_s: float) -> dict:
+    render_profile = encoding_profiles.choose(profile)
+    if config.TARGET_SIZE_ENCODING:
+        render_profile = encoding_profiles.fit_to_size(
+            render_profile, duration_s, upload_limit(ctx)
+        )
+    return render_profile
+
+
+# Make sure a rendered video can be uploaded, in case the size cap missed
+async def fit_for_upload(ctx, video_path: str, duration_s: float, render_profile: dict) -> str:
+    if not config.TARGET_SIZE_ENCODING:
+        return video_path
+    return await shrink_to_fit(video_path, upload_limit(ctx), duration_s, render_profile)
+
+
+# Send a reply with a file, timed as the "upload" stage
+async def send_file(ctx, file: File, **kwargs):
+    with tracing.span("upload"):
+        return await ctx.send(file=file, **kwargs)
+
+
+# Run a command through the job scheduler instead of starting it right away,
+# keeping the user posted on their place in the queue while they wait.
+# The command is traced as a job, see tracing.py, and its files go in a
+# workspace that is deleted when it's done, see workspace.py.
+def queued_job(kind: str):
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(ctx, **kwargs):
+            await ctx.defer()  # Tell discord that we're gonna be a while
+            trace = tracing.start_job(kind, str(ctx.user.id), ctx.id)
+            queued_at = time.monotonic()
+            status_message = None
+
+            async def on_position(position):
+                nonlocal status_message
+                text = f"⏳ You are #{position} in the /{kind} queue."
+                if status_message is None:
+                    status_message = await ctx.send(text)
+                else:
+                    await status_message.edit(content=text)
+
+            async def job():
+                tracing.record("queue", time.monotonic() - queued_at)
+                glif_client.set_deadline(config.GLIF_DEADLINE_S)
+                if status_message is not None:
+                    with contextlib.suppress(Exception):
+                        await status_message.delete()
+                async with workspace.scoped(f"{kind}_{ctx.id}"):
+                    return await func(ctx, **kwargs)
+
+            try:
+                with tracing.span("command"):
+                    await scheduler.submit(kind, str(ctx.user.id), job, on_position)
+            except QueueFullError:
+                logging.warning(f"🚦 Rejected /{kind}, queue is full.")
+                await ctx.send(
+                    f"🚦 The bot is too busy right now, please try /{kind} again in a minute."
+                )
+                return
+
+            breakdown = tracing.format_breakdown(trace)
+            logging.info(f"⏱️ /{kind} for {ctx.user.id}: {breakdown}")
+            if config.TRACE_IN_REPLY:
+                await ctx.send(f"⏱️ {breakdown}")
+
+        return wrapper
+
+    return decorator
 
 
 @slash_command(
@@ -55,17 +211,29 @@ def temp_file_prefix(ctx: SlashContext):
     required=True,
     opt_type=OptionType.STRING,
 )
+@queued_job("music")
 async def music(ctx, *, prompt: str = ""):
-    await ctx.defer()  # Tell discord that we're gonna be a while
     logging.info(f"🔵 Creating music for: {prompt}")
 
     try:
         logging.info("music_generation")
-        mp3_path = await music_generation(config.REPLICATE_API_TOKEN, prompt)
+        if config.IN_MEMORY_PIPELINE:
+            # Upload straight from memory, no temp files
+            music_data = await music_generation(
+                config.REPLICATE_API_TOKEN, prompt, as_bytes=True
+            )
+            await send_file(
+                ctx, File(io.BytesIO(music_data), file_name="music.wav"), content=prompt
+            )
+            return
+
+        mp3_path = await music_generation(
+            config.REPLICATE_API_TOKEN, prompt, filename_prefix=temp_file_prefix(ctx)
+        )
         if mp3_path:
             # await ctx.send(files=File(mp3_path))
             # await ctx.send(prompt)
-            await ctx.send_message(content=prompt, file=File(mp3_path))
+            await send_file(ctx, File(mp3_path), content=prompt)
 
             if settings["delete_temp_files"]:
                 os.path.exists(mp3_path) and os.remove(mp3_path)
@@ -88,11 +256,23 @@ async def music(ctx, *, prompt: str = ""):
     required=True,
     opt_type=OptionType.STRING,
 )
-async def image(ctx, *, prompt: str):
-    await ctx.defer()  # Tell discord that we're gonna be a while
+@slash_option(
+    name="variants",
+    description="How many versions to make, sent together as a grid.",
+    required=False,
+    opt_type=OptionType.INTEGER,
+    min_value=1,
+    max_value=config.IMAGE_MAX_VARIANTS,
+)
+@queued_job("image")
+async def image(ctx, *, prompt: str, variants: int = 1):
     logging.info(f"🔵 Creating image for: {prompt}")
 
     try:
+        if variants > 1:
+            await image_variants(ctx, prompt, min(variants, config.IMAGE_MAX_VARIANTS))
+            return
+
         image_url = await image_glif(prompt)
         if image_url:
             await ctx.send(image_url)  # This will send the image URL directly
@@ -105,6 +285,37 @@ async def image(ctx, *, prompt: str):
         await ctx.send(f"An error occurred while handling your image request: {e}")
 
 
+# /image with several variants: the Glif runs go out at once, each image is
+# added to one message as it arrives, and then they are sent as one grid
+async def image_variants(ctx, prompt: str, count: int):
+    image_urls = [None] * count
+    status_message = await ctx.send(f"🎨 0/{count} images ready for: {prompt}")
+    finished = 0
+    async for index, image_url in image_glif_variants(prompt, count, str(ctx.user.id)):
+        finished += 1
+        image_urls[index] = image_url
+        lines = [f"{i + 1}. {url}" for i, url in enumerate(image_urls) if url]
+        with contextlib.suppress(Exception):
+            await status_message.edit(
+                content=f"🎨 {finished}/{count} images ready for: {prompt}\n" + "\n".join(lines)
+            )
+
+    image_urls = [url for url in image_urls if url]
+    if not image_urls:
+        await ctx.send("An error occurred or no image URL was returned.")
+        return
+
+    run_path = temp_file_prefix(ctx)
+    image_paths = await asyncio.gather(
+        *(
+            resolve_image(url, f"{run_path}variant{i + 1}.img")
+            for i, url in enumerate(image_urls)
+        )
+    )
+    grid_path = await make_grid(image_paths, run_path + "grid.jpg")
+    await send_file(ctx, File(grid_path), content=prompt)
+
+
 @slash_command(
     name="video",
     description="Generate a video about a videogame from text",
@@ -116,13 +327,28 @@ async def image(ctx, *, prompt: str):
     required=True,
     opt_type=OptionType.STRING,
 )
-async def video(ctx, *, prompt: str):
-    await ctx.defer()  # Tell discord that we're gonna be a while
+@slash_option(
+    name="profile",
+    description="Encoding profile, trading quality for speed. (Advanced)",
+    required=False,
+    opt_type=OptionType.STRING,
+    choices=PROFILE_CHOICES,
+)
+@queued_job("video")
+async def video(ctx, *, prompt: str, profile: str = None):
     logging.info(f"🔵 Creating video for: {prompt}")
 
     music_prompt = f"8 bit retro gaming soundtrack for {prompt} game"
+    ffmpeg_timings = ffmpeg_pool.track_timings()
 
     try:
+        render_profile = render_profile_for(ctx, profile, 8)
+
+        if config.IN_MEMORY_PIPELINE:
+            await video_in_memory(ctx, prompt, music_prompt, render_profile)
+            logging.info(f"⏱️ ffmpeg jobs for video: {ffmpeg_pool.format_timings(ffmpeg_timings)}")
+            return
+
         # Start both glif API and replicate API calls concurrently
         image_path, mp3_path = await asyncio.gather(
             image_glif(prompt),  # Ensure this returns a URL
@@ -137,12 +363,14 @@ async def video(ctx, *, prompt: str):
         if image_path and mp3_path:
             # Generate the video
             video_path = await generate_video(
-                image_path, mp3_path, temp_file_prefix(ctx), duration=8
+                image_path, mp3_path, temp_file_prefix(ctx), duration=8, profile=render_profile
             )
+            video_path = await fit_for_upload(ctx, video_path, 8, render_profile)
 
             # Send the video to the Discord channel
-            await ctx.send(file=File(video_path))
+            await send_file(ctx, File(video_path))
             await ctx.send(prompt)
+            logging.info(f"⏱️ ffmpeg jobs for video: {ffmpeg_pool.format_timings(ffmpeg_timings)}")
 
             # Clean up the generated files
             if settings["delete_temp_files"]:
@@ -157,6 +385,33 @@ async def video(ctx, *, prompt: str):
         await ctx.send(f"An error occurred while handling your video request: {e}")
 
 
+# /video without temp files: assets are piped into ffmpeg and the video is
+# uploaded from memory
+async def video_in_memory(ctx, prompt: str, music_prompt: str, render_profile: dict):
+    image_url, music_data = await asyncio.gather(
+        image_glif(prompt),
+        music_generation(config.REPLICATE_API_TOKEN, music_prompt, as_bytes=True),
+    )
+    image_data = await load_image_bytes(image_url)
+    video_data = await generate_video_bytes(
+        image_data, music_data, duration=8, profile=render_profile
+    )
+    if config.TARGET_SIZE_ENCODING and len(video_data) > upload_limit(ctx):
+        # Too big to upload, shrink it on disk like the file-based /video does
+        video_path = temp_file_prefix(ctx) + "video.mp4"
+        await asyncio.to_thread(write_file, video_path, video_data)
+        video_path = await fit_for_upload(ctx, video_path, 8, render_profile)
+        await send_file(ctx, File(video_path))
+    else:
+        await send_file(ctx, File(io.BytesIO(video_data), file_name="video.mp4"))
+    await ctx.send(prompt)
+
+
+def write_file(path: str, data: bytes):
+    with open(path, "wb") as f:
+        f.write(data)
+
+
 @slash_command(
     name="film",
     description="Generate a short film from text",
@@ -168,13 +423,24 @@ async def video(ctx, *, prompt: str):
     required=True,
     opt_type=OptionType.STRING,
 )
-async def film(ctx, *, prompt: str):
-    await ctx.defer()
+@slash_option(
+    name="profile",
+    description="Encoding profile, trading quality for speed. (Advanced)",
+    required=False,
+    opt_type=OptionType.STRING,
+    choices=PROFILE_CHOICES,
+)
+@queued_job("film")
+async def film(ctx, *, prompt: str, profile: str = None):
     logging.info(f"🔵 Creating film for: {prompt}")
 
     run_path = temp_file_prefix(ctx)
+    ffmpeg_timings = ffmpeg_pool.track_timings()
 
     try:
+        # Four 8 second scenes
+        render_profile = render_profile_for(ctx, profile, 32)
+
         (
             image_url_1,
             image_url_2,
@@ -187,17 +453,21 @@ async def film(ctx, *, prompt: str):
             ),
         )
 
-        video_path1 = await generate_video(
-            image_url_1, mp3_path, temp_file_prefix(ctx) + "1_"
-        )
-        video_path2 = await generate_video(
-            image_url_2, mp3_path, temp_file_prefix(ctx) + "2_"
-        )
-        video_path3 = await generate_video(
-            image_url_3, mp3_path, temp_file_prefix(ctx) + "3_"
-        )
-        video_path4 = await generate_video(
-            image_url_4, mp3_path, temp_file_prefix(ctx) + "4_"
+        # Render all scenes at once; the ffmpeg scheduler caps how many
+        # encoders actually run at the same time.
+        video_path1, video_path2, video_path3, video_path4 = await asyncio.gather(
+            generate_video(
+                image_url_1, mp3_path, temp_file_prefix(ctx) + "1_", profile=render_profile
+            ),
+            generate_video(
+                image_url_2, mp3_path, temp_file_prefix(ctx) + "2_", profile=render_profile
+            ),
+            generate_video(
+                image_url_3, mp3_path, temp_file_prefix(ctx) + "3_", profile=render_profile
+            ),
+            generate_video(
+                image_url_4, mp3_path, temp_file_prefix(ctx) + "4_", profile=render_profile
+            ),
         )
         # await ctx.send(file=File(video_path1))
         # await ctx.send(file=File(video_path2))
@@ -208,14 +478,31 @@ async def film(ctx, *, prompt: str):
             [video_path1, video_path2, video_path3, video_path4],
             run_path + "concat.mp4",
         )
-        await ctx.send(file=File(concat_video_path))
+        concat_video_path = await fit_for_upload(ctx, concat_video_path, 32, render_profile)
+        await send_file(ctx, File(concat_video_path))
         await ctx.send(prompt)
+        logging.info(f"⏱️ ffmpeg jobs for film: {ffmpeg_pool.format_timings(ffmpeg_timings)}")
 
     except Exception as e:
         logging.exception("An error occurred while handling the image request.")
         await ctx.send(f"An error occurred while handling your image request: {e}")
 
 
+# The scenes option of /film2. Only the split story (STORY_TEXT_GLIF_ID) can
+# make other than 4 scenes, so without it the option isn't offered at all.
+def film_scenes_option(func):
+    if not config.STORY_TEXT_GLIF_ID:
+        return func
+    return slash_option(
+        name="scenes",
+        description="How many scenes the film has.",
+        required=False,
+        opt_type=OptionType.INTEGER,
+        min_value=1,
+        max_value=config.FILM_MAX_SCENES,
+    )(func)
+
+
 @slash_command(
     name="film2",
     description="Generate a short film from text",
@@ -233,70 +520,39 @@ async def film(ctx, *, prompt: str):
     required=False,
     opt_type=OptionType.INTEGER,
 )
-async def film2(ctx, *, prompt: str, duration: int = 12):
-    await ctx.defer()
+@film_scenes_option
+@slash_option(
+    name="profile",
+    description="Encoding profile, trading quality for speed. (Advanced)",
+    required=False,
+    opt_type=OptionType.STRING,
+    choices=PROFILE_CHOICES,
+)
+@queued_job("film2")
+async def film2(
+    ctx, *, prompt: str, duration: int = 12, scenes: int = None, profile: str = None
+):
     logging.info(f"🔵 Creating film for: {prompt}")
 
     film_duration_s = float(duration)
 
     run_path = temp_file_prefix(ctx)
+    ffmpeg_timings = ffmpeg_pool.track_timings()
 
     try:
-        (
-            image_url_1,
-            image_url_2,
-            image_url_3,
-            image_url_4,
-        ), mp3_path = await asyncio.gather(
-            story_glif(prompt),  # Ensure this returns a URL
-            music_generation(
-                config.REPLICATE_API_TOKEN,
-                prompt,
-                filename_prefix=run_path,
-                duration=film_duration_s,
-            ),
-        )
-
-        video_path1 = await generate_video(
-            image_url_1,
-            None,
-            temp_file_prefix(ctx) + "1_",
-            duration=film_duration_s / 4,
-        )
-        video_path2 = await generate_video(
-            image_url_2,
-            None,
-            temp_file_prefix(ctx) + "2_",
-            duration=film_duration_s / 4,
-        )
-        video_path3 = await generate_video(
-            image_url_3,
-            None,
-            temp_file_prefix(ctx) + "3_",
-            duration=film_duration_s / 4,
+        # Scenes render as soon as the story arrives, music is only joined
+        # in the final mux
+        render_profile = render_profile_for(ctx, profile, film_duration_s)
+        scene_count = min(scenes or config.FILM_SCENE_COUNT, config.FILM_MAX_SCENES)
+        concat_video_path = await make_film(
+            prompt, film_duration_s, run_path, scene_count=scene_count, profile=render_profile
         )
-        video_path4 = await generate_video(
-            image_url_4,
-            None,
-            temp_file_prefix(ctx) + "4_",
-            duration=film_duration_s / 4,
-        )
-        # await ctx.send(file=File(video_path1))
-        # await ctx.send(file=File(video_path2))
-        # await ctx.send(file=File(video_path3))
-        # await ctx.send(file=File(video_path4))
-
-        logging.info("concatenate_videos_with_audio_async")
-        concat_video_path = await concatenate_videos_with_audio_async(
-            video_path1,
-            video_path2,
-            video_path3,
-            video_path4,
-            mp3_path,
-            run_path + "concat.mp4",
+        concat_video_path = await fit_for_upload(
+            ctx, concat_video_path, film_duration_s, render_profile
         )
         await ctx.send(prompt)
-        await ctx.send(file=File(concat_video_path))
+        await send_file(ctx, File(concat_video_path))
+        logging.info(f"⏱️ ffmpeg jobs for film2: {ffmpeg_pool.format_timings(ffmpeg_timings)}")
         logging.info(f"🟢 Finished creating film for: {prompt}")
 
     except Exception as e:
@@ -328,8 +584,8 @@ async def film2(ctx, *, prompt: str, duration: int = 12):
     opt_type=OptionType.STRING,
 )
 
+@queued_job("chattorio")
 async def chattorio(ctx, *, action: str, glif_id: str = None, inventory: str = None):
-    await ctx.defer()
     logging.info(f"🔵 Doing chattorio for: {action}")
 
     run_path = temp_file_prefix(ctx)
@@ -373,6 +629,15 @@ async def chattorio(ctx, *, action: str, glif_id: str = None, inventory: str = N
         await ctx.send(f"An error occurred while handling your chattorio request: {e}")
 
 
+@listen()
+async def on_startup():
+    # This event is called once, when the bot first connects
+    http_client.start()
+    await replicate_api.start_webhook_server()
+    tracing.start_metrics_server()
+    workspace.start_janitor()
+
+
 @listen()  # this decorator tells snek that it needs to listen for the corresponding event, and run this coroutine
 async def on_ready():
     # This event is called when the bot is ready to respond to commands
@@ -380,4 +645,18 @@ async def on_ready():
     logging.info(f"This bot is owned by {bot.owner}")
 
 
-bot.start(config.TOKEN)
+async def run_bot():
+    try:
+        await bot.astart(config.TOKEN)
+    finally:
+        # Close pooled connections however the bot stops
+        await replicate_api.stop_webhook_server()
+        tracing.stop_metrics_server()
+        await workspace.stop_janitor()
+        await http_client.close()
+        await player_store.close()
+
+
+if __name__ == "__main__":
+    with contextlib.suppress(KeyboardInterrupt):
+        asyncio.run(run_bot())
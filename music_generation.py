@@ -1,9 +1,20 @@
-import replicate
-import aiohttp
 import logging
 import asyncio
 import re
+import json
+import hashlib
+import math
+import random
+import tempfile
+import time
+from collections import OrderedDict
 import config
+import audio
+import asset_cache
+import replicate_api
+import workspace
+from single_flight import SingleFlight, normalize
+from circuit_breaker import CircuitBreaker, CircuitOpenError
 
 # Configure logging
 # Configure logging
@@ -11,9 +22,74 @@ logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
 )
 
-# Initialize logging to only log errors
-#  Replicate client generates a ton of info logs so we need this.
-logging.getLogger("httpx").setLevel(logging.ERROR)
+
+MUSICGEN_MODEL = "meta/musicgen:7a76a8258b23fae65c5a22debb8841d1d7e816b75c2f24218cd2bd8573787906"
+
+# Recent MusicGen results: cache key -> (expiry time, music URL). The audio
+# itself lives in the asset cache, keyed by that URL.
+_result_cache = OrderedDict()
+result_cache_stats = {"hits": 0, "misses": 0}
+
+# Identical predictions requested while one is still running share it
+prediction_flights = SingleFlight("MusicGen")
+
+# While MusicGen keeps failing or is very slow, music comes from
+# _degraded_music() instead
+music_breaker = CircuitBreaker("musicgen", config.BREAKER_SLOW_MUSIC_S)
+
+
+# Cache key for a MusicGen call: the model plus every input, with the prompt
+# lowercased and whitespace-collapsed so trivial variations still hit.
+def result_cache_key(model: str, model_input: dict) -> str:
+    normalized = dict(model_input)
+    normalized["prompt"] = normalize(model_input["prompt"])
+    return model + ":" + json.dumps(normalized, sort_keys=True)
+
+
+# Local path of a cached result for this key, or None
+def _cached_result(key: str) -> str:
+    entry = _result_cache.get(key)
+    if entry is None:
+        return None
+    expires_at, music_url = entry
+    cached_path = asset_cache.lookup(music_url)
+    if time.time() > expires_at or cached_path is None:
+        del _result_cache[key]
+        return None
+    _result_cache.move_to_end(key)
+    return music_url
+
+
+def _store_result(key: str, music_url: str):
+    _result_cache[key] = (time.time() + config.MUSIC_CACHE_TTL_S, music_url)
+    _result_cache.move_to_end(key)
+    while len(_result_cache) > config.MUSIC_CACHE_MAX_ENTRIES:
+        _result_cache.popitem(last=False)
+
+
+# Music to use while MusicGen is unavailable: the most recent cached result,
+# whatever its prompt, or else DEFAULT_MUSIC_PATH, cut or padded with silence
+# to the requested duration
+async def _degraded_music(filename_prefix: str, as_bytes: bool, duration: float):
+    source_path = config.DEFAULT_MUSIC_PATH
+    for _, music_url in reversed(_result_cache.values()):
+        cached_path = asset_cache.lookup(music_url)
+        if cached_path is not None and music_url.endswith(".wav"):
+            logging.warning("⚠️ MusicGen is unavailable, reusing a recent soundtrack.")
+            source_path = cached_path
+            break
+    else:
+        logging.warning("⚠️ MusicGen is unavailable, using the default soundtrack.")
+
+    if as_bytes:
+        with tempfile.TemporaryDirectory(dir=workspace.current_path()) as work_path:
+            music_filename = await asyncio.to_thread(
+                audio.trim, source_path, work_path + "/music.wav", duration
+            )
+            return await asyncio.to_thread(asset_cache.read_file, music_filename)
+    return await asyncio.to_thread(
+        audio.trim, source_path, f"{filename_prefix}music.wav", duration
+    )
 
 
 def sanitize_for_unix_filename(s):
@@ -45,12 +121,46 @@ async def music_generation(
     output_format="wav",
     seed=None,
     filename_prefix="./",
+    fresh=False,
+    as_bytes=False,
+    degrade=True,
 ):
+    """
+    Generates music with MusicGen on Replicate, returns path to local audio file.
+
+    Results are cached by prompt and settings (see MUSIC_CACHE_* in config.py);
+    pass fresh=True to always run a new prediction. Pass a seed to get a
+    reproducible result; without one a random seed is used. With as_bytes=True
+    the audio is returned in memory instead of being saved to a file. While
+    MusicGen is unavailable a fallback track is returned, or with degrade=False
+    CircuitOpenError is raised.
+    """
     # Testing
     if config.DO_FAKE_RESULTS:
         logging.info("😎 Using fake replicate response for testing. Ignoring duration and other settings.")
+        if as_bytes:
+            return await asyncio.to_thread(
+                asset_cache.read_file, "test_files/wanderingstan_1175179192011333713_music.wav"
+            )
         return "test_files/wanderingstan_1175179192011333713_music.wav"
 
+    if config.MUSIC_CHUNK_S and duration > config.MUSIC_CHUNK_S and not continuation:
+        return await chunked_music_generation(
+            REPLICATE_API_TOKEN,
+            prompt,
+            duration,
+            seed=seed,
+            filename_prefix=filename_prefix,
+            fresh=fresh,
+            as_bytes=as_bytes,
+            model_version=model_version,
+            normalization_strategy=normalization_strategy,
+            top_k=top_k,
+            top_p=top_p,
+            temperature=temperature,
+            classifier_free_guidance=classifier_free_guidance,
+        )
+
     # Note: Don't fully understand the continuation settings yet.
     if continuation_end == 0:
         continuation_end = duration
@@ -61,37 +171,63 @@ async def music_generation(
     if not REPLICATE_API_TOKEN:
         raise ValueError("No Replicate API token passed.")
 
-    # Initialize Replicate Client with your API token
-    replicate_client = replicate.Client(api_token=REPLICATE_API_TOKEN)
-
-    logging.info("🕒 Calling the Replicate API for music_generation.")
-
-    # Run the new music generation model using Replicate API
-    output = await asyncio.to_thread(
-        replicate_client.run,
-        "meta/musicgen:7a76a8258b23fae65c5a22debb8841d1d7e816b75c2f24218cd2bd8573787906",
-        input={
-            "seed": -1,
-            "top_k": top_k,
-            "top_p": top_p,
-            "prompt": fullprompt,
-            "duration": duration,
-            "temperature": temperature,
-            "continuation": continuation,
-            "model_version": "large",
-            "output_format": output_format,
-            "continuation_end": continuation_end,
-            "continuation_start": continuation_start,
-            "normalization_strategy": normalization_strategy,  # "peak",
-            "classifier_free_guidance": classifier_free_guidance,
-        },
-    )
+    model_input = {
+        "seed": seed if seed is not None else -1,
+        "top_k": top_k,
+        "top_p": top_p,
+        "prompt": fullprompt,
+        "duration": duration,
+        "temperature": temperature,
+        "continuation": continuation,
+        "model_version": "large",
+        "output_format": output_format,
+        "continuation_end": continuation_end,
+        "continuation_start": continuation_start,
+        "normalization_strategy": normalization_strategy,  # "peak",
+        "classifier_free_guidance": classifier_free_guidance,
+    }
+
+    cache_key = result_cache_key(MUSICGEN_MODEL, model_input)
+    music_url = None
+    if config.MUSIC_CACHE_ENABLED and not fresh:
+        music_url = _cached_result(cache_key)
+
+    if music_url is not None:
+        result_cache_stats["hits"] += 1
+        logging.info("🟢 Using cached music_generation result.")
+    else:
+        result_cache_stats["misses"] += 1
+
+        logging.info("🕒 Calling the Replicate API for music_generation.")
+
+        # Run the new music generation model using Replicate API. Every
+        # caller downloads the shared output to its own file.
+        def predict():
+            return music_breaker.call(
+                lambda: replicate_api.run(MUSICGEN_MODEL, model_input, api_token=REPLICATE_API_TOKEN)
+            )
 
-    if output is None:
-        raise Exception("No output was returned from the model.")
+        try:
+            if config.SINGLE_FLIGHT_ENABLED and not fresh:
+                output = await prediction_flights.run(cache_key, predict)
+            else:
+                output = await predict()
+        except CircuitOpenError:
+            if not degrade:
+                raise
+            return await _degraded_music(filename_prefix, as_bytes, duration)
+
+        if output is None:
+            raise Exception("No output was returned from the model.")
+
+        # Assuming the model returns a URL to the generated music file
+        music_url = output
 
-    # Assuming the model returns a URL to the generated music file
-    music_url = output
+    if as_bytes:
+        music_data = await asset_cache.fetch_bytes(music_url)
+        if config.MUSIC_CACHE_ENABLED and asset_cache.lookup(music_url) is not None:
+            _store_result(cache_key, music_url)
+        return music_data
 
     # Download the generated music file
     music_filename = (
@@ -101,11 +237,106 @@ async def music_generation(
 
     logging.info(f"🟢 Saving music to {music_filename}")
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get(music_url) as response:
-            if response.status == 200:
-                with open(music_filename, "wb") as f:
-                    f.write(await response.read())
-                return music_filename
-            else:
-                raise Exception(f"Error downloading music: {response.status}")
+    music_filename = await asset_cache.fetch(music_url, music_filename)
+
+    if config.MUSIC_CACHE_ENABLED:
+        _store_result(cache_key, music_url)
+
+    return music_filename
+
+
+# Chunk lengths (whole seconds, as MusicGen wants) that cover duration when
+# consecutive chunks overlap by overlap_s
+def plan_chunks(duration: float, chunk_s: float, overlap_s: float) -> list:
+    chunk_s = math.floor(chunk_s)
+    if chunk_s <= overlap_s:
+        raise ValueError(f"Music chunks of {chunk_s}s can't overlap by {overlap_s}s.")
+    count = max(1, math.ceil((duration - overlap_s) / (chunk_s - overlap_s)))
+    length = math.ceil((duration + (count - 1) * overlap_s) / count)
+    return [length] * count
+
+
+async def chunked_music_generation(
+    REPLICATE_API_TOKEN,
+    prompt,
+    duration,
+    seed=None,
+    filename_prefix="./",
+    fresh=False,
+    as_bytes=False,
+    **settings,
+):
+    """
+    Generates a long track as several shorter MusicGen predictions run at the
+    same time, joined with crossfades, so it takes about as long as one chunk.
+    Returns path to local audio file (or the bytes with as_bytes=True).
+
+    Chunks can't use MusicGen's continuation, which needs the previous chunk's
+    audio and so would run one after another. Instead they share the prompt
+    and consecutive seeds, which keeps the style consistent without every
+    chunk being the same clip. Without a seed they start from one derived
+    from the prompt and settings, so a repeated prompt gets the same chunks
+    back from the result cache (or a random one with fresh=True).
+    """
+    if as_bytes:
+        # The chunks and stitched track still need files, keep them out of ./
+        with tempfile.TemporaryDirectory(dir=workspace.current_path()) as work_path:
+            music_filename = await chunked_music_generation(
+                REPLICATE_API_TOKEN,
+                prompt,
+                duration,
+                seed=seed,
+                filename_prefix=work_path + "/",
+                fresh=fresh,
+                **settings,
+            )
+            return await asyncio.to_thread(asset_cache.read_file, music_filename)
+
+    lengths = plan_chunks(duration, config.MUSIC_CHUNK_S, config.MUSIC_CHUNK_OVERLAP_S)
+    if seed is None and fresh:
+        seed = random.randrange(2**31 - len(lengths))
+    elif seed is None:
+        key = result_cache_key(MUSICGEN_MODEL, {"prompt": prompt, "duration": duration, **settings})
+        seed = int(hashlib.sha256(key.encode()).hexdigest(), 16) % (2**31 - len(lengths))
+    logging.info(f"🕒 Generating {duration}s of music as {len(lengths)} chunks of {lengths[0]}s.")
+
+    tasks = [
+        asyncio.ensure_future(
+            music_generation(
+                REPLICATE_API_TOKEN,
+                prompt,
+                duration=length,
+                seed=seed + i,
+                filename_prefix=f"{filename_prefix}chunk{i + 1}_",
+                fresh=fresh,
+                degrade=False,
+                **settings,
+            )
+        )
+        for i, length in enumerate(lengths)
+    ]
+    try:
+        chunk_paths = await asyncio.gather(*tasks)
+    except CircuitOpenError:
+        # Rather one fallback track than fallback chunks crossfaded into real ones
+        return await _degraded_music(filename_prefix, False, duration)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    def stitch():
+        sample_rate = None
+        clips = []
+        for path in chunk_paths:
+            samples, rate = audio.read(path)
+            if sample_rate is not None and rate != sample_rate:
+                raise Exception(f"Music chunks have different sample rates ({sample_rate}, {rate}).")
+            sample_rate = rate
+            clips.append(samples)
+        track = audio.join(clips, sample_rate, config.MUSIC_CHUNK_OVERLAP_S)
+        track = audio.fade_out(audio.slice_seconds(track, sample_rate, 0, duration), sample_rate, 1)
+        return audio.write(f"{filename_prefix}music.wav", track, sample_rate)
+
+    music_filename = await asyncio.to_thread(stitch)
+    logging.info(f"🟢 Saving music to {music_filename}")
+    return music_filename
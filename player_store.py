@@ -0,0 +1,143 @@
+import asyncio
+import logging
+import sqlite3
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import config
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+
+# Chattorio player state, kept in SQLite behind a single persistent WAL-mode
+# connection. All database work runs on one dedicated thread so it never
+# blocks the Discord event loop, and recently active players are answered from
+# an in-memory write-through cache. Writes are committed in batches: after
+# PLAYER_STORE_BATCH_SIZE writes or PLAYER_STORE_COMMIT_DELAY_S seconds,
+# whichever comes first.
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="player_store")
+_conn = None
+_cache = OrderedDict()
+_uncommitted = 0
+_commit_timer = None
+
+stats = {"cache_hits": 0, "cache_misses": 0, "commits": 0}
+
+
+def _connect(db_path: str):
+    global _conn
+    if _conn is None:
+        _conn = sqlite3.connect(db_path)
+        _conn.execute("PRAGMA journal_mode=WAL")
+        _conn.execute("PRAGMA synchronous=NORMAL")
+        _conn.execute('''
+            CREATE TABLE IF NOT EXISTS player_state (
+                player_id TEXT PRIMARY KEY,
+                glif_id TEXT,
+                timestamp REAL,
+                game_state TEXT
+            )
+        ''')
+        _conn.commit()
+    return _conn
+
+
+def _select(player_id):
+    cursor = _connect(config.db_path).execute(
+        'SELECT glif_id, timestamp, game_state FROM player_state WHERE player_id = ?', (player_id,)
+    )
+    row = cursor.fetchone()
+    if row:
+        return {"glif_id": row[0], "timestamp": row[1], "game_state": row[2]}
+    return None
+
+
+def _upsert(player_id, glif_id, timestamp, game_state):
+    _connect(config.db_path).execute('''
+        INSERT INTO player_state (player_id, glif_id, timestamp, game_state)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(player_id)
+        DO UPDATE SET
+            glif_id = excluded.glif_id,
+            timestamp = excluded.timestamp,
+            game_state = excluded.game_state
+    ''', (player_id, glif_id, timestamp, game_state))
+
+
+def _commit():
+    if _conn is not None:
+        _conn.commit()
+        stats["commits"] += 1
+
+
+def _close():
+    global _conn
+    if _conn is not None:
+        _conn.commit()
+        _conn.close()
+        _conn = None
+
+
+async def _run(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(_executor, func, *args)
+
+
+def _remember(player_id, state):
+    _cache[player_id] = state
+    _cache.move_to_end(player_id)
+    while len(_cache) > config.PLAYER_CACHE_MAX_ENTRIES:
+        _cache.popitem(last=False)
+
+
+# Get a player's state, or None for a new player
+async def get_player_state(player_id):
+    if player_id in _cache:
+        stats["cache_hits"] += 1
+        _cache.move_to_end(player_id)
+        return dict(_cache[player_id])
+
+    stats["cache_misses"] += 1
+    state = await _run(_select, player_id)
+    if state is not None:
+        _remember(player_id, state)
+        return dict(state)
+    return None
+
+
+# Save a player's state, returns the saved state
+async def update_player_state(player_id, glif_id, timestamp, game_state):
+    global _uncommitted, _commit_timer
+
+    state = {"glif_id": glif_id, "timestamp": timestamp, "game_state": game_state}
+    _remember(player_id, state)
+    await _run(_upsert, player_id, glif_id, timestamp, game_state)
+
+    _uncommitted += 1
+    if _uncommitted >= config.PLAYER_STORE_BATCH_SIZE:
+        await flush()
+    elif _commit_timer is None:
+        _commit_timer = asyncio.get_running_loop().call_later(
+            config.PLAYER_STORE_COMMIT_DELAY_S, lambda: asyncio.ensure_future(flush())
+        )
+    return dict(state)
+
+
+# Commit any batched writes
+async def flush():
+    global _uncommitted, _commit_timer
+    if _commit_timer is not None:
+        _commit_timer.cancel()
+        _commit_timer = None
+    if _uncommitted:
+        _uncommitted = 0
+        await _run(_commit)
+
+
+# Commit and close the connection
+async def close():
+    await flush()
+    await _run(_close)
+    logging.info("Player store closed.")
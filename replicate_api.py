@@ -0,0 +1,150 @@
+import asyncio
+import logging
+from aiohttp import web
+import config
+import http_client
+import tracing
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+
+# asyncio-native client for Replicate predictions, on the shared HTTP session.
+# A prediction is created, then polled with a growing delay until it finishes,
+# without holding a thread while the GPU works. If REPLICATE_WEBHOOK_URL is set,
+# Replicate also calls us back when the prediction completes, which wakes the
+# poller straight away. The webhook isn't authenticated, so its body is never
+# used: the poller fetches the prediction from the API as usual. Cancelling the
+# awaiting task cancels the prediction on Replicate too, so we stop paying for
+# it.
+
+TERMINAL_STATUSES = ("succeeded", "failed", "canceled")
+
+# prediction id -> future the webhook endpoint resolves to wake the poller
+_webhook_waiters = {}
+_webhook_runner = None
+
+
+def _headers(api_token: str = None) -> dict:
+    return {
+        "Authorization": f"Bearer {api_token or config.REPLICATE_API_TOKEN}",
+        "Content-Type": "application/json",
+    }
+
+
+async def _request(method: str, url: str, api_token: str = None, json: dict = None) -> dict:
+    session = http_client.get_session()
+    async with session.request(method, url, headers=_headers(api_token), json=json) as response:
+        if response.status not in (200, 201):
+            error_message = f"Error calling Replicate API: {response.status} {await response.text()}"
+            logging.error(error_message)
+            raise Exception(error_message)
+        return await response.json()
+
+
+# Start a prediction. model is "owner/name:version".
+async def create_prediction(model: str, model_input: dict, api_token: str = None) -> dict:
+    payload = {"version": model.split(":", 1)[1], "input": model_input}
+    if config.REPLICATE_WEBHOOK_URL:
+        payload["webhook"] = config.REPLICATE_WEBHOOK_URL
+        payload["webhook_events_filter"] = ["completed"]
+    return await _request(
+        "POST", f"{config.REPLICATE_API_BASE}/predictions", api_token, payload
+    )
+
+
+async def get_prediction(prediction_id: str, api_token: str = None) -> dict:
+    return await _request(
+        "GET", f"{config.REPLICATE_API_BASE}/predictions/{prediction_id}", api_token
+    )
+
+
+async def cancel_prediction(prediction_id: str, api_token: str = None) -> dict:
+    return await _request(
+        "POST", f"{config.REPLICATE_API_BASE}/predictions/{prediction_id}/cancel", api_token
+    )
+
+
+# Poll until the prediction finishes, backing off between polls
+async def wait_for_prediction(prediction: dict, api_token: str = None) -> dict:
+    delay = config.REPLICATE_POLL_INITIAL_S
+    waiter = None
+    if config.REPLICATE_WEBHOOK_URL:
+        waiter = _webhook_waiters[prediction["id"]] = asyncio.get_running_loop().create_future()
+    try:
+        while prediction["status"] not in TERMINAL_STATUSES:
+            if waiter is not None:
+                # Wake up early if the webhook arrives first
+                await asyncio.wait([waiter], timeout=delay)
+                if waiter.done():
+                    # Before polling, so a webhook that arrives meanwhile isn't missed
+                    waiter = _webhook_waiters[prediction["id"]] = asyncio.get_running_loop().create_future()
+            else:
+                await asyncio.sleep(delay)
+            delay = min(delay * config.REPLICATE_POLL_BACKOFF, config.REPLICATE_POLL_MAX_S)
+            prediction = await get_prediction(prediction["id"], api_token)
+    finally:
+        _webhook_waiters.pop(prediction["id"], None)
+    return prediction
+
+
+# Run a model and return its output
+@tracing.traced("replicate")
+async def run(model: str, model_input: dict, api_token: str = None):
+    prediction = await create_prediction(model, model_input, api_token)
+    logging.info(f"🕒 Replicate prediction {prediction['id']} started.")
+    try:
+        prediction = await wait_for_prediction(prediction, api_token)
+    except asyncio.CancelledError:
+        logging.info(f"⚠️ Cancelling Replicate prediction {prediction['id']}.")
+        try:
+            await asyncio.shield(cancel_prediction(prediction["id"], api_token))
+        except Exception as e:
+            # The caller is waiting for its cancellation, not for this error
+            logging.error(f"Could not cancel Replicate prediction {prediction['id']}: {e}")
+        raise
+
+    if prediction["status"] != "succeeded":
+        error_message = f"Replicate prediction {prediction['id']} {prediction['status']}: {prediction.get('error')}"
+        logging.error(error_message)
+        raise Exception(error_message)
+
+    logging.info(f"🟢 Replicate prediction {prediction['id']} succeeded.")
+    return prediction.get("output")
+
+
+# Only wakes the poller for the prediction: anyone can POST here, so the body
+# is not trusted beyond its id
+async def _handle_webhook(request):
+    try:
+        prediction_id = (await request.json()).get("id")
+    except (ValueError, AttributeError):
+        return web.Response(status=400, text="bad request")
+    waiter = _webhook_waiters.get(prediction_id)
+    if waiter is not None and not waiter.done():
+        waiter.set_result(None)
+    return web.Response(text="ok")
+
+
+# Listen for Replicate's completion webhooks, if configured
+async def start_webhook_server():
+    global _webhook_runner
+    if not config.REPLICATE_WEBHOOK_URL or _webhook_runner is not None:
+        return
+    app = web.Application()
+    app.router.add_post("/replicate-webhook", _handle_webhook)
+    _webhook_runner = web.AppRunner(app)
+    await _webhook_runner.setup()
+    await web.TCPSite(
+        _webhook_runner, host=config.REPLICATE_WEBHOOK_HOST, port=config.REPLICATE_WEBHOOK_PORT
+    ).start()
+    logging.info(f"🟢 Replicate webhook listening on port {config.REPLICATE_WEBHOOK_PORT}")
+
+
+async def stop_webhook_server():
+    global _webhook_runner
+    if _webhook_runner is not None:
+        await _webhook_runner.cleanup()
+        _webhook_runner = None
@@ -0,0 +1,56 @@
+import asyncio
+import logging
+
+
+# Key for a prompt that ignores case and whitespace differences
+def normalize(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+class SingleFlight:
+    """
+    At most one call per key in flight. Callers asking for a key whose call is
+    already running wait for that call and share its result, or its exception,
+    instead of making their own. The call runs in a task of its own so that it
+    outlives the caller that started it, and is only cancelled once every
+    caller waiting for it has been cancelled.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        # key -> [task, number of callers waiting for it]
+        self._flights = {}
+        # Calls made, and calls saved by joining one in flight
+        self.stats = {"calls": 0, "saved": 0}
+
+    def __len__(self):
+        return len(self._flights)
+
+    async def run(self, key, func):
+        """
+        Returns the result of func(), an async function, or of the call for
+        the same key that is already in flight.
+        """
+        entry = self._flights.get(key)
+        if entry is None:
+            task = asyncio.get_running_loop().create_task(func())
+            entry = self._flights[key] = [task, 0]
+
+            def done(_):
+                if self._flights.get(key) is entry:
+                    del self._flights[key]
+
+            task.add_done_callback(done)
+            self.stats["calls"] += 1
+        else:
+            self.stats["saved"] += 1
+            logging.info(f"🟢 Joining the {self.name} call already in flight for the same prompt.")
+
+        task = entry[0]
+        entry[1] += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and not task.done():
+                task.cancel()
@@ -0,0 +1,275 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import contextvars
+import functools
+import logging
+import threading
+import time
+from collections import defaultdict
+from flask import Flask, Response
+from werkzeug.serving import make_server
+import config
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+
+# Lightweight tracing for the command pipelines. Each command runs as a "job"
+# (see start_job()), and every stage inside it, like a Glif call, a Replicate
+# prediction, a download, an ffmpeg run or the Discord upload, is timed with
+# span(). Spans are kept on the job, tagged with the command, user and
+# interaction id, for a per-job breakdown, and are aggregated into
+# Prometheus histograms and counters by stage and command, served on
+# METRICS_PORT at /metrics.
+
+# Histogram bucket upper bounds in seconds
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_job = contextvars.ContextVar("tracing_job", default=None)
+
+# The metrics server thread reads these while the bot writes them
+_lock = threading.Lock()
+# (stage, command) -> [bucket counts..., +Inf count], sum
+_histograms = {}
+# (stage, command, status) -> count
+_counters = defaultdict(int)
+# name -> (type, help, function returning the current value, label)
+_live_metrics = {}
+
+# How long a scrape waits for the event loop to read the metrics
+SNAPSHOT_TIMEOUT_S = 5
+
+_loop = None
+_server = None
+_server_thread = None
+
+
+# Start tracing a job in the current task (and the tasks it spawns).
+# Returns the job, whose "spans" list collects every span recorded in it.
+def start_job(command: str, user: str, interaction_id) -> dict:
+    job = {
+        "command": command,
+        "user": user,
+        "interaction_id": str(interaction_id),
+        "started_at": time.monotonic(),
+        "spans": [],
+    }
+    _job.set(job)
+    return job
+
+
+# Record a finished span of the given length, e.g. one timed elsewhere
+def record(name: str, seconds: float, status: str = "ok", **tags):
+    job = _job.get()
+    command = job["command"] if job is not None else ""
+    if job is not None:
+        job["spans"].append(
+            {
+                "name": name,
+                "seconds": seconds,
+                "status": status,
+                "command": job["command"],
+                "user": job["user"],
+                "interaction_id": job["interaction_id"],
+                **tags,
+            }
+        )
+
+    with _lock:
+        counts, total = _histograms.get((name, command), ([0] * (len(BUCKETS) + 1), 0.0))
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                counts[i] += 1
+        counts[-1] += 1
+        _histograms[(name, command)] = (counts, total + seconds)
+        _counters[(name, command, status)] += 1
+
+
+# Time the enclosed block as a span. Works in sync and async code.
+@contextlib.contextmanager
+def span(name: str, **tags):
+    started_at = time.monotonic()
+    status = "ok"
+    try:
+        yield
+    except asyncio.CancelledError:
+        status = "cancelled"
+        raise
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        record(name, time.monotonic() - started_at, status, **tags)
+
+
+# Decorator timing every call of an async function as a span
+def traced(name: str, **tags):
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with span(name, **tags):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+# Expose a value on /metrics, read on the event loop when scraped. With a
+# label, func returns a dict of label value -> value.
+def gauge(name: str, help_text: str, func, label: str = None):
+    _live_metrics[name] = ("gauge", help_text, func, label)
+
+
+# Like gauge(), for a total that only goes up. The name ends in _total.
+def counter(name: str, help_text: str, func, label: str = None):
+    if not name.endswith("_total"):
+        raise ValueError(f"Counter {name} should end in _total.")
+    _live_metrics[name] = ("counter", help_text, func, label)
+
+
+# Per stage: how many spans and their total time, then the job's total.
+# Stages that run in parallel (e.g. four scene renders) overlap, so they can
+# add up to more than the total.
+def format_breakdown(job: dict) -> str:
+    stages = {}
+    for s in job["spans"]:
+        if s["name"] == "command":
+            continue
+        count, total = stages.get(s["name"], (0, 0.0))
+        stages[s["name"]] = (count + 1, total + s["seconds"])
+    parts = [
+        f"{name} {total:.1f}s" if count == 1 else f"{name} {count}× {total:.1f}s"
+        for name, (count, total) in stages.items()
+    ]
+    parts.append(f"total {time.monotonic() - job['started_at']:.1f}s")
+    return " · ".join(parts)
+
+
+# Label values escaped as the text format requires: backslash, double quote
+# and line feed
+def _label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(**labels) -> str:
+    return ",".join(f'{key}="{_label_value(value)}"' for key, value in labels.items())
+
+
+# All metrics in the Prometheus text format
+def render_metrics() -> str:
+    lines = [
+        "# HELP bot_stage_seconds Time spent in each pipeline stage.",
+        "# TYPE bot_stage_seconds histogram",
+    ]
+    with _lock:
+        histograms = {key: (list(counts), total) for key, (counts, total) in _histograms.items()}
+        counters = dict(_counters)
+    for (stage, command), (counts, total) in sorted(histograms.items()):
+        for bound, count in zip(BUCKETS, counts):
+            lines.append(
+                f"bot_stage_seconds_bucket{{{_labels(stage=stage, command=command, le=bound)}}} {count}"
+            )
+        lines.append(
+            f"bot_stage_seconds_bucket{{{_labels(stage=stage, command=command, le='+Inf')}}} {counts[-1]}"
+        )
+        lines.append(f"bot_stage_seconds_sum{{{_labels(stage=stage, command=command)}}} {total}")
+        lines.append(f"bot_stage_seconds_count{{{_labels(stage=stage, command=command)}}} {counts[-1]}")
+
+    lines += [
+        "# HELP bot_stages_total Pipeline stages run, by outcome.",
+        "# TYPE bot_stages_total counter",
+    ]
+    for (stage, command, status), count in sorted(counters.items()):
+        lines.append(
+            f"bot_stages_total{{{_labels(stage=stage, command=command, status=status)}}} {count}"
+        )
+
+    for name, kind, help_text, samples in _snapshot():
+        if not samples:
+            continue
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+        lines += samples
+    return "\n".join(lines) + "\n"
+
+
+# Sample lines of every gauge and counter. Must run on the event loop, whose
+# state the functions read. A metric whose function fails is left out.
+def _read_metrics() -> list:
+    metrics = []
+    for name, (kind, help_text, func, label) in sorted(_live_metrics.items()):
+        try:
+            if label is None:
+                samples = [f"{name} {func()}"]
+            else:
+                samples = [
+                    f"{name}{{{_labels(**{label: key})}}} {value}"
+                    for key, value in sorted(func().items())
+                ]
+        except Exception:
+            logging.exception(f"Could not read metric {name}.")
+            continue
+        metrics.append((name, kind, help_text, samples))
+    return metrics
+
+
+# _read_metrics() run on the event loop, from the metrics server thread
+def _snapshot() -> list:
+    if _loop is None or not _loop.is_running() or _loop_is_current():
+        return _read_metrics()
+    future = concurrent.futures.Future()
+
+    def read():
+        try:
+            future.set_result(_read_metrics())
+        except BaseException as e:
+            future.set_exception(e)
+
+    _loop.call_soon_threadsafe(read)
+    try:
+        return future.result(timeout=SNAPSHOT_TIMEOUT_S)
+    except concurrent.futures.TimeoutError:
+        logging.warning("⚠️ The event loop is busy, /metrics has no gauges or counters this time.")
+        return []
+
+
+def _loop_is_current() -> bool:
+    try:
+        return asyncio.get_running_loop() is _loop
+    except RuntimeError:
+        return False
+
+
+_app = Flask(__name__)
+
+
+@_app.route("/metrics")
+def _metrics():
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+
+# Serve /metrics from a background thread, if METRICS_PORT is set
+def start_metrics_server():
+    global _loop, _server, _server_thread
+    if not config.METRICS_PORT or _server is not None:
+        return
+    try:
+        _loop = asyncio.get_running_loop()
+    except RuntimeError:
+        _loop = None
+    _server = make_server("0.0.0.0", config.METRICS_PORT, _app, threaded=True)
+    _server_thread = threading.Thread(target=_server.serve_forever, daemon=True)
+    _server_thread.start()
+    logging.info(f"🟢 Metrics on port {config.METRICS_PORT} at /metrics")
+
+
+def stop_metrics_server():
+    global _server, _server_thread
+    if _server is not None:
+        _server.shutdown()
+        _server_thread.join()
+        _server = None
+        _server_thread = None
@@ -1,11 +1,19 @@
 import os
-import aiohttp
+import math
 import asyncio
 import logging
 import random
+import shlex
 import shutil
 import tempfile
+import threading
+import contextlib
 import config
+import asset_cache
+import audio
+import ffmpeg_pool
+import encoding_profiles
+import kenburns
 
 # Configure logging
 logging.basicConfig(
@@ -16,26 +24,62 @@ logging.basicConfig(level=logging.INFO)
 
 
 # Default image URL
-DEFAULT_IMAGE_URL = "https://glif.app/_next/image?url=https%3A%2F%2Fres.cloudinary.com%2Fdzkwltgyd%2Fimage%2Fupload%2Fv1699551574%2Fglif-run-outputs%2Fs6s7h7fypr9pr35bpxul.png&w=2048&q=75&dpl=dpl_J7MPoF6chivDp2KiVJA6mJ9faKu1"
+DEFAULT_IMAGE_URL = config.DEFAULT_IMAGE_URL
 
 
-# Download a file from a URL to a local file
+# Download a file from a URL to a local file, reading through the asset cache
 async def download_file(url, file_name):
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
-            if response.status == 200:
-                with open(file_name, "wb") as f:
-                    while True:
-                        chunk = await response.content.read(1024)
-                        if not chunk:
-                            break
-                        f.write(chunk)
-                logging.info(f"File downloaded successfully: {file_name}")
-                return file_name
-            else:
-                error_msg = f"Failed to download file from {url}"
-                logging.error(error_msg)
-                raise Exception(error_msg)
+    return await asset_cache.fetch(url, file_name)
+
+
+# Download or assign an image file, falling back to the default image
+async def resolve_image(image_source: str, image_path: str) -> str:
+    if image_source and (
+        image_source.startswith("http://") or image_source.startswith("https://")
+    ):
+        return await download_file(image_source, image_path)
+    elif image_source:
+        return image_source
+    else:
+        logging.warn(f"Could not find image source of {image_source}, using default.")
+        return await download_file(DEFAULT_IMAGE_URL, image_path)
+
+
+# Load an image into memory, falling back to the default image
+async def load_image_bytes(image_source: str) -> bytes:
+    if image_source and (
+        image_source.startswith("http://") or image_source.startswith("https://")
+    ):
+        return await asset_cache.fetch_bytes(image_source)
+    elif image_source:
+        return await asyncio.to_thread(asset_cache.read_file, image_source)
+    else:
+        logging.warn(f"Could not find image source of {image_source}, using default.")
+        return await asset_cache.fetch_bytes(DEFAULT_IMAGE_URL)
+
+
+# How much the zoom factor grows per second (0.001 per frame at 25 fps)
+ZOOM_PER_SECOND = 0.025
+
+
+# ffmpeg filter that slowly zooms into a still image and draws a subtitle on it.
+# The zoom speed and text size are scaled so every profile gets the same
+# zoom over time and the same layout as the original 1024x1024 at 25 fps.
+def zoom_filter(subtitle: str = "", profile: dict = None) -> str:
+    profile = profile or encoding_profiles.PROFILES["default"]
+    size = profile["size"]
+    fps = profile["fps"]
+    return (
+        f"zoompan=z='zoom+{ZOOM_PER_SECOND / fps:.6f}':d=200:x='iw/2-(iw/zoom/2)':y='ih/2-(ih/zoom/2)':s={size}x{size}:fps={fps}, "
+        f"{subtitle_filter(subtitle, profile)}"
+    )
+
+
+# ffmpeg filter that draws a subtitle near the bottom of the frame
+def subtitle_filter(subtitle: str = "", profile: dict = None) -> str:
+    profile = profile or encoding_profiles.PROFILES["default"]
+    scale = profile["size"] / 1024
+    return f"drawtext=text='{subtitle}':fontsize={round(64 * scale)}:fontcolor=white:shadowcolor=black:shadowx=2:shadowy=2:x=(w-text_w)/2:y=h-th-{round(100 * scale)}"
 
 
 # Generate a video from an image and audio source
@@ -45,9 +89,11 @@ async def generate_video(
     file_prefix: str = "./",
     duration: float = None,
     subtitle: str = "",
+    profile: dict = None,
 ) -> str:
     """Generates video from image and audio sources using ffmpeg, returns path to local video file."""
     logging.info("generate_video zoom")
+    profile = profile or encoding_profiles.choose()
 
     # Define the paths for temporary files
     image_path = f"{file_prefix}img.jpg"
@@ -55,15 +101,7 @@ async def generate_video(
     video_path = f"{file_prefix}video.mp4"
 
     # Download or assign image file
-    if image_source and (
-        image_source.startswith("http://") or image_source.startswith("https://")
-    ):
-        image_path = await download_file(image_source, image_path)
-    elif image_source:
-        image_path = image_source
-    else:
-        logging.warn(f"Could not find image source of {image_source}, using default.")
-        image_path = await download_file(DEFAULT_IMAGE_URL, image_path)
+    image_path = await resolve_image(image_source, image_path)
 
     if not audio_source and duration is None:
         raise ValueError(f"No audio source found for video at {audio_source}.")
@@ -84,113 +122,343 @@ async def generate_video(
             f"No audio source found for video to go with image {image_path}."
         )
 
+    if audio_source is not None and audio_path.endswith(".wav"):
+        # Cut the 8 second clip here with a fade out rather than letting -t chop it
+        audio_path = await asyncio.to_thread(
+            audio.trim, audio_path, f"{file_prefix}clip.wav", 8
+        )
+
+    if config.ZOOM_RENDERER == "numpy":
+        await kenburns.render_video(
+            image_path,
+            audio_path,
+            video_path,
+            8 if audio_source is not None else duration,
+            subtitle_filter(subtitle, profile),
+            ZOOM_PER_SECOND,
+            profile,
+        )
+        logging.info(f"Video generated successfully: {video_path}")
+        return video_path
+
     # Create the ffmpeg command
     if audio_source is not None:
         # Duration implied from audio
         logging.info(f"Duration implied from audio: {audio_path}")
         cmd = (
             f"ffmpeg -loop 1 -framerate 10 -i {image_path} -i {audio_path} "
-            f"-filter_complex \"[0:v]zoompan=z='zoom+0.001':d=200:x='iw/2-(iw/zoom/2)':y='ih/2-(ih/zoom/2)':s=1024x1024, "
-            f"drawtext=text='{subtitle}':fontsize=64:fontcolor=white:shadowcolor=black:shadowx=2:shadowy=2:x=(w-text_w)/2:y=h-th-100[fv];[fv][1:a]concat=n=1:v=1:a=1[v][a]\" "
-            f"-map '[v]' -map '[a]' -c:v libx264 -tune stillimage -c:a aac -strict experimental "
-            f"-b:a 192k -pix_fmt yuv420p -t 8 {video_path}"
+            f"-filter_complex \"[0:v]{zoom_filter(subtitle, profile)}[fv];[fv][1:a]concat=n=1:v=1:a=1[v][a]\" "
+            f"-map '[v]' -map '[a]' {encoding_profiles.video_args(profile)} "
+            f"{encoding_profiles.audio_args(profile)} -t 8 {encoding_profiles.thread_args(profile)} {video_path}"
         )
     else:
         # Duration specified
         logging.info(f"Duration specified: {duration}")
         cmd = (
             f"ffmpeg -loop 1 -framerate 10 -i {image_path} "
-            f"-filter_complex \"[0:v]zoompan=z='zoom+0.001':d=200:x='iw/2-(iw/zoom/2)':y='ih/2-(ih/zoom/2)':s=1024x1024, "
-            f"drawtext=text='{subtitle}':fontsize=64:fontcolor=white:shadowcolor=black:shadowx=2:shadowy=2:x=(w-text_w)/2:y=h-th-100[fv]\" "
-            f"-map '[fv]' -c:v libx264 -tune stillimage -pix_fmt yuv420p -t {duration} {video_path}"
+            f"-filter_complex \"[0:v]{zoom_filter(subtitle, profile)}[fv]\" "
+            f"-map '[fv]' {encoding_profiles.video_args(profile)} -t {duration} "
+            f"{encoding_profiles.thread_args(profile)} {video_path}"
         )
 
-    logging.info(cmd)
+    # Run the ffmpeg command once the scheduler has a free slot
+    await ffmpeg_pool.run(cmd, label=f"video {os.path.basename(video_path)}")
 
-    # Run the ffmpeg command
-    process = await asyncio.create_subprocess_shell(
-        cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
-    )
+    logging.info(f"Video generated successfully: {video_path}")
 
-    # Wait for the command to complete
-    stdout, stderr = await process.communicate()
+    return video_path
 
-    if process.returncode != 0:
-        error_message = f"ffmpeg command failed for video:\n{stderr}"
-        logging.error(error_message)
-        raise Exception(error_message)
 
-    logging.info(f"Video generated successfully: {video_path}")
+def _feed_pipe(pipe_path: str, data: bytes):
+    try:
+        with open(pipe_path, "wb") as f:
+            f.write(data)
+    except BrokenPipeError:
+        # ffmpeg stopped reading, it will report its own error
+        pass
 
-    return video_path
 
+@contextlib.contextmanager
+def _piped_inputs(datas):
+    """
+    Exposes each in-memory buffer as a named pipe that ffmpeg can read as an
+    ordinary input, yielding the pipe paths. Nothing but the pipes themselves
+    touches the disk.
+    """
+    pipe_dir = tempfile.mkdtemp(prefix="ffmpeg_pipes_")
+    pipe_paths = []
+    feeders = []
+    try:
+        for i, data in enumerate(datas):
+            pipe_path = os.path.join(pipe_dir, f"input{i}")
+            os.mkfifo(pipe_path)
+            pipe_paths.append(pipe_path)
+            feeder = threading.Thread(target=_feed_pipe, args=(pipe_path, data), daemon=True)
+            feeder.start()
+            feeders.append(feeder)
+        yield pipe_paths
+    finally:
+        for pipe_path, feeder in zip(pipe_paths, feeders):
+            if feeder.is_alive():
+                # ffmpeg never opened this pipe; drain it ourselves so the
+                # feeder's blocking open() and write() return
+                fd = os.open(pipe_path, os.O_RDONLY | os.O_NONBLOCK)
+                try:
+                    while feeder.is_alive():
+                        with contextlib.suppress(BlockingIOError):
+                            os.read(fd, 1 << 16)
+                        feeder.join(timeout=0.01)
+                finally:
+                    os.close(fd)
+        shutil.rmtree(pipe_dir, ignore_errors=True)
+
+
+async def generate_video_bytes(
+    image_data: bytes,
+    audio_data: bytes = None,
+    duration: float = None,
+    subtitle: str = "",
+    profile: dict = None,
+) -> bytes:
+    """
+    In-memory version of generate_video: the image and audio are piped into
+    ffmpeg and the video comes back as fragmented MP4 bytes, ready to upload.
+    """
+    logging.info("generate_video_bytes zoom")
+    profile = profile or encoding_profiles.choose()
 
-async def concatenate_videos_async(video_files, output_file="output.mp4"):
+    if audio_data is None and duration is None:
+        raise ValueError(f"No audio source or duration provided.")
+
+    datas = [image_data] if audio_data is None else [image_data, audio_data]
+    with _piped_inputs(datas) as pipe_paths:
+        # A pipe can only be read once, so loop the single decoded frame
+        # with a filter instead of re-reading the image with -loop 1
+        inputs = f"-f image2pipe -i {pipe_paths[0]}"
+        audio_args = ""
+        if audio_data is not None:
+            inputs += f" -i {pipe_paths[1]}"
+            audio_args = f"-map 1:a {encoding_profiles.audio_args(profile)}"
+        cmd = (
+            f"ffmpeg {inputs} "
+            f"-filter_complex \"[0:v]loop=loop=-1:size=1,setpts=N/10/TB,{zoom_filter(subtitle, profile)}[fv]\" "
+            f"-map '[fv]' {audio_args} {encoding_profiles.video_args(profile)} "
+            f"-t {duration if duration is not None else 8} "
+            f"-movflags frag_keyframe+empty_moov -f mp4 {encoding_profiles.thread_args(profile)} pipe:1"
+        )
+        stdout, stderr = await ffmpeg_pool.run(cmd, label="video (in memory)")
+
+    logging.info(f"Video generated successfully in memory ({len(stdout)} bytes)")
+    return stdout
+
+
+# Put images side by side in a grid of tile_size squares, as close to square
+# as possible, e.g. 2x2 for 3 or 4 images. Returns the path to the JPEG.
+async def make_grid(image_paths: list, output_path: str, tile_size: int = 512) -> str:
+    count = len(image_paths)
+    columns = math.ceil(math.sqrt(count))
+    rows = math.ceil(count / columns)
+    inputs = " ".join(f"-i {shlex.quote(path)}" for path in image_paths)
+    tiles = ";".join(
+        f"[{i}:v]scale={tile_size}:{tile_size},setsar=1[t{i}]" for i in range(count)
+    )
+    if count == 1:
+        filter_complex = f"{tiles};[t0]null[grid]"
+    else:
+        layout = "|".join(
+            f"{(i % columns) * tile_size}_{(i // columns) * tile_size}" for i in range(count)
+        )
+        stacked = "".join(f"[t{i}]" for i in range(count))
+        filter_complex = f"{tiles};{stacked}xstack=inputs={count}:layout={layout}:fill=black[grid]"
+    cmd = (
+        f"ffmpeg -y {inputs} -filter_complex \"{filter_complex}\" -map '[grid]' "
+        f"-frames:v 1 -q:v 3 {ffmpeg_pool.thread_args(1)} {shlex.quote(output_path)}"
+    )
+    await ffmpeg_pool.run(cmd, label=f"grid of {count} ({columns}x{rows})")
+    return output_path
+
+
+async def concatenate_videos_async(
+    video_files,
+    output_file="output.mp4",
+    audio_file=None,
+    profile: dict = None,
+    duration: float = None,
+):
     """
     Concatenates a list of videos into a single video file using FFmpeg, asynchronously,
-    using the demuxer syntax for concatenation.
+    using the demuxer syntax for concatenation. The video is copied, not re-encoded.
 
     :param video_files: List of paths to video files.
     :param output_file: Path to the output video file.
+    :param audio_file: Optional audio to use as the soundtrack instead of the videos' own.
+    :param profile: Encoding profile for the soundtrack.
+    :param duration: Length of the videos together, needed with audio_file. The
+        soundtrack is padded with silence or cut to match.
     :return: Path to the concatenated output video file.
     """
+    profile = profile or encoding_profiles.choose()
     # Ensure FFmpeg is installed
     if not shutil.which("ffmpeg"):
         raise RuntimeError("FFmpeg is not installed or not in the PATH.")
+    if audio_file is not None and duration is None:
+        raise ValueError("The film's duration is needed to fit the soundtrack to it.")
 
     # Create a temporary file to list all video files
-    with tempfile.NamedTemporaryFile(mode="w+", delete=False) as list_file:
+    with tempfile.NamedTemporaryFile(
+        mode="w+", delete=False, dir=os.path.dirname(os.path.abspath(output_file))
+    ) as list_file:
         for file in video_files:
             abs_path = os.path.abspath(file)  # Convert to absolute path
             list_file.write(f"file '{abs_path}'\n")
         list_path = list_file.name
 
     # Create the FFmpeg command
-    cmd = f"ffmpeg -y -safe 0 -f concat -i {list_path} -c copy {output_file}"
-    logging.info(cmd)
+    if audio_file is None:
+        cmd = f"ffmpeg -y -safe 0 -f concat -i {list_path} -c copy {output_file}"
+    else:
+        cmd = (
+            f"ffmpeg -y -safe 0 -f concat -i {list_path} -i {shlex.quote(audio_file)} "
+            f"-map 0:v -map 1:a -c:v copy -af apad=whole_dur={duration} -t {duration} "
+            f"{encoding_profiles.audio_args(profile)} "
+            f"{encoding_profiles.thread_args(profile)} {output_file}"
+        )
 
-    # Run the command asynchronously
-    process = await asyncio.create_subprocess_shell(
-        cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
-    )
+    # Run the command once the scheduler has a free slot
+    try:
+        await ffmpeg_pool.run(cmd, label="concat")
+    finally:
+        # Clean up the temporary file
+        os.remove(list_path)
+
+    return os.path.abspath(output_file)
 
-    # Wait for the command to complete and capture stdout and stderr
-    stdout, stderr = await process.communicate()
 
-    # Check for errors
-    if process.returncode != 0:
-        error_message = f"FFmpeg command failed: {stderr.decode('utf-8')}"
-        raise Exception(error_message)
+async def concatenate_videos_with_audio_async(
+    video_files, audio_file, output_file="output.mp4", duration: float = None
+):
+    """
+    Concatenates any number of videos and lays an audio track over them, re-encoding once.
+
+    :param video_files: List of paths to video files.
+    :param audio_file: Path to the audio file.
+    :param output_file: Path to the output video file.
+    :param duration: Length of the videos together. The audio is padded with
+        silence or cut to match.
+    :return: Path to the concatenated output video file.
+    """
+    # Ensure FFmpeg is installed
+    if not shutil.which("ffmpeg"):
+        raise RuntimeError("FFmpeg is not installed or not in the PATH.")
+    if duration is None:
+        raise ValueError("The film's duration is needed to fit the soundtrack to it.")
+
+    inputs = " ".join(f"-i {shlex.quote(v)}" for v in video_files)
+    labels = "".join(f"[{i}:v]" for i in range(len(video_files)))
+    audio_index = len(video_files)
+
+    cmd = (
+        f"ffmpeg {inputs} -i {shlex.quote(audio_file)} "
+        f"-filter_complex \"{labels}concat=n={len(video_files)}:v=1:a=0[outv];"
+        f"[{audio_index}:a]apad=whole_dur={duration}[outa]\" "
+        f"-map \"[outv]\" -map \"[outa]\" -c:a aac -strict -2 -t {duration} "
+        f"{ffmpeg_pool.thread_args()} -y {shlex.quote(output_file)}"
+    )
 
-    # Clean up the temporary file
-    os.remove(list_path)
+    # Run the command once the scheduler has a free slot
+    await ffmpeg_pool.run(cmd, label="concat with audio")
 
     return os.path.abspath(output_file)
 
-async def concatenate_videos_with_audio_async(video1, video2, video3, video4, audio_file, output_file="output.mp4"):
 
-  # Ensure FFmpeg is installed
-  if not shutil.which("ffmpeg"):
-      raise RuntimeError("FFmpeg is not installed or not in the PATH.")
+# How many times shrink_to_fit() re-encodes before giving up
+SHRINK_ATTEMPTS = 2
 
-  cmd = (
-      f"ffmpeg -i {video1} -i {video2} -i {video3} -i {video4} -i {audio_file} "
-      f"-filter_complex \"[0:v][1:v][2:v][3:v]concat=n=4:v=1:a=0[outv]\" "
-      f"-map \"[outv]\" -map 4:a -c:a aac -strict -2 -y {output_file}"
-  )
 
-  # Run the command asynchronously
-  process = await asyncio.create_subprocess_shell(
-      cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
-  )
+async def shrink_to_fit(video_path: str, max_bytes: int, duration: float, profile: dict = None) -> str:
+    """
+    Makes sure a video fits in max_bytes, for when the size cap of
+    encoding_profiles.fit_to_size() misses: re-encodes it a quarter smaller,
+    with the video bitrate capped below what it actually came out at by as
+    much as it was over. Videos that already fit are returned untouched,
+    which is almost always.
 
-  # Wait for the command to complete and capture stdout and stderr
-  stdout, stderr = await process.communicate()
+    :return: Path to a video that fits.
+    """
+    profile = profile or encoding_profiles.choose()
+    for attempt in range(1, SHRINK_ATTEMPTS + 1):
+        size = os.path.getsize(video_path)
+        if size <= max_bytes:
+            return video_path
+        logging.warning(f"⚠️ {video_path} is {size} bytes, over {max_bytes}, shrinking.")
+        # Bitrates the video has and needs, keeping 10% headroom
+        actual_kbps = size * 8 / 1000 / duration - encoding_profiles.audio_kbps(profile)
+        excess_kbps = (size - max_bytes) * 8 / 1000 / duration
+        kbps = max(1, int((actual_kbps - excess_kbps) * 0.9))
+        smaller = dict(profile, max_video_kbps=kbps)
+        output_path = f"{os.path.splitext(video_path)[0]}_fit{attempt}.mp4"
+        cmd = (
+            f"ffmpeg -y -i {shlex.quote(video_path)} -vf 'scale=trunc(iw*3/8)*2:-2' "
+            f"{encoding_profiles.video_args(smaller)} -c:a copy "
+            f"{encoding_profiles.thread_args(profile)} {shlex.quote(output_path)}"
+        )
+        await ffmpeg_pool.run(cmd, label="shrink to fit")
+        video_path = output_path
 
-  # Check for errors
-  if process.returncode != 0:
-      error_message = f"FFmpeg command failed: {stderr.decode('utf-8')}"
-      raise Exception(error_message)
+    size = os.path.getsize(video_path)
+    if size > max_bytes:
+        raise Exception(f"Video is {size} bytes, too big to upload (limit {max_bytes}).")
+    return video_path
 
-  return os.path.abspath(output_file)
 
+async def assemble_film(scenes, audio_file, output_file="output.mp4", profile: dict = None):
+    """
+    Renders a whole film with a single ffmpeg run: every scene gets its own zoom
+    and subtitle, the scenes are concatenated and the audio is muxed in, all in
+    one filtergraph and one encode pass, with no intermediate scene files. The
+    audio is padded with silence or cut to the length of the scenes.
+
+    :param scenes: List of dicts with "image" (local path), "duration" (seconds)
+        and optionally "subtitle".
+    :param audio_file: Path to the audio file.
+    :param output_file: Path to the output video file.
+    :param profile: Encoding profile, see encoding_profiles.py.
+    :return: Path to the film.
+    """
+    profile = profile or encoding_profiles.choose()
+    # Ensure FFmpeg is installed
+    if not shutil.which("ffmpeg"):
+        raise RuntimeError("FFmpeg is not installed or not in the PATH.")
+
+    if not scenes:
+        raise ValueError("A film needs at least one scene.")
+
+    inputs = []
+    filters = []
+    for i, scene in enumerate(scenes):
+        inputs.append(
+            f"-loop 1 -framerate 10 -t {scene['duration']} -i {shlex.quote(scene['image'])}"
+        )
+        # zoompan emits many frames per input frame, so cut each scene to length
+        filters.append(
+            f"[{i}:v]{zoom_filter(scene.get('subtitle', ''), profile)},"
+            f"trim=duration={scene['duration']},setpts=PTS-STARTPTS[v{i}]"
+        )
+    labels = "".join(f"[v{i}]" for i in range(len(scenes)))
+    filters.append(f"{labels}concat=n={len(scenes)}:v=1:a=0[outv]")
+    audio_index = len(scenes)
+    total_duration = sum(scene["duration"] for scene in scenes)
+    filters.append(f"[{audio_index}:a]apad=whole_dur={total_duration}[outa]")
+
+    cmd = (
+        f"ffmpeg {' '.join(inputs)} -i {shlex.quote(audio_file)} "
+        f"-filter_complex \"{';'.join(filters)}\" "
+        f"-map \"[outv]\" -map \"[outa]\" "
+        f"{encoding_profiles.video_args(profile)} {encoding_profiles.audio_args(profile)} "
+        f"-t {total_duration} {encoding_profiles.thread_args(profile)} -y {shlex.quote(output_file)}"
+    )
+
+    # Run the command once the scheduler has a free slot
+    await ffmpeg_pool.run(cmd, label=f"film ({len(scenes)} scenes)")
+
+    return os.path.abspath(output_file)
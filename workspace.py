@@ -0,0 +1,177 @@
+import asyncio
+import contextlib
+import contextvars
+import logging
+import os
+import shutil
+import time
+import uuid
+import config
+import asset_cache
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+
+# Every command gets its own workspace directory under WORKSPACE_PATH for its
+# intermediate files (downloads, scene clips, concat lists, the final video),
+# which is deleted when the command finishes, fails or is cancelled. A
+# background janitor cleans up whatever is left behind anyway, e.g. after a
+# crash: it deletes files in TEMP_PATH and WORKSPACE_PATH older than
+# TEMP_MAX_AGE_S, then the oldest ones until they are under TEMP_MAX_BYTES.
+# The asset cache manages its own directory and is left alone.
+
+WORKSPACE_PATH = config.WORKSPACE_PATH
+
+_current = contextvars.ContextVar("workspace_path", default=None)
+_active = set()
+_janitor_task = None
+
+# Disk usage as of the last sweep, and what the janitor has deleted
+stats = {
+    "bytes": 0,
+    "files": 0,
+    "free_bytes": 0,
+    "deleted_bytes": 0,
+    "deleted_entries": 0,
+}
+
+
+# Directory (with trailing slash) for the current job's files, or TEMP_PATH
+# outside a job
+def current_path() -> str:
+    return _current.get() or config.TEMP_PATH
+
+
+@contextlib.asynccontextmanager
+async def scoped(name: str):
+    """
+    Creates a workspace directory for the enclosed block and makes it the
+    current_path() of the task (and tasks it spawns), then deletes it.
+
+    :param name: Readable part of the directory name.
+    """
+    path = os.path.join(WORKSPACE_PATH, f"{name}_{uuid.uuid4().hex[:8]}") + "/"
+    await asyncio.to_thread(os.makedirs, path, exist_ok=True)
+    _active.add(os.path.abspath(path))
+    token = _current.set(path)
+    try:
+        yield path
+    finally:
+        _current.reset(token)
+        _active.discard(os.path.abspath(path))
+        if not config.KEEP_WORKSPACES:
+            await asyncio.to_thread(shutil.rmtree, path, True)
+
+
+# Size in bytes, file count and last modification time of a file or
+# directory tree. Files hard-linked from the asset cache take no extra space,
+# so each inode is only counted once across calls sharing `seen`.
+def _usage(path: str, seen: set):
+    if not os.path.isdir(path) or os.path.islink(path):
+        paths = [path]
+    else:
+        paths = [os.path.join(root, name) for root, _, names in os.walk(path) for name in names]
+    size, files, mtime = 0, 0, os.lstat(path).st_mtime
+    for file_path in paths:
+        with contextlib.suppress(OSError):
+            st = os.lstat(file_path)
+            files += 1
+            mtime = max(mtime, st.st_mtime)
+            if (st.st_dev, st.st_ino) not in seen:
+                seen.add((st.st_dev, st.st_ino))
+                size += st.st_size
+    return size, files, mtime
+
+
+def _remove(path: str):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+
+
+def _sweep() -> dict:
+    os.makedirs(WORKSPACE_PATH, exist_ok=True)
+    workspace_root = os.path.abspath(WORKSPACE_PATH)
+    keep = {os.path.abspath(asset_cache.CACHE_PATH)} | _active
+
+    entries = []
+    seen = set()
+    total_bytes, total_files = 0, 0
+    for root in {os.path.abspath(config.TEMP_PATH), workspace_root}:
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            if path == workspace_root:
+                # Swept entry by entry as a root of its own
+                continue
+            try:
+                size, files, mtime = _usage(path, seen)
+            except OSError:
+                continue
+            total_bytes += size
+            total_files += files
+            if path not in keep:
+                entries.append((mtime, size, files, path))
+
+    deleted_bytes, deleted_entries = 0, 0
+    now = time.time()
+    entries.sort()
+    for mtime, size, files, path in entries:
+        too_old = now - mtime > config.TEMP_MAX_AGE_S
+        too_big = total_bytes - deleted_bytes > config.TEMP_MAX_BYTES
+        if not too_old and not too_big:
+            # Oldest first, so nothing after this needs deleting either
+            break
+        _remove(path)
+        deleted_bytes += size
+        deleted_entries += 1
+        total_files -= files
+
+    if deleted_entries:
+        logging.info(f"🧹 Janitor deleted {deleted_entries} old temp files ({deleted_bytes} bytes).")
+    stats.update(
+        bytes=total_bytes - deleted_bytes,
+        files=total_files,
+        free_bytes=shutil.disk_usage(WORKSPACE_PATH).free,
+        deleted_bytes=stats["deleted_bytes"] + deleted_bytes,
+        deleted_entries=stats["deleted_entries"] + deleted_entries,
+    )
+    return stats
+
+
+# Run one janitor pass now
+async def sweep() -> dict:
+    return await asyncio.to_thread(_sweep)
+
+
+async def _janitor():
+    while True:
+        try:
+            await sweep()
+        except Exception:
+            logging.exception("Janitor sweep failed.")
+        await asyncio.sleep(config.JANITOR_INTERVAL_S)
+
+
+def start_janitor():
+    global _janitor_task
+    if _janitor_task is None:
+        _janitor_task = asyncio.get_running_loop().create_task(_janitor())
+
+
+async def stop_janitor():
+    global _janitor_task
+    if _janitor_task is not None:
+        _janitor_task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await _janitor_task
+        _janitor_task = None
+
+
+# Number of workspaces in use
+def active_count() -> int:
+    return len(_active)